@@ -4,6 +4,10 @@ from tornado import web
 from tornado.log import app_log
 
 from .urls import urlpatterns
+from .cache import RedisCache, FragmentCache, CacheInvalidator
+from .middlewares import MiddlewareChain
+from .models.rate_limit import RateLimiter
+from .libs.utils import import_object
 from config import config_dict
 
 
@@ -16,4 +20,18 @@ def create_app(mode='dev'):
         **config_cls.APP_SETTINGS
     )
     app.logger = app_log
-    return app
\ No newline at end of file
+    # 中间件只在启动时解析和实例化一次，所有请求共享
+    app.middleware_chain = MiddlewareChain(config_cls.MIDDLEWARES)
+    # 片段缓存和页面缓存使用同一个缓存类，数据改动时清除依赖它的缓存
+    cache_middleware = app.middleware_chain.get('CacheMiddleware')
+    cache = RedisCache
+    if cache_middleware is not None:
+        cache = cache_middleware.cache
+    FragmentCache.cache = cache
+    CacheInvalidator.setup(cache)
+    # 频率限制的实现，默认使用Redis，单进程部署或者测试时可以使用
+    # `'app.models.rate_limit.LocalBackend'`
+    rate_limit_backend = getattr(config_cls, 'RATE_LIMIT_BACKEND', None)
+    if rate_limit_backend:
+        RateLimiter.use_backend(import_object(rate_limit_backend)())
+    return app
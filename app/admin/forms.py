@@ -146,6 +146,10 @@ class SysConfigForm(Form):
         "session过期时间(单位:秒)",
         validators=[DataRequired()]
     )
+    session_refresh_threshold = IntegerField(
+        "session剩余时间低于该值时延期(单位:秒)",
+        validators=[DataRequired()]
+    )
     comment_limit_enable = BooleanField(
         "是否开启评论限制",
     )
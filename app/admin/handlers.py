@@ -207,7 +207,7 @@ class PostListHandler(BaseHandler):
 
     @web.authenticated
     def get(self, *args, **kwargs):
-        object_list = Post.get_object_list(self.db)
+        object_list = Post.get_object_list(self.db, profile='list')
         data = self.handle_object_list(
             object_list,
             self._page,
@@ -317,6 +317,7 @@ class PostCreateHandler(BaseHandler):
             content=form.content.data,
             type=form.type.data,
         )
+        yield self.render_post_content(post_obj)
         # 处理文章集合
         if form.collection.data:
             collection = PostCollection.get_object_by_name(
@@ -475,6 +476,7 @@ class PostDetailHandler(BaseHandler):
             content=form.content.data,
             type=form.type.data,
         )
+        yield self.render_post_content(obj)
         # collection的处理
         if not form.collection.data:
             obj.collection = None
@@ -517,6 +519,8 @@ class SysConfigHandler(BaseHandler):
     def get(self, *args, **kwargs):
         form = SysConfigForm(data={
             "session_expire": SysConfig.get(**SysConfig.session_expire),
+            "session_refresh_threshold": SysConfig.get(
+                                    **SysConfig.session_refresh_threshold),
             "per_page": SysConfig.get(**SysConfig.per_page),
             "blog_per_page": SysConfig.get(**SysConfig.blog_per_page),
             "cache_enable": SysConfig.get(**SysConfig.cache_enable),
@@ -545,10 +549,14 @@ class SysConfigHandler(BaseHandler):
                 errors=None
             )
 
+        changed = False
         for key, value in form.data.items():
+            if SysConfig.get(key, type=type(value)) != value:
+                changed = True
             SysConfig.set(key, value, type=type(value))
-        # 清空缓存
-        self.cache_client.flush_all()
+        # 系统配置影响所有页面，有改动时才清空缓存
+        if changed:
+            self.cache_client.flush_all()
         self.redirect(self.reverse_url("admin:sys-config"))
 
 
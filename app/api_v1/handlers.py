@@ -3,7 +3,12 @@
 import json
 
 from ..models import User, Post, Category, Tag, Image, Comment
-from ..base.handlers import BaseHandler, ListAPIMixin, DetailAPIMixin
+from ..models.base import engine_pool_stats
+from ..models.stats import stats_recorder
+from ..models.rate_limit import RateLimiter, login_limiter
+from ..models.sys_config import SysConfig
+from ..base.handlers import (BaseHandler, ListAPIMixin, DetailAPIMixin,
+                             CommentScopeMixin)
 from .forms import (UserCreateForm, UserUpdateForm, CategoryForm,
                     PostCreateForm, PostUpdateForm, TagForm,
                     ImageCreateForm, CommentCreateForm, CommentUpdateForm,
@@ -11,7 +16,8 @@ from .forms import (UserCreateForm, UserUpdateForm, CategoryForm,
 
 __all__ = ['UserListHandler', 'UserDetailHandler', 'CategoryListHandler',
            'CategoryDetailHandler', 'TagListHandler', 'TagDetailHandler',
-           'SessionIDHandler']
+           'SessionIDHandler', 'MetricsHandler', 'SearchHandler',
+           'PostCommentHandler']
 # TODO: 加入一些权限的验证
 
 
@@ -43,6 +49,7 @@ class CategoryDetailHandler(DetailAPIMixin, BaseHandler):
 
 class PostListHandler(ListAPIMixin, BaseHandler):
     model = Post
+    paginate_keys = (Post.id,)
     post_form = PostCreateForm
     unique_field = 'title'
 
@@ -53,8 +60,57 @@ class PostDetailHandler(DetailAPIMixin, BaseHandler):
     unique_field = 'title'
 
 
+class SearchHandler(BaseHandler):
+    """文章的全文搜索API，参数: q(关键词), page(页码)"""
+
+    def get(self, *args, **kwargs):
+        keyword = self.get_query_argument('q', '').strip()
+        if not keyword:
+            return self.write_error(400)
+        data = self.handle_search_list(
+            keyword,
+            page_num=self.get_query_argument('page', 1),
+            per_page=SysConfig.get(**SysConfig.per_page),
+            profile='api_list',
+            to_json=True
+        )
+        self.write(data)
+
+
+class PostCommentHandler(CommentScopeMixin, BaseHandler):
+    """文章的评论(文章详情页的"加载更多")
+
+    参数: cursor(上一页返回的`next_cursor`)，
+    per_page(每页的评论数量，不超过`comment_per_page`)
+
+    评论按楼层排序并组装为回复树，匿名用户只能看到开启的评论
+    """
+
+    def get(self, *args, **kwargs):
+        post_id = int(kwargs['id'])
+        published = Post.get_published_post(self.db).filter(
+            Post.id == post_id
+        ).with_entities(Post.id).first()
+        if published is None:
+            return self.write_error(404)
+        try:
+            per_page = int(self.get_query_argument('per_page',
+                                                   self.comment_per_page))
+        except ValueError:
+            return self.write_error(400)
+        data = self.handle_comment_page(
+            post_id, cursor=self.get_query_argument('cursor', None),
+            per_page=max(min(per_page, self.comment_per_page), 1),
+            to_json=True
+        )
+        # 新的评论会清除这篇文章的页面缓存
+        self.add_cache_tags('post:{0}'.format(post_id))
+        self.write(data)
+
+
 class CommentListHandler(ListAPIMixin, BaseHandler):
     model = Comment
+    paginate_keys = (Comment.id,)
     post_form = CommentCreateForm
 
 
@@ -102,8 +158,13 @@ class SessionIDHandler(BaseHandler):
         })
 
     def post(self, *args, **kwargs):
-        """需要用户登录来下发一个新的session_id"""
-        # TODO: 加入一些登录次数限制的功能
+        """需要用户登录来下发一个新的session_id
+
+        每个IP登录失败的次数受到`login_limiter`限制，登录成功时清空
+        """
+        remote_ip = self.request.remote_ip
+        if not login_limiter.peek(remote_ip).allowed:
+            return self.write_error(429)
         try:
             json_data = json.loads(self.request.body)
         except json.JSONDecodeError:
@@ -116,6 +177,7 @@ class SessionIDHandler(BaseHandler):
             return self.write(error_msg)
 
         if User.exists(form.email.data, self.db) is False:
+            login_limiter.hit(remote_ip)
             error_msg = {
                 'error': 2,
                 'msg': 'email or password error'    # 错误信息不能明确对方该邮箱不存在
@@ -126,6 +188,7 @@ class SessionIDHandler(BaseHandler):
             User.email == form.email.data
         ).one()
         if user_obj.verify_password(form.password.data) is False:
+            login_limiter.hit(remote_ip)
             error_msg = {
                 'error': 2,
                 'msg': 'email or password error'
@@ -133,6 +196,7 @@ class SessionIDHandler(BaseHandler):
             return self.write(error_msg)
 
         # session_id创建成功
+        login_limiter.reset(remote_ip)
         self.session.user_id = user_obj.id
         self.set_status(201)
         self.write({"error": 0})
@@ -147,4 +211,28 @@ class SessionIDHandler(BaseHandler):
         if not self.current_user:
             return self.write_error(401)
         self.session.logout()
-        self.set_status(204)
\ No newline at end of file
+        self.set_status(204)
+
+
+class MetricsHandler(BaseHandler):
+    """运行时的监控数据(当前worker进程)，只允许超级用户访问"""
+
+    def get(self, *args, **kwargs):
+        if not self.current_user:
+            return self.write_error(401)
+        if not self.current_user.is_superuser:
+            return self.write_error(403)
+        data = {
+            'db_pool': engine_pool_stats(),
+            'stats_recorder': stats_recorder.stats(),
+            'rate_limit': RateLimiter.all_stats(),
+        }
+        if self.middleware_chain is not None:
+            data['middlewares'] = self.middleware_chain.stats()
+        try:
+            cache_stats = getattr(self.cache_client, 'stats', None)
+        except KeyError:
+            cache_stats = None
+        if cache_stats is not None:
+            data['cache'] = cache_stats()
+        self.write(data)
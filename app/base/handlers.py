@@ -3,19 +3,20 @@
 """基础Handler模块
 包括Handler基类`BaseHandler`的定义，以及首页handler等通用页面的handler定义
 """
+import math
 import json
 
-from tornado import web
+from tornado import web, gen
 from tornado.concurrent import futures
 
-from sqlalchemy import create_engine
-
-from ..libs.paginator import Paginator
+from ..libs.markup import render_markdown
+from ..libs.paginator import Paginator, KeysetPaginator, InvalidCursor
 from ..libs.utils import import_object
-from ..middlewares import MiddlewareProcess
 from ..models import Session as DBSession
-from ..models import User
-from ..models.base import redis_cli
+from ..models import User, Comment
+from ..models.base import redis_cli, get_engine
+from ..models.search import PostSearchIndex
+from ..models.rate_limit import api_write_limiter
 from ..models.sys_config import SysConfig
 from ..session import Session
 
@@ -29,6 +30,18 @@ class BaseHandler(web.RequestHandler):
     _redis_cli = None
     _session = None
     _cache_client = None
+    _cache_tags = None
+    # 设置以后列表使用keyset分页(游标分页)，比如`(Post.publish_time, Post.id)`
+    paginate_keys = None
+    paginate_with_count = True      # keyset分页时是否返回(缓存的)总数
+    paginate_count_expire = 60
+    # 列表的筛选参数，keyset分页缓存的总数按这些参数区分(其它参数不影响总数)
+    paginate_filter_args = ()
+    # 没有`page`参数时是否默认使用keyset分页，否则只在有`cursor`参数时使用
+    paginate_cursor_default = False
+    comment_per_page = 20           # 文章详情页每次加载的评论数量
+    # API中受到频率限制(`api_write_limiter`)的写操作
+    write_methods = ('POST', 'PUT', 'PATCH', 'DELETE')
     thread_pool = thread_pool
     process_pool = process_pool
 
@@ -43,22 +56,45 @@ class BaseHandler(web.RequestHandler):
                 raise KeyError("Not provide cache middleware")
         return self._cache_client
 
+    def add_cache_tags(self, *tags):
+        """声明当前页面依赖的数据标签，比如`post:1`, `sidebar`
+
+        缓存中间件会把页面缓存和这些标签关联起来，
+        数据改动时只清除依赖它的页面缓存(参考`app.cache.CacheInvalidator`)
+        """
+        if self._cache_tags is None:
+            self._cache_tags = set()
+        self._cache_tags.update(tags)
+
     @property
     def session(self):
+        """session对象
+
+        可以在配置中通过`SESSION_BACKEND`选择session的实现，默认使用
+        Redis存储的`app.session.Session`，也可以使用无状态的
+        `app.session.CookieSession`
+        """
         if self._session is None:
-            self._session = Session(self)
+            backend = getattr(self.config, 'SESSION_BACKEND', None)
+            session_cls = import_object(backend) if backend else Session
+            self._session = session_cls(self)
         return self._session
 
     @property
     def db(self):
         if self._db is None:
-            self._db = DBSession(bind=create_engine(
-                self.config.SQLALCHEMY_URI,
-                pool_size=self.config.SQLALCHEMY_POOL_SIZE,
-                pool_recycle=self.config.SQLALCHEMY_POOL_RECYCLE,
-            ))
+            self._db = DBSession(bind=self.engine)
         return self._db
 
+    @property
+    def engine(self):
+        """进程内共享的engine，不要在每个请求中新建engine(连接池)"""
+        return get_engine(
+            self.config.SQLALCHEMY_URI,
+            pool_size=self.config.SQLALCHEMY_POOL_SIZE,
+            pool_recycle=self.config.SQLALCHEMY_POOL_RECYCLE,
+        )
+
     @property
     def redis_cli(self):
         if self._redis_cli is None:
@@ -80,18 +116,31 @@ class BaseHandler(web.RequestHandler):
         self.set_status(status_code)
         super().write_error(status_code, **kwargs)
 
+    @property
+    def middleware_chain(self):
+        return getattr(self.application, 'middleware_chain', None)
+
     def prepare(self):
         # web中间件的prepare处理
-        self._middleware_list = self.config.MIDDLEWARES
-        MiddlewareProcess.prepare(self, self._middleware_list)
+        if self.middleware_chain is not None:
+            self.middleware_chain.prepare(self)
+
+    def finish(self, chunk=None):
+        # 在响应发送之前写回session的缓冲数据，
+        # 保证客户端拿到响应以后立即发起的下一个请求能读取到最新的session
+        if self._session is not None:
+            try:
+                self._session.save()
+            except Exception:
+                self.application.logger.error(
+                    "session save error", exc_info=True
+                )
+        return super().finish(chunk)
 
     def on_finish(self):
         # web中间件的on_finish处理
-        try:
-            MiddlewareProcess.on_finish(self, self._middleware_list)
-        except AttributeError:
-            # 有可能没有设定middleware_list
-            pass
+        if self.middleware_chain is not None:
+            self.middleware_chain.on_finish(self)
         # clean工作
         if self._db:
             try:
@@ -110,7 +159,20 @@ class BaseHandler(web.RequestHandler):
 
     def handle_object_list(self, object_list, page_num,
                            per_page, to_json=False):
-        """根据参数来筛选对象列表，默认进行分页"""
+        """根据参数来筛选对象列表，默认进行分页
+
+        设置了`paginate_keys`的handler在有`cursor`参数(第一页为空字符串)时
+        使用keyset分页，参考`handle_object_cursor_list()`；
+        `paginate_cursor_default`为True时，没有`page`参数也使用keyset分页
+        """
+        use_cursor = (
+            self.get_query_argument('cursor', None) is not None or
+            (self.paginate_cursor_default and
+             self.get_query_argument('page', None) is None)
+        )
+        if self.paginate_keys and use_cursor:
+            return self.handle_object_cursor_list(object_list, per_page,
+                                                  to_json)
         paginator = Paginator(object_list, per_page)
         page = paginator.page(page_num)
         if to_json:
@@ -125,7 +187,135 @@ class BaseHandler(web.RequestHandler):
             "has_next": page.has_next(),
             "current_page": int(page_num)
         }
-    
+
+    def paginate_count_key(self):
+        """keyset分页缓存总数的键: 同一个路径和筛选参数共用一个总数
+
+        只使用`paginate_filter_args`中的参数，避免任意的查询参数生成新的键
+        """
+        filters = [(name, self.get_query_argument(name, None))
+                   for name in self.paginate_filter_args]
+        return "_count:{0}:{1}".format(self.request.path, filters)
+
+    def handle_object_cursor_list(self, object_list, per_page, to_json=False):
+        """使用keyset分页筛选对象列表
+
+        通过查询参数`cursor`翻页，不再使用`OFFSET`，翻到很深的页也不会变慢.
+        返回值和`handle_object_list()`兼容(`has_prev`/`has_next`...)，
+        另外加入了`prev_cursor`/`next_cursor`，`current_page`为None，
+        `count`是缓存的估计值(`paginate_with_count`为False时为None)
+        """
+        paginator = KeysetPaginator(
+            object_list, per_page, self.paginate_keys,
+            count_key=(self.paginate_count_key()
+                       if self.paginate_with_count else None),
+            count_expire=self.paginate_count_expire,
+            cache=self.redis_cli
+        )
+        try:
+            page = paginator.page(self.get_query_argument('cursor', None))
+        except InvalidCursor:
+            raise web.HTTPError(400)
+        if to_json:
+            object_list = [obj.to_list_json() for obj in page.object_list]
+        else:
+            object_list = page.object_list
+        return {
+            "object_list": object_list,
+            "count": paginator.count,
+            "total_pages": paginator.total_pages,
+            "has_prev": page.has_previous(),
+            "has_next": page.has_next(),
+            "current_page": None,
+            "prev_cursor": page.previous_cursor,
+            "next_cursor": page.next_cursor
+        }
+
+    def handle_search_list(self, keyword, page_num, per_page, profile=None,
+                           to_json=False):
+        """全文搜索文章并分页，返回值和`handle_object_list()`一致
+
+        搜索结果按相关度排序并缓存在Redis中，所以这里使用页码分页
+        """
+        try:
+            page_num = max(int(page_num), 1)
+        except (TypeError, ValueError):
+            raise web.HTTPError(400)
+        count, object_list = PostSearchIndex.search_posts(
+            self.db, keyword, offset=(page_num - 1) * per_page,
+            limit=per_page, profile=profile
+        )
+        if to_json:
+            object_list = [obj.to_list_json() for obj in object_list]
+        total_pages = (count + per_page - 1) // per_page
+        return {
+            "object_list": object_list,
+            "count": count,
+            "total_pages": total_pages,
+            "has_prev": page_num > 1,
+            "has_next": page_num < total_pages,
+            "current_page": page_num
+        }
+
+    def comment_approved_only(self):
+        """匿名用户(和非管理员)只能看到开启的评论"""
+        return not (self.current_user and self.current_user.is_superuser)
+
+    def page_cache_scope(self):
+        """同一个地址对不同的用户返回不同的内容时，返回区分它们的字符串
+
+        缓存中间件把它加入页面缓存的键，默认为None(所有用户共用一份缓存)
+        """
+        return None
+
+    def handle_comment_page(self, post_id, cursor=None, per_page=None,
+                            to_json=False):
+        """按楼层分页读取文章的评论，并组装为回复树
+
+        匿名用户(和非管理员)只能看到开启的评论，显示评论的页面需要在
+        `page_cache_scope()`中区分(参考`CommentScopeMixin`);
+        下一页通过`next_cursor`读取，参考`KeysetPaginator`
+
+        :param per_page: 每页的评论数量，默认为`comment_per_page`
+        :return: `{"object_list": ..., "has_next": bool, "next_cursor": str}`，
+            `to_json`为True时`object_list`为嵌套的字典，
+            否则为`Comment.walk_threads()`的结果
+        """
+        paginator = KeysetPaginator(
+            Comment.get_thread_query(self.db, post_id,
+                                     self.comment_approved_only()),
+            per_page or self.comment_per_page, (Comment.floor, Comment.id),
+            descending=False
+        )
+        try:
+            page = paginator.page(cursor)
+        except InvalidCursor:
+            raise web.HTTPError(400)
+        threads = Comment.build_threads(page.object_list)
+        return {
+            "object_list": (Comment.threads_to_json(threads) if to_json
+                            else Comment.walk_threads(threads)),
+            "has_next": page.has_next(),
+            "next_cursor": page.next_cursor
+        }
+
+    @gen.coroutine
+    def render_post_content(self, post_obj):
+        """渲染文章的markdown并保存渲染结果(渲染结果没有过期时什么都不做)
+
+        内容超过`MARKDOWN_PROCESS_THRESHOLD`个字符的文章在进程池中渲染，
+        避免阻塞IOLoop
+        """
+        if not post_obj.content_is_stale():
+            return
+        content = post_obj.content or ''
+        threshold = getattr(self.config, 'MARKDOWN_PROCESS_THRESHOLD', 20000)
+        if len(content) < threshold:
+            post_obj.render_content()
+            return
+        html, toc = yield self.process_pool.submit(render_markdown, content)
+        post_obj.set_rendered_content(html, toc, source=content)
+
     def render(self, template_name, **kwargs):
         """根据系统配置:template_version来选择模版"""
         if not template_name.startswith('admin'):
@@ -137,6 +327,32 @@ class BaseHandler(web.RequestHandler):
     def json_body(self):
         return json.loads(self.request.body)
 
+    def check_rate_limit(self, limiter, identity, cost=1, limit=None):
+        """通过频率限制器`limiter`检查`identity`(比如IP，用户id)
+
+        超过限制时返回429(带`Retry-After`响应头)
+
+        :return: bool，是否受到限制(已经返回了响应)
+        """
+        result = limiter.hit(identity, cost=cost, limit=limit)
+        self.set_header('X-RateLimit-Limit', limit or limiter.limit)
+        self.set_header('X-RateLimit-Remaining', result.remaining)
+        if result.allowed:
+            return False
+        if result.retry_after > 0:
+            self.set_header('Retry-After', math.ceil(result.retry_after))
+        self.write_error(429)
+        return True
+
+
+class CommentScopeMixin(object):
+    """显示文章评论的页面: 管理员可以看到关闭的评论，使用单独的页面缓存"""
+
+    def page_cache_scope(self):
+        if self.comment_approved_only():
+            return None
+        return 'all-comments'
+
 
 class ListAPIMixin(object):
     """列表API接口的mixin"""
@@ -150,12 +366,17 @@ class ListAPIMixin(object):
         if not self.current_user:
             return self.write_error(401)
         super().prepare()
+        if self.request.method in self.write_methods and \
+                self.check_rate_limit(api_write_limiter, self.current_user.id):
+            return
         self._page = int(self.get_query_argument('page', 1))
 
     def get(self, *args, **kwargs):
         """获取对象列表"""
         if not self.object_list:
-            self.object_list = self.model.get_object_list(self.db)
+            self.object_list = self.model.get_object_list(
+                self.db, profile='api_list'
+            )
         data = self.handle_object_list(self.object_list,
                                        self._page,
                                        SysConfig.get(**SysConfig.per_page),
@@ -208,6 +429,8 @@ class DetailAPIMixin(object):
         if not self.current_user:
             return self.write_error(401)
         super().prepare()
+        if self.request.method in self.write_methods:
+            self.check_rate_limit(api_write_limiter, self.current_user.id)
 
     def get(self, *args, **kwargs):
         """获取对象详情"""
@@ -1,19 +1,91 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 """博客页面的handlers"""
-from tornado import web
+from datetime import datetime
+from collections import namedtuple
 
-from sqlalchemy import func
+from tornado import web, gen
 
-from ..base.handlers import BaseHandler
-from ..models.post import Post, Category, PostTag, Tag, Comment
+from sqlalchemy import false
+
+from ..base.handlers import BaseHandler, CommentScopeMixin
+from ..cache import FragmentCache
+from ..models.post import (Post, Category, PostTag, Tag, Comment,
+                           PostSlugMap, PostRelation)
 from ..models.sys_config import SysConfig
 from ..models.stats import SiteStats
 from .forms import CommentForm
 
+SidebarItem = namedtuple('SidebarItem', ['id', 'name'])
+
+
+class SidebarMixin(object):
+    """博客侧边栏(标签，分类，归档，统计信息)
+
+    侧边栏的数据很少改动，使用片段缓存保存:
+
+    - 标签/分类/归档数据以普通tuple的形式缓存，文章/标签/分类改动时清除
+    - 统计信息(PV/UV/计数器)每次一个pipeline从Redis读取，
+      渲染好的侧边栏HTML只缓存`base_stats_expire`秒
+    - 模版可以通过`{% raw handler.render_sidebar() %}`直接使用渲染好的HTML
+    """
+    sidebar_expire = 60 * 60 * 24
+    base_stats_expire = 60
+    sidebar_template = 'sidebar.html'
+
+    def _create_sidebar_data(self):
+        tags = Tag.get_object_list(self.db, have_post=True)
+        categories = Category.get_object_list(self.db)
+        return {
+            # 关联多篇文章的标签会重复出现，去重并保持顺序
+            'tag_data': tuple({(tag.id, tag.name): None
+                               for tag in tags}),
+            'category_data': tuple((category.id, category.name)
+                                   for category in categories),
+            'archive_info': tuple((month.year, month.month, count)
+                                  for month, count
+                                  in Post.get_archive_month(self.db)),
+        }
+
+    def _cached_sidebar_data(self):
+        return FragmentCache.get_data(
+            'sidebar', self._create_sidebar_data,
+            expire=self.sidebar_expire, tags=['sidebar', 'archive']
+        )
+
+    def sidebar_tag_data(self):
+        """侧边栏的标签，不读取统计信息(只需要标签的模版使用)"""
+        return [SidebarItem(*item)
+                for item in self._cached_sidebar_data()['tag_data']]
+
+    def sidebar_data(self):
+        """侧边栏的模版变量: tag_data, category_data, archive_info, base_stats"""
+        data = self._cached_sidebar_data()
+        return {
+            'tag_data': [SidebarItem(*item) for item in data['tag_data']],
+            'category_data': [SidebarItem(*item)
+                              for item in data['category_data']],
+            'archive_info': [(datetime(year, month, 1), count)
+                             for year, month, count in data['archive_info']],
+            'base_stats': SiteStats.get_base_info(self.db),
+        }
+
+    def render_sidebar(self):
+        """渲染好的侧边栏HTML，和统计信息的缓存时间一致"""
+        template_version = SysConfig.get(**SysConfig.template_version)
+        template_name = template_version + '/' + self.sidebar_template
+        return FragmentCache.get_html(
+            'sidebar:' + template_version,
+            lambda: self.render_string(template_name, **self.sidebar_data()),
+            expire=self.base_stats_expire, tags=['sidebar', 'archive']
+        )
+
 
-class HomepageHandler(BaseHandler):
+class HomepageHandler(SidebarMixin, BaseHandler):
     """首页"""
+    paginate_keys = (Post.publish_time, Post.id)
+    paginate_filter_args = ('tag', 'category', 'archive-date')
+    paginate_cursor_default = True
 
     def prepare(self):
         super(HomepageHandler, self).prepare()
@@ -34,9 +106,16 @@ class HomepageHandler(BaseHandler):
                 category_id=self._category_id
             )
         if self._archive_month:
-            object_list = object_list.filter(
-                func.DATE_FORMAT(Post.publish_time, "%Y%m") == self._archive_month
-            )
+            # 使用范围查询，可以利用`publish_time`上的索引
+            try:
+                start, end = Post.month_range(self._archive_month)
+            except ValueError:
+                object_list = object_list.filter(false())
+            else:
+                object_list = object_list.filter(
+                    Post.publish_time >= start,
+                    Post.publish_time < end
+                )
         return super(HomepageHandler, self).handle_object_list(
             object_list, page_num, per_page, to_json
         )
@@ -46,135 +125,162 @@ class HomepageHandler(BaseHandler):
 
         context变量介绍:
 
-        :param archive_info(list):
-
-            归档信息: (月份，该月发布的文章数量)，倒序排列(最近的日期在前)
-
-        :param tag_data(ResultList):
-
-            标签数据：标签对象列表
-
         :param post_data(dict):
 
             博客文章信息: 字典。包含已分页的文章对象列表，以及分页相关信息，倒序排列
 
-        :param category_data(ResultList):
-
-            分类信息: 所有创建的文章分类对象列表
-
-        :param base_stats: dict
-
-            网站基础的统计信息
+        侧边栏的变量(tag_data, category_data, archive_info, base_stats)
+        由模版通过`SidebarMixin`获取，参考`SidebarMixin.sidebar_data()`
         """
-        _post_obj_list = Post.get_published_post(self.db)
+        _post_obj_list = Post.get_published_post(self.db, profile='list')
         post_data = self.handle_object_list(
             _post_obj_list,
             page_num=self._page_num,
             per_page=SysConfig.get(**SysConfig.blog_per_page),
         )
-        tag_data = Tag.get_object_list(self.db, have_post=True)
-        category_data = Category.get_object_list(self.db)
-        archive_info = Post.get_archive_month(self.db)
-        base_stats = SiteStats.get_base_info(self.db)
+        self.add_cache_tags('post-list', 'archive', 'sidebar')
         self.render(
             "homepage.html",
             post_data=post_data,
-            category_data=category_data,
-            archive_info=archive_info,
-            tag_data=tag_data,
-            code_skin=SysConfig.get(**SysConfig.template_code_skin),
-            base_stats=base_stats
+            code_skin=SysConfig.get(**SysConfig.template_code_skin)
         )
 
 
-class PostHandler(BaseHandler):
+class SearchHandler(SidebarMixin, BaseHandler):
+    """全文搜索"""
+
+    def get(self, *args, **kwargs):
+        """
+
+        context变量介绍:
+
+        :param keyword: 搜索的关键词(查询参数`q`)
+        :param post_data(dict):
+
+            搜索结果: 按相关度排序的文章列表，以及分页相关信息，
+            参考`BaseHandler.handle_search_list()`
+        """
+        keyword = self.get_query_argument('q', '').strip()
+        post_data = self.handle_search_list(
+            keyword,
+            page_num=self.get_query_argument('page', 1),
+            per_page=SysConfig.get(**SysConfig.blog_per_page),
+            profile='list'
+        )
+        self.add_cache_tags('post-list', 'sidebar')
+        self.render(
+            "search.html",
+            keyword=keyword,
+            post_data=post_data,
+            code_skin=SysConfig.get(**SysConfig.template_code_skin)
+        )
+
+
+class PostHandler(CommentScopeMixin, SidebarMixin, BaseHandler):
     """文章详情"""
     
     def prepare(self):
-        # 统计文章的点击量
-        SiteStats.incr_post_view(self.path_kwargs['slug'])
         super(PostHandler, self).prepare()
+        # 统计文章的点击量(页面缓存命中时不会执行get()，所以在这里统计);
+        # 缓存中间件在后台刷新缓存的请求不是访问者的点击
+        if getattr(self, '_cache_revalidation', False):
+            return
+        post_id = PostSlugMap.get_id(self.db, self.path_kwargs['slug'])
+        if post_id is not None:
+            SiteStats.incr_post_view(post_id)
+
+    def redirect_to_canonical(self, post_obj, kwargs):
+        """旧的slug或者日期不符时，永久重定向到文章当前的地址"""
+        publish_time = post_obj.publish_time
+        if publish_time is None:
+            return False
+        date = (int(kwargs['year']), int(kwargs['month']), int(kwargs['day']))
+        if post_obj.slug == kwargs['slug'] and date == (
+                publish_time.year, publish_time.month, publish_time.day):
+            return False
+        url = self.reverse_url("post", publish_time.year, publish_time.month,
+                               publish_time.day, post_obj.slug)
+        if self.request.query:
+            url += "?" + self.request.query
+        self.redirect(url, permanent=True)
+        return True
+
+    @staticmethod
+    def relation_posts(relation):
+        """`PostRelation.get()`结果中的所有文章"""
+        posts = list(relation['related'])
+        posts.extend(relation[name] for name in
+                     ('prev', 'next', 'series_prev', 'series_next')
+                     if relation[name] is not None)
+        return posts
 
+    def render_post(self, post_obj, comment_form, errors=None,
+                    relation=None):
+        """渲染文章详情页，评论只读取第一页，之后的评论通过API"加载更多"
+        """
+        if relation is None:
+            relation = PostRelation.get(self.db, post_obj.id)
+        self.render(
+            "post.html",
+            post_obj=post_obj,
+            relation=relation,
+            comment_data=self.handle_comment_page(post_obj.id),
+            comment_form=comment_form,
+            errors=errors,
+            code_skin=SysConfig.get(**SysConfig.template_code_skin)
+        )
+
+    @gen.coroutine
     def get(self, *args, **kwargs):
         slug = kwargs.get('slug', None)
         if not slug:
             return self.write_error(404)
-        post_obj = Post.get_object_by_slug(self.db, slug)
+        post_obj = PostSlugMap.get_post(self.db, slug, profile='detail')
         if not post_obj:
             return self.write_error(404)
+        if self.redirect_to_canonical(post_obj, kwargs):
+            return
 
-        tag_data = Tag.get_object_list(self.db, have_post=True)
-        category_data = Category.get_object_list(self.db)
-        archive_info = Post.get_archive_month(self.db)
-        base_stats = SiteStats.get_base_info(self.db)
+        # 渲染结果过期时(比如旧数据)重新渲染，随请求结束保存到数据库
+        yield self.render_post_content(post_obj)
         form = CommentForm()
-        self.render(
-            "post.html",
-            post_obj=post_obj,
-            tag_data=tag_data,
-            category_data=category_data,
-            archive_info=archive_info,
-            comment_form=form,
-            errors=None,
-            code_skin=SysConfig.get(**SysConfig.template_code_skin),
-            base_stats=base_stats
-        )
+        # 文章详情页的归档信息不随新文章发布而清除缓存，由缓存过期时间来更新
+        self.add_cache_tags('post:{0}'.format(post_obj.id), 'sidebar')
+        if post_obj.category_id:
+            self.add_cache_tags('category:{0}'.format(post_obj.category_id))
+        self.add_cache_tags(*['tag:{0}'.format(tag.id)
+                              for tag in post_obj.tags])
+        relation = PostRelation.get(self.db, post_obj.id)
+        self.add_cache_tags(*['post:{0}'.format(obj.id)
+                              for obj in self.relation_posts(relation)])
+        self.render_post(post_obj, form, relation=relation)
 
     def post(self, *args, **kwargs):
         slug = kwargs.get('slug', None)
         if not slug:
             return self.write_error(404)
-        post_obj = Post.get_object_by_slug(self.db, slug)
+        # 发表评论成功时只需要文章本身，不需要加载正文和评论
+        post_obj = PostSlugMap.get_post(self.db, slug)
         if not post_obj:
             return self.write_error(404)
 
         # 验证表单
         form = CommentForm(self.request.arguments)
         if not form.validate():
-            tag_data = Tag.get_object_list(self.db, have_post=True)
-            category_data = Category.get_object_list(self.db)
-            archive_info = Post.get_archive_month(self.db)
-            base_stats = SiteStats.get_base_info(self.db)
-            return self.render(
-                "post.html",
-                post_obj=post_obj,
-                tag_data=tag_data,
-                category_data=category_data,
-                archive_info=archive_info,
-                comment_form=form,
-                errors=None,
-                code_skin=SysConfig.get(**SysConfig.template_code_skin),
-                base_stats=base_stats
-            )
+            return self.render_post(post_obj, form)
 
         # 判断该IP是否收到评论限制
         if Comment.comment_restricted(self.request.remote_ip) is True:
             errors='您的IP受到评论限制，请联系管理员'
-            tag_data = Tag.get_object_list(self.db, have_post=True)
-            category_data = Category.get_object_list(self.db)
-            archive_info = Post.get_archive_month(self.db)
-            base_stats = SiteStats.get_base_info(self.db)
-            return self.render(
-                "post.html",
-                post_obj=post_obj,
-                tag_data=tag_data,
-                category_data=category_data,
-                archive_info=archive_info,
-                comment_form=form,
-                errors=errors,
-                code_skin=SysConfig.get(**SysConfig.template_code_skin),
-                base_stats=base_stats
-            )
+            return self.render_post(post_obj, form, errors)
 
-        # 创建评论
-        floor = len(post_obj.comment_set) + 1
+        # 创建评论(楼层在插入时根据文章的评论数量分配)
         Comment.create(
             self.db,
             email=form.email.data,
             title=form.title.data,
             content=form.content.data,
             remote_ip=self.request.remote_ip,
-            floor=floor,
             post_id=post_obj.id
         )
 
@@ -3,7 +3,21 @@
 
 使用redis|memcache|...实现web应用的缓存组件
 """
-from .models.base import redis_cli
+import os
+import sys
+import time
+import marshal
+import uuid
+import threading
+from collections import OrderedDict
+
+from redis import WatchError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+from tornado.log import gen_log
+
+from .models.base import redis_binary_cli, Session
+from .models.post import Post, Comment, Tag, Category
 
 
 class BaseCache(object):
@@ -17,8 +31,12 @@ class BaseCache(object):
         raise NotImplemented
 
     @classmethod
-    def set(cls, key, value, expire=None):
-        """设置缓存资源"""
+    def set(cls, key, value, expire=None, tags=None):
+        """设置缓存资源
+
+        :param tags: 缓存资源依赖的数据标签，比如`post:1`, `sidebar`，
+            通过`invalidate_tags()`可以清除依赖这些标签的缓存资源
+        """
         raise NotImplemented
 
     @classmethod
@@ -35,6 +53,11 @@ class BaseCache(object):
         """设置缓存过期时间"""
         raise NotImplemented
 
+    @classmethod
+    def invalidate_tags(cls, *tags):
+        """清除依赖这些标签的缓存资源"""
+        raise NotImplemented
+
     @classmethod
     def flush_all(cls):
         """刷新所有缓存"""
@@ -42,8 +65,38 @@ class BaseCache(object):
 
 
 class RedisCache(BaseCache):
-    """Redis实现的缓存组件"""
-    client = redis_cli
+    """Redis实现的缓存组件，缓存值是二进制数据(bytes)
+
+    每个标签对应一个Redis有序集合(`cache:tags:<标签>`)，保存依赖它的缓存键，
+    score为缓存键的过期时间. 每次写入时清除已经过期的成员，
+    所以集合只包含仍然有效的缓存键，不会因为不同的查询字符串无限增长.
+    集合的过期时间只会延长到最晚过期的成员，有成员不过期时集合也不过期.
+    """
+    client = redis_binary_cli
+    scan_count = 500                    # `flush_all()`每批扫描/删除的键数量
+    flush_skip = ('lock:',)             # 缓存中间件的渲染锁，不需要清除
+
+    # KEYS: [标签集合], ARGV: [当前时间, 过期时间(或'+inf'), 缓存键, 有效期(秒，0为不过期)]
+    add_tag_script = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    local existed = redis.call('EXISTS', KEYS[1])
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+    local ttl = tonumber(ARGV[4])
+    if ttl == 0 then
+        redis.call('PERSIST', KEYS[1])
+        return 1
+    end
+    local current = redis.call('TTL', KEYS[1])
+    if existed == 0 or (current ~= -1 and current < ttl) then
+        redis.call('EXPIRE', KEYS[1], ttl)
+    end
+    return 1
+    """
+    _add_tag = None
+
+    @classmethod
+    def _tag_key(cls, tag):
+        return "{0}:tags:{1}".format(cls.key, tag)
 
     @classmethod
     def get(cls, key, default=None):
@@ -54,11 +107,25 @@ class RedisCache(BaseCache):
         return value
 
     @classmethod
-    def set(cls, key, value, expire=None):
+    def set(cls, key, value, expire=None, tags=None):
         cache_key = "{0}:{1}".format(cls.key, key)
-        cls.client.set(cache_key, value)
-        if expire:
-            cls.expire(key, expire)
+        if not tags:
+            cls.client.set(cache_key, value, ex=expire or None)
+            return
+        # 缓存值和标签在同一个事务中写入，不会漏掉并发的`invalidate_tags()`
+        now = time.time()
+        expire_at = now + expire if expire else '+inf'
+        if RedisCache._add_tag is None:
+            RedisCache._add_tag = cls.client.register_script(
+                cls.add_tag_script
+            )
+        pipe = cls.client.pipeline()
+        pipe.set(cache_key, value, ex=expire or None)
+        for tag in tags:
+            cls._add_tag(keys=[cls._tag_key(tag)],
+                         args=[now, expire_at, key, int(expire or 0)],
+                         client=pipe)
+        pipe.execute()
 
     @classmethod
     def delete(cls, key):
@@ -75,10 +142,358 @@ class RedisCache(BaseCache):
         cache_key = "{0}:{1}".format(cls.key, key)
         cls.client.expire(cache_key, seconds)
 
+    @classmethod
+    def invalidate_tags(cls, *tags):
+        """清除依赖这些标签的缓存，返回被清除的缓存键列表
+
+        读取标签集合以后在一个`MULTI`事务中删除缓存键和标签集合，
+        `WATCH`标签集合，期间有新的缓存写入时重试
+        """
+        if not tags:
+            return []
+        tag_keys = [cls._tag_key(tag) for tag in tags]
+        prefix = "{0}:".format(cls.key).encode()
+        with cls.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*tag_keys)
+                    keys = set()
+                    for tag_key in tag_keys:
+                        keys.update(pipe.zrange(tag_key, 0, -1))
+                    pipe.multi()
+                    if keys:
+                        pipe.delete(*[prefix + key for key in keys])
+                    pipe.delete(*tag_keys)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        return sorted(key.decode() for key in keys)
+
     @classmethod
     def flush_all(cls):
-        keys = cls.client.keys("http*")
-        if keys:
-            cls.client.delete(*keys)
+        """使用`SCAN`分批删除所有缓存，不会像`KEYS`一样阻塞Redis"""
+        prefix = "{0}:".format(cls.key)
+        skip = tuple((prefix + name).encode() for name in cls.flush_skip)
+        batch = []
+        for cache_key in cls.client.scan_iter(match=prefix + "*",
+                                              count=cls.scan_count):
+            if cache_key.startswith(skip):
+                continue
+            batch.append(cache_key)
+            if len(batch) >= cls.scan_count:
+                cls.client.delete(*batch)
+                batch = []
+        if batch:
+            cls.client.delete(*batch)
+
+
+class TieredCache(RedisCache):
+    """两级缓存组件: 进程内的LRU缓存 + Redis缓存
+
+    - 读取时先查找进程内的LRU缓存，没有命中再读取Redis，并回填到LRU缓存中
+    - LRU缓存按照字节数计算容量(`max_bytes`)，每个条目有自己的过期时间，
+      不会超过Redis中的剩余时间，也不会超过`local_max_ttl`
+    - 写入/删除时通过Redis的发布/订阅通知所有worker进程删除本地的旧条目
+
+    使用方法: 在`MIDDLEWARES`中配置`'cache': 'app.cache.TieredCache'`
+    """
+    max_bytes = 64 * 1024 * 1024        # LRU缓存的总容量(字节)
+    max_entry_bytes = 1024 * 1024       # 单个条目超过这个大小就不放入LRU缓存
+    local_max_ttl = 60                  # LRU缓存条目的最长存活时间(秒)
+    channel = '_cache:invalidate'       # 缓存失效通知的频道
+    flush_all_flag = '*'
+
+    _local = OrderedDict()              # {key: (value, expire_at, size)}
+    _local_bytes = 0
+    _lock = threading.RLock()
+    _origin = uuid.uuid4().hex          # 用于忽略本进程自己发出的通知
+    _subscriber = None
+    _subscriber_pid = None
+    _counters = {
+        'local_hits': 0,
+        'local_misses': 0,
+        'local_evictions': 0,
+        'local_expirations': 0,
+        'redis_hits': 0,
+        'redis_misses': 0,
+        'invalidations': 0,
+    }
+
+    @classmethod
+    def _ensure_subscriber(cls):
+        """在当前进程中订阅缓存失效通知(fork以后需要重新订阅)"""
+        pid = os.getpid()
+        if cls._subscriber_pid == pid:
+            return
+        with cls._lock:
+            if cls._subscriber_pid == pid:
+                return
+            cls._subscriber_pid = pid
+            cls._origin = uuid.uuid4().hex
+            cls._local_clear()
+            pubsub = cls.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{cls.channel: cls._on_message})
+            cls._subscriber = pubsub.run_in_thread(sleep_time=1,
+                                                   daemon=True)
+
+    @classmethod
+    def _on_message(cls, message):
+        try:
+            origin, key = message['data'].decode().split(':', 1)
+        except (AttributeError, UnicodeDecodeError, ValueError):
+            return
+        if origin == cls._origin:
+            return
+        cls._count('invalidations')
+        if key == cls.flush_all_flag:
+            cls._local_clear()
+        else:
+            cls._local_delete(key)
 
+    @classmethod
+    def _publish(cls, key):
+        try:
+            cls.client.publish(cls.channel,
+                               "{0}:{1}".format(cls._origin, key))
+        except Exception:
+            gen_log.error('TieredCache publish error', exc_info=True)
+
+    @classmethod
+    def _count(cls, name):
+        with cls._lock:
+            cls._counters[name] += 1
+
+    # 进程内LRU缓存的操作 ----------------------------------------
+
+    @classmethod
+    def _local_get(cls, key):
+        with cls._lock:
+            item = cls._local.get(key)
+            if item is None:
+                return None
+            value, expire_at, size = item
+            if expire_at <= time.time():
+                cls._local_delete(key)
+                cls._count('local_expirations')
+                return None
+            cls._local.move_to_end(key)
+            return value
+
+    @classmethod
+    def _local_set(cls, key, value, ttl):
+        size = sys.getsizeof(value)
+        if size > cls.max_entry_bytes or ttl <= 0:
+            cls._local_delete(key)
+            return
+        with cls._lock:
+            cls._local_delete(key)
+            cls._local[key] = (value, time.time() + ttl, size)
+            cls._local_bytes += size
+            while cls._local_bytes > cls.max_bytes and cls._local:
+                _, (_, _, evicted_size) = cls._local.popitem(last=False)
+                cls._local_bytes -= evicted_size
+                cls._count('local_evictions')
+
+    @classmethod
+    def _local_delete(cls, key):
+        with cls._lock:
+            item = cls._local.pop(key, None)
+            if item is not None:
+                cls._local_bytes -= item[2]
+
+    @classmethod
+    def _local_clear(cls):
+        with cls._lock:
+            cls._local.clear()
+            cls._local_bytes = 0
+
+    # BaseCache API ----------------------------------------------
+
+    @classmethod
+    def get(cls, key, default=None):
+        cls._ensure_subscriber()
+        value = cls._local_get(key)
+        if value is not None:
+            cls._count('local_hits')
+            return value
+        cls._count('local_misses')
 
+        cache_key = "{0}:{1}".format(cls.key, key)
+        pipe = cls.client.pipeline(transaction=False)
+        pipe.get(cache_key)
+        pipe.ttl(cache_key)
+        value, ttl = pipe.execute()
+        if not value:
+            cls._count('redis_misses')
+            return default
+        cls._count('redis_hits')
+        if ttl is None or ttl < 0:
+            ttl = cls.local_max_ttl
+        cls._local_set(key, value, min(ttl, cls.local_max_ttl))
+        return value
+
+    @classmethod
+    def set(cls, key, value, expire=None, tags=None):
+        cls._ensure_subscriber()
+        super().set(key, value, expire, tags)
+        cls._local_set(key, value, min(expire or cls.local_max_ttl,
+                                       cls.local_max_ttl))
+        cls._publish(key)
+
+    @classmethod
+    def delete(cls, key):
+        cls._ensure_subscriber()
+        super().delete(key)
+        cls._local_delete(key)
+        cls._publish(key)
+
+    @classmethod
+    def exists(cls, key):
+        if cls._local_get(key) is not None:
+            return True
+        return super().exists(key)
+
+    @classmethod
+    def expire(cls, key, seconds):
+        super().expire(key, seconds)
+        cls._local_delete(key)
+        cls._publish(key)
+
+    @classmethod
+    def invalidate_tags(cls, *tags):
+        cls._ensure_subscriber()
+        keys = super().invalidate_tags(*tags)
+        for key in keys:
+            cls._local_delete(key)
+            cls._publish(key)
+        return keys
+
+    @classmethod
+    def flush_all(cls):
+        cls._ensure_subscriber()
+        super().flush_all()
+        cls._local_clear()
+        cls._publish(cls.flush_all_flag)
+
+    @classmethod
+    def stats(cls):
+        """返回各级缓存的命中/未命中/淘汰次数"""
+        with cls._lock:
+            return dict(cls._counters, local_entries=len(cls._local),
+                        local_bytes=cls._local_bytes)
+
+
+class FragmentCache(object):
+    """片段缓存: 缓存页面中多个页面共用的部分(比如侧边栏)
+
+    - `get_data()`: 缓存计算好的数据，数据只能由tuple, list, dict, str,
+      int...等普通类型组成，使用`marshal`序列化，紧凑而且解析很快
+    - `get_html()`: 缓存渲染好的HTML片段
+
+    缓存的片段同样可以关联数据标签，由`CacheInvalidator`在数据改动时清除.
+
+    在模版中使用: `{% raw handler.render_sidebar() %}`
+    """
+    cache = RedisCache                  # 在`create_app()`中替换为配置的缓存类
+    key = 'fragment'
+    default_expire = 60 * 10
+
+    @classmethod
+    def _fragment_key(cls, name):
+        return "{0}:{1}".format(cls.key, name)
+
+    @classmethod
+    def get_data(cls, name, creator, expire=None, tags=None):
+        """获取缓存的数据，没有命中时调用`creator()`计算并写入缓存"""
+        fragment_key = cls._fragment_key(name)
+        value = cls.cache.get(fragment_key)
+        if value is not None:
+            try:
+                return marshal.loads(value)
+            except (EOFError, ValueError, TypeError):
+                pass
+        data = creator()
+        cls.cache.set(fragment_key, marshal.dumps(data),
+                      expire=expire or cls.default_expire, tags=tags)
+        return data
+
+    @classmethod
+    def get_html(cls, name, creator, expire=None, tags=None):
+        """获取缓存的HTML片段(bytes)，没有命中时调用`creator()`渲染并写入缓存"""
+        fragment_key = cls._fragment_key(name)
+        value = cls.cache.get(fragment_key)
+        if value is not None:
+            return value
+        html = creator()
+        if isinstance(html, str):
+            html = html.encode()
+        cls.cache.set(fragment_key, html,
+                      expire=expire or cls.default_expire, tags=tags)
+        return html
+
+    @classmethod
+    def delete(cls, name):
+        cls.cache.delete(cls._fragment_key(name))
+
+
+class CacheInvalidator(object):
+    """根据数据库的改动清除依赖它的页面缓存
+
+    `Post`, `Comment`, `Tag`, `Category`在插入/更新/删除时，
+    将对象的`cache_tags()`记录到数据库session中，
+    等到事务提交以后再清除这些标签对应的缓存(回滚时丢弃)，
+    避免其它请求在提交之前又把旧数据写入缓存.
+
+    使用方法: `CacheInvalidator.setup(RedisCache)`，在`create_app()`中调用
+    """
+    models = (Post, Comment, Tag, Category)
+    cache = None
+    _registered = False
+
+    @classmethod
+    def setup(cls, cache):
+        cls.cache = cache
+        if cls._registered:
+            return
+        cls._registered = True
+        for model in cls.models:
+            event.listen(model, 'after_insert', cls.collect)
+            event.listen(model, 'after_update', cls.collect_update)
+            event.listen(model, 'after_delete', cls.collect)
+        event.listen(Session, 'after_commit', cls.invalidate)
+        event.listen(Session, 'after_rollback', cls.discard)
+
+    @classmethod
+    def collect(cls, mapper, connection, target):
+        session = object_session(target)
+        if session is None:
+            return
+        session.info.setdefault('cache_tags', set()).update(
+            target.cache_tags()
+        )
+
+    @classmethod
+    def collect_update(cls, mapper, connection, target):
+        """只改动了`cache_ignored_attrs`中的字段(比如渲染结果)时不清除缓存"""
+        ignored = getattr(target, 'cache_ignored_attrs', ())
+        if ignored:
+            changed = [attr.key for attr in inspect(target).attrs
+                       if attr.history.has_changes()]
+            if changed and all(key in ignored for key in changed):
+                return
+        cls.collect(mapper, connection, target)
+
+    @classmethod
+    def invalidate(cls, session):
+        tags = session.info.pop('cache_tags', None)
+        if not tags or cls.cache is None:
+            return
+        try:
+            cls.cache.invalidate_tags(*tags)
+        except Exception:
+            gen_log.error('CacheInvalidator invalidate error', exc_info=True)
+
+    @classmethod
+    def discard(cls, session):
+        session.info.pop('cache_tags', None)
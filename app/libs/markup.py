@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""Markdown渲染
+
+`Markdown`对象的创建(加载扩展)开销很大，这里维护一个对象池，
+每次渲染以后调用`reset()`放回池中重复使用.
+
+`render_markdown()`是模块级别的函数，可以提交到进程池中执行.
+"""
+import queue
+import hashlib
+
+import markdown
+
+EXTENSIONS = [
+    'markdown.extensions.extra',
+    'markdown.extensions.toc',
+    'markdown.extensions.tables',
+]
+# 渲染方式改变(比如修改扩展)时修改这个版本号，已经保存的渲染结果会重新生成
+RENDER_VERSION = '1'
+
+_pool = queue.Queue(maxsize=8)
+
+
+def _acquire():
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return markdown.Markdown(extensions=EXTENSIONS)
+
+
+def _release(md):
+    md.reset()
+    try:
+        _pool.put_nowait(md)
+    except queue.Full:
+        pass
+
+
+def render_markdown(text):
+    """渲染markdown文本
+
+    :return: (html, toc)
+    """
+    md = _acquire()
+    try:
+        html = md.convert(text or '')
+        toc = getattr(md, 'toc', '')
+    finally:
+        _release(md)
+    return html, toc
+
+
+def content_hash(text):
+    """markdown文本(和渲染版本)的摘要，用于判断保存的渲染结果是否过期"""
+    value = "{0}:{1}".format(RENDER_VERSION, text or '')
+    return hashlib.sha1(value.encode()).hexdigest()
@@ -3,8 +3,11 @@ Created on Oct 20, 2015
 
 @author: ahmadjaved.se@gmail.com
 '''
+import json
+import base64
+import datetime
 from math import ceil
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_
 
 
 class InvalidPage(Exception):
@@ -16,6 +19,9 @@ class PageNotAnInteger(InvalidPage):
 class EmptyPage(InvalidPage):
     pass
 
+class InvalidCursor(InvalidPage):
+    pass
+
 
 class Paginator(object):
     """
@@ -282,3 +288,201 @@ class Page(object):
         return self.number * self.paginator.per_page_limit
 
     end_index = property(__end_index)
+
+
+class KeysetPaginator(object):
+    """
+    Cursor based (keyset / seek) pagination.
+
+    Instead of ``OFFSET``, every page continues from the sort key of the last
+    (or first) row of the previous page, e.g. for keys ``(publish_time, id)``
+    in descending order the next page is::
+
+        WHERE publish_time < :t OR (publish_time = :t AND id < :id)
+        ORDER BY publish_time DESC, id DESC LIMIT :per_page + 1
+
+    so deep pages cost the same as the first one when there is an index on
+    the keys. The last key must be unique (usually the primary key).
+
+    The cursors are opaque url-safe strings. The total number of records is
+    optional: it is only computed when ``count_key`` is given, and then it is
+    cached in redis for ``count_expire`` seconds, so it is an estimate.
+
+    ..usage::
+        >>> paginator = KeysetPaginator(query, 10,
+        ...                             keys=(Post.publish_time, Post.id))
+        >>> page = paginator.page(cursor)
+        >>> page.object_list, page.next_cursor, page.previous_cursor
+    """
+
+    def __init__(self, query_set, per_page_limit, keys, descending=True,
+                 count_key=None, count_expire=60, cache=None):
+        """
+        :param query_set: SQLAlchemy query, its ORDER BY will be replaced.
+        :param per_page_limit: Required number of records in a page.
+        :param keys: Columns to sort and seek on, the last one must be unique.
+        :param descending: Sort order of all the keys.
+        :param count_key: Cache key of the total count, ``None`` to skip it.
+        :param count_expire: Seconds to cache the total count.
+        :param cache: Redis client used to cache the total count.
+        """
+        self.query_set = query_set
+        self.per_page_limit = per_page_limit
+        self.keys = keys
+        self.descending = descending
+        self.count_key = count_key
+        self.count_expire = count_expire
+        self.cache = cache
+        self.__count = None
+
+    @staticmethod
+    def encode_cursor(direction, values):
+        """Encode the direction ('n'ext / 'p'revious) and key values."""
+        data = [direction]
+        for value in values:
+            if isinstance(value, datetime.datetime):
+                data.append({'dt': value.isoformat()})
+            else:
+                data.append(value)
+        raw = json.dumps(data, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """
+        :return: (direction, values)
+
+        ..warning::
+            This function can raise InvalidCursor
+        """
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            data = json.loads(raw.decode())
+            direction, values = data[0], data[1:]
+            values = [
+                datetime.datetime.strptime(
+                    value['dt'],
+                    '%Y-%m-%dT%H:%M:%S.%f' if '.' in value['dt']
+                    else '%Y-%m-%dT%H:%M:%S'
+                ) if isinstance(value, dict) else value
+                for value in values
+            ]
+        except (ValueError, TypeError, KeyError, IndexError):
+            raise InvalidCursor('That cursor is invalid')
+        if direction not in ('n', 'p') or len(values) != len(self.keys):
+            raise InvalidCursor('That cursor is invalid')
+        return direction, values
+
+    def _seek(self, values, forward):
+        """Build the WHERE clause: rows after ``values`` in the scan order."""
+        # scanning forward in a descending order means "less than"
+        less = self.descending == forward
+        clauses = []
+        for index, key in enumerate(self.keys):
+            compare = key < values[index] if less else key > values[index]
+            clauses.append(and_(
+                *[self.keys[i] == values[i] for i in range(index)] + [compare]
+            ))
+        return or_(*clauses)
+
+    def _order_by(self, forward):
+        if self.descending == forward:
+            return [key.desc() for key in self.keys]
+        return [key.asc() for key in self.keys]
+
+    def _key_values(self, obj):
+        return [getattr(obj, key.key) for key in self.keys]
+
+    def page(self, cursor=None):
+        """
+        Returns the page after (or before) the given cursor, the first page
+        if cursor is empty.
+
+        :rtype: KeysetPage.
+
+        ..warning::
+            This function can raise InvalidCursor
+        """
+        direction, values = 'n', None
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+        forward = direction == 'n'
+        query = self.query_set.order_by(None).order_by(
+            *self._order_by(forward))
+        if values is not None:
+            query = query.filter(self._seek(values, forward))
+        object_list = query.limit(self.per_page_limit + 1).all()
+        has_more = len(object_list) > self.per_page_limit
+        object_list = object_list[:self.per_page_limit]
+        if forward:
+            has_next, has_previous = has_more, values is not None
+        else:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+        return KeysetPage(object_list, has_next, has_previous, self)
+
+    def __get_count(self):
+        """
+        Returns the cached estimate of the total number of records, or None
+        if ``count_key`` is not given.
+        """
+        if self.__count is None and self.count_key is not None:
+            if self.cache is not None:
+                count = self.cache.get(self.count_key)
+                if count is not None:
+                    self.__count = int(count)
+                    return self.__count
+            query = self.query_set.order_by(None)
+            count_query = query.statement.with_only_columns([func.count()])
+            self.__count = query.session.execute(count_query).scalar()
+            if self.cache is not None:
+                self.cache.set(self.count_key, self.__count,
+                               ex=self.count_expire)
+        return self.__count
+
+    count = property(__get_count)
+
+    def __get_total_pages(self):
+        """Returns the estimated number of pages, or None."""
+        if self.count is None:
+            return None
+        return int(ceil(max(1, self.count) / float(self.per_page_limit)))
+
+    total_pages = property(__get_total_pages)
+
+
+class KeysetPage(object):
+    """A page of KeysetPaginator, with the cursors of its neighbours."""
+
+    def __init__(self, object_list, has_next, has_previous, paginator):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.paginator = paginator
+
+    def __repr__(self):
+        return '<KeysetPage of %s objects>' % len(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def __next_cursor(self):
+        if not self.has_next():
+            return None
+        return self.paginator.encode_cursor(
+            'n', self.paginator._key_values(self.object_list[-1]))
+
+    next_cursor = property(__next_cursor)
+
+    def __previous_cursor(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.encode_cursor(
+            'p', self.paginator._key_values(self.object_list[0]))
+
+    previous_cursor = property(__previous_cursor)
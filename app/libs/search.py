@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""全文搜索的分词
+
+文章是中英文混合的，这里不依赖分词词典:
+
+- 英文/数字: 转为小写以后按单词切分
+- 中日文: 连续的汉字(假名)切分为重叠的二元组(bigram)，
+  比如"异步编程" -> "异步", "步编", "编程"，单个汉字保留为一个词;
+  建立索引时(`unigrams=True`)再加入每个单字，单字的查询也能匹配
+
+查询使用同样的二元组，所以连续的中文查询可以匹配到包含它的文章.
+"""
+import re
+
+# 英文/数字，假名，CJK统一汉字(含扩展A)，CJK兼容汉字
+_TOKEN_RE = re.compile(
+    r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+'
+)
+MAX_TOKEN_LENGTH = 32   # 过长的英文"单词"(比如哈希值，base64)不建立索引
+
+_MARKDOWN_RES = [
+    (re.compile(r'!\[([^\]]*)\]\([^)]*\)'), r'\1'),     # 图片
+    (re.compile(r'\[([^\]]*)\]\([^)]*\)'), r'\1'),      # 链接
+    (re.compile(r'<[^>]+>'), ' '),                      # HTML标签
+    (re.compile(r'&[a-z]+;|&#\d+;'), ' '),              # HTML实体
+    (re.compile(r'[#>*_`~|=\\-]+'), ' '),               # 其他标记
+]
+
+
+def strip_markdown(text):
+    """去掉markdown的标记，只保留文字(链接和图片只保留说明文字)"""
+    text = text or ''
+    for pattern, repl in _MARKDOWN_RES:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def tokenize(text, unigrams=False):
+    """分词，返回词的列表(保留重复的词，用于统计词频)
+
+    :param unigrams: 连续的汉字(假名)是否同时切分为单字(建立索引时使用)
+    """
+    tokens = []
+    for word in _TOKEN_RE.findall((text or '').lower()):
+        if word[0] < '\u0080':
+            if len(word) <= MAX_TOKEN_LENGTH:
+                tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            if unigrams:
+                tokens.extend(word)
+    return tokens
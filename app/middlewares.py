@@ -1,161 +1,567 @@
 #! /usr/bin/env python
 """中间件模块
 
-缓存中间件
+缓存中间件，数据统计中间件，以及在启动时编译好的中间件链`MiddlewareChain`
 """
+import re
+import gzip
+import time
+import secrets
 import types
+import struct
+import datetime
+import threading
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
 
 from app.libs.utils import import_object
 from app.models.sys_config import SysConfig
-from app.models.stats import SiteStats
+from app.models.stats import stats_recorder
 
 
 class BaseMiddleware(object):
-    """实现基础的中间件API"""
+    """实现基础的中间件API
+
+    中间件在`create_app()`中实例化一次，所有请求共享同一个实例，
+    所以请求相关的状态要保存在handler上，而不是中间件实例上.
+    子类只需要实现用到的钩子函数，没有实现的钩子不会被调用.
+    """
 
-    def __init__(self, handler, **kwargs):
-        self.handler = handler
+    def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def before_request(self):
+    def enabled(self, handler):
+        """这个请求是否需要经过这个中间件(每个请求只检查一次)"""
+        return True
+
+    def before_request(self, handler):
         """一个请求到达时的钩子函数，
 
         这个钩子函数将会在`RequestHandler.prepare()`中触发
         """
-        raise NotImplemented
 
-    def after_request(self):
+    def after_request(self, handler):
         """一个请求处理完毕后(已经返回响应)时的钩子函数
 
-        这个钩子函数将会在`RequestHandler.on_finish()`中触发
+        这个钩子函数将会在`RequestHandler.on_finish()`中触发，
+        只有执行过`before_request()`的中间件才会执行，顺序和`before_request()`相反
+        """
+
+
+class CachedResponse(object):
+    """缓存的完整响应: 状态码，部分响应头，ETag，gzip压缩后的响应体
+
+    序列化为紧凑的二进制记录:
+
+        magic(4) | status(H) | fresh_until(d) | 响应头数量(B) | etag长度(H)
+        | (name长度(B) | value长度(H) | name | value)... | etag | gzip响应体
+    """
+    __slots__ = ['status', 'headers', 'etag', 'body', 'fresh_until']
+    magic = b'MBC1'
+    _head = struct.Struct('>4sHdBH')
+    _header_head = struct.Struct('>BH')
+    cached_headers = ('Content-Type', 'Cache-Control', 'Last-Modified')
+
+    def __init__(self, status, headers, etag, body, fresh_until):
+        """
+        :param headers: [(name, value)...]
+        :param body: gzip压缩后的响应体
         """
-        raise NotImplemented
+        self.status = status
+        self.headers = headers
+        self.etag = etag
+        self.body = body
+        self.fresh_until = fresh_until
+
+    @classmethod
+    def from_handler(cls, handler, chunk, fresh_until):
+        """根据RequestHandler当前的状态和未压缩的响应体创建缓存记录"""
+        headers = [(name, str(handler._headers[name]))
+                   for name in cls.cached_headers if name in handler._headers]
+        etag = handler._headers.get('Etag') or handler.compute_etag() or ''
+        return cls(handler.get_status(), headers, str(etag),
+                   gzip.compress(chunk), fresh_until)
+
+    def pack(self):
+        etag = self.etag.encode()
+        parts = [self._head.pack(self.magic, self.status, self.fresh_until,
+                                 len(self.headers), len(etag))]
+        for name, value in self.headers:
+            name, value = name.encode(), value.encode()
+            parts.append(self._header_head.pack(len(name), len(value)))
+            parts.append(name)
+            parts.append(value)
+        parts.append(etag)
+        parts.append(self.body)
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        """解析二进制记录，格式不正确时返回None"""
+        if not isinstance(data, bytes) or not data.startswith(cls.magic):
+            return None
+        try:
+            _, status, fresh_until, header_count, etag_length = \
+                cls._head.unpack_from(data)
+            offset = cls._head.size
+            headers = []
+            for _ in range(header_count):
+                name_length, value_length = \
+                    cls._header_head.unpack_from(data, offset)
+                offset += cls._header_head.size
+                name = data[offset:offset + name_length].decode()
+                offset += name_length
+                value = data[offset:offset + value_length].decode()
+                offset += value_length
+                headers.append((name, value))
+            etag = data[offset:offset + etag_length].decode()
+            offset += etag_length
+        except (struct.error, UnicodeDecodeError):
+            return None
+        return cls(status, headers, etag, data[offset:], fresh_until)
 
 
 class CacheMiddleware(BaseMiddleware):
-    """缓存中间件"""
+    """缓存中间件
+
+    为了防止缓存过期时大量并发请求同时渲染同一个页面(缓存击穿):
+
+    - 进程内: 同一个缓存键只有一个请求负责渲染，其它请求等待它的结果(single-flight)
+    - 进程间: 负责渲染的请求需要先获得一个短时间的Redis锁，
+      锁的值是一个随机的token，只有仍然持有锁的请求才能写入缓存
+    - 缓存条目过期以后还会保留`stale_ttl`秒，在这段时间内直接返回旧内容，
+      同时由一个后台请求(携带token)重新渲染并刷新缓存.
+      后台请求发送到`revalidate_origin`(默认为本机的`127.0.0.1:<端口>`)，
+      不使用客户端提供的Host; token和当前锁的值不一致的请求按普通请求处理
+    """
+    revalidate_header = 'X-Cache-Revalidate'
+    _inflight = {}      # 进程内正在渲染的缓存键: {key: Future}
+    _release_lock = None
+
+    # 比较锁的值，只有持有者才能释放锁
+    release_lock_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
 
-    def __init__(self, handler, cache,
-                 no_get_flush=True):
+    def __init__(self, cache, no_get_flush=True, stale_ttl=60,
+                 lock_timeout=10, revalidate_origin=None):
         """初始化缓存配置
 
-        :param handler: RequestHandler的实例
         :param cache:
 
             缓存类的引入字符串。
 
             比如想要`from cache import RedisCache`，等价于字符串"cache.RedisCache".
 
-        :param expire: 缓存的过期时间
         :param no_get_flush:
 
             一个标识参数，决定是否在非GET方法请求时将缓存清空.
 
-        :param host: 缓存后端的host
-        :param port: 缓存后端的port
-        :param password: 缓存后端的密码
+        :param stale_ttl: 缓存过期以后，仍然可以返回旧内容的时间(秒)
+        :param lock_timeout: 渲染锁的过期时间，也是等待其它请求渲染的最长时间(秒)
+        :param revalidate_origin:
+            后台刷新请求发送到的地址，比如"http://127.0.0.1:8000"，
+            默认为`127.0.0.1`和接收到这个请求的端口
         """
-        self.handler = handler
         self.no_get_flush = no_get_flush
-        self.request = handler.request
+        self.stale_ttl = stale_ttl
+        self.lock_timeout = lock_timeout
+        self.revalidate_origin = revalidate_origin
         self.cache = import_object(cache)
 
-    def before_request(self):
+    def enabled(self, handler):
+        # 没有开启缓存时跳过缓存中间件
+        # (开关缓存时后台会清空缓存，这里不需要每个请求都清空)
+        return SysConfig.get(**SysConfig.cache_enable) is not False
+
+    # 渲染锁 --------------------------------------------------------
+
+    def _lock_key(self, key):
+        return "{0}:lock:{1}".format(self.cache.key, key)
+
+    def acquire_lock(self, key):
+        """获取渲染锁，成功时返回(无法猜测的)token，失败时返回None"""
+        token = secrets.token_hex(16)
+        if self.cache.client.set(self._lock_key(key), token,
+                                 nx=True, ex=self.lock_timeout):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        """释放渲染锁，返回是否仍然持有这个锁"""
+        if CacheMiddleware._release_lock is None:
+            CacheMiddleware._release_lock = self.cache.client.register_script(
+                self.release_lock_script
+            )
+        return bool(self._release_lock(keys=[self._lock_key(key)],
+                                       args=[token]))
+
+    def lock_holder(self, key):
+        value = self.cache.client.get(self._lock_key(key))
+        return value.decode() if value is not None else None
+
+    # 请求处理 ------------------------------------------------------
+
+    def before_request(self, handler):
         """在请求刚到达时的缓存策略处理流程
 
-        使用request.uri作为缓存键.
+        使用request.uri作为缓存键，handler的`page_cache_scope()`不为None时
+        加入缓存键(比如管理员看到的页面和匿名用户不同).
 
         在请求方法是'GET'的情况下,使用monkey-patch技术来修改response过程.
         """
-        redis_key = self.request.uri
-        if self.request.method.upper() != 'GET':
+        request = handler.request
+        redis_key = request.uri
+        scope_getter = getattr(handler, 'page_cache_scope', None)
+        scope = scope_getter() if scope_getter is not None else None
+        if scope is not None:
+            redis_key = "{0}#{1}".format(redis_key, scope)
+        if request.method.upper() != 'GET':
             if self.no_get_flush:
                 self.cache.delete(redis_key)
-        else:
-            cache_content = self.cache.get(redis_key, None)
-            # 如果有相应的缓存内容则直接使用`.finish()`输出
-            # 注意，使用`.finish()`以后这个handler的生命周期就结束了
-            # 所以缓存中间件一般应该放在中间件列表的最后位置
-            if cache_content is not None:
-                if (cache_content.startswith('{')
-                        and cache_content.endswith('}')):
-                    self.handler.set_header(
-                        "Content-Type",
-                        "application/json; charset=UTF-8"
+            return
+
+        # 后台刷新缓存的请求，必须携带当前锁的token，否则按普通请求处理
+        token = request.headers.get(self.revalidate_header, None)
+        if token is not None and token == self.lock_holder(redis_key):
+            handler._cache_revalidation = True
+            self.render_and_cache(handler, redis_key, token)
+            return
+
+        entry = CachedResponse.unpack(self.cache.get(redis_key, None))
+        if (entry is not None and scope is not None and
+                entry.fresh_until < time.time()):
+            # 后台刷新请求不带用户的身份，有作用域的缓存过期以后直接重新渲染
+            entry = None
+        if entry is not None:
+            if entry.fresh_until < time.time():
+                # 缓存已经过期，返回旧内容，并在后台刷新
+                url = self.revalidate_url(request, redis_key)
+                token = self.acquire_lock(redis_key) if url else None
+                if token is not None:
+                    IOLoop.current().spawn_callback(
+                        self.revalidate, url, redis_key, token
                     )
-                this = self
-                def _get(self, *args, **kwargs):
-                    this.handler.finish(cache_content)
-                this.handler.get = types.MethodType(_get, this.handler)
+            self.serve(handler, entry)
+            return
+
+        # 同一个进程内已经有请求在渲染这个页面，等待它的结果
+        future = self._inflight.get(redis_key)
+        if future is not None:
+            self.wait_for(handler, future)
+            return
+
+        # 获取跨进程的渲染锁，没有获取到锁的请求只渲染不写入缓存
+        token = self.acquire_lock(redis_key)
+        self.render_and_cache(handler, redis_key, token)
+
+    def after_request(self, handler):
+        """请求结束时，结束未完成的single-flight并释放渲染锁"""
+        state = getattr(handler, '_cache_flight', None)
+        if state is None:
+            return
+        redis_key, token, future = state
+        handler._cache_flight = None
+        if future is not None:
+            if self._inflight.get(redis_key) is future:
+                del self._inflight[redis_key]
+            if not future.done():
+                future.set_result(None)
+        if token is not None:
+            self.release_lock(redis_key, token)
+
+    def finish_with(self, handler, entry):
+        """使用缓存的响应输出
+
+        - 请求的`If-None-Match`和缓存的ETag一致时直接返回304，不需要响应体
+        - 客户端支持gzip时直接输出压缩好的响应体，否则解压以后输出
+        """
+        handler.set_status(entry.status)
+        for name, value in entry.headers:
+            handler.set_header(name, value)
+        handler.set_header('Vary', 'Accept-Encoding')
+        if entry.etag:
+            handler.set_header('Etag', entry.etag)
+            if handler.check_etag_header():
+                handler.set_status(304)
+                return handler.finish()
+        if 'gzip' in handler.request.headers.get('Accept-Encoding', ''):
+            handler.set_header('Content-Encoding', 'gzip')
+            handler.write(entry.body)
+        else:
+            handler.write(gzip.decompress(entry.body))
+        handler.finish()
+
+    def serve(self, handler, entry):
+        """使用缓存内容直接响应
+        注意，使用`.finish()`以后这个handler的生命周期就结束了
+        所以缓存中间件一般应该放在中间件链的最后位置
+        """
+        this = self
+        def _get(self, *args, **kwargs):
+            this.finish_with(self, entry)
+        handler.get = types.MethodType(_get, handler)
+
+    def wait_for(self, handler, future):
+        """等待同一个进程内负责渲染的请求，超时或者渲染失败时自己渲染"""
+        this = self
+        original_get = handler.get
+        @gen.coroutine
+        def _get(self, *args, **kwargs):
+            try:
+                entry = yield gen.with_timeout(
+                    datetime.timedelta(seconds=this.lock_timeout), future
+                )
+            except gen.TimeoutError:
+                entry = None
+            if entry is None:
+                result = original_get(*args, **kwargs)
+                if result is not None:
+                    yield result
             else:
-                # 如果没有缓存内容,
-                # 我们需要使用monkey-patch来改造`.flush()`方法,
-                # 为它加入缓存的功能
-                this = self
-                # instance-level monkey-patch
-                def _flush(self, *args, **kwargs):
-                    # 如果是304状态码就不会包含body数据
-                    if self._status_code != 304:
-                        chunk = b"".join(self._write_buffer)
-                        this.cache.set(
-                            redis_key, chunk,
-                            expire=SysConfig.get(**SysConfig.cache_expire)
-                        )
-                    super(self.__class__, self).flush(*args, **kwargs)
-                this.handler.flush = types.MethodType(_flush, this.handler)
+                this.finish_with(self, entry)
+        handler.get = types.MethodType(_get, handler)
+
+    def render_and_cache(self, handler, redis_key, token):
+        """正常渲染页面，并在输出时写入缓存
+
+        - 使用monkey-patch来改造`.flush()`方法,为它加入缓存的功能
+        - `token`为None时(其它进程持有渲染锁)只渲染，不写入缓存
+        """
+        future = None
+        if redis_key not in self._inflight:
+            future = Future()
+            self._inflight[redis_key] = future
+        handler._cache_flight = (redis_key, token, future)
+        this = self
+        # instance-level monkey-patch
+        def _flush(self, *args, **kwargs):
+            # 缓存命中时根据Accept-Encoding输出不同的响应体，
+            # 第一次渲染的响应也要声明，避免中间代理缓存错误的版本
+            if 'Vary' not in self._headers:
+                self.set_header('Vary', 'Accept-Encoding')
+            # 如果是304状态码就不会包含body数据
+            if self._status_code == 200 and (token or future):
+                expire = SysConfig.get(**SysConfig.cache_expire)
+                entry = CachedResponse.from_handler(
+                    self, b"".join(self._write_buffer), time.time() + expire
+                )
+                if token is not None and this.release_lock(redis_key, token):
+                    this.cache.set(redis_key, entry.pack(),
+                                   expire=expire + this.stale_ttl,
+                                   tags=self._cache_tags)
+                if future is not None and not future.done():
+                    future.set_result(entry)
+            super(self.__class__, self).flush(*args, **kwargs)
+        handler.flush = types.MethodType(_flush, handler)
+
+    def revalidate_url(self, request, path):
+        """后台刷新请求的URL，无法确定本机端口时返回None(不在后台刷新)"""
+        if self.revalidate_origin:
+            return self.revalidate_origin.rstrip('/') + path
+        try:
+            port = request.connection.stream.socket.getsockname()[1]
+        except (AttributeError, OSError, IndexError, TypeError):
+            return None
+        return "http://127.0.0.1:{0}{1}".format(port, path)
+
+    @gen.coroutine
+    def revalidate(self, url, redis_key, token):
+        """后台请求同一个URL来刷新缓存"""
+        revalidate_request = HTTPRequest(
+            url, headers={self.revalidate_header: token},
+            request_timeout=self.lock_timeout
+        )
+        try:
+            yield AsyncHTTPClient().fetch(revalidate_request,
+                                          raise_error=False)
+        except Exception:
+            app_log.error("cache revalidate error", exc_info=True)
+        finally:
+            # 刷新请求没有完成时(比如连接失败)释放锁，下一个请求可以重新刷新
+            self.release_lock(redis_key, token)
 
 
 class StatsMiddleware(BaseMiddleware):
     """数据统计中间件"""
 
-    def __init__(self, handler):
-        self.handler = handler
-        self.request = handler.request
+    def after_request(self, handler):
+        # 缓存中间件发出的后台刷新请求(token已经验证过)不计入统计
+        if getattr(handler, '_cache_revalidation', False):
+            return
+        # 增量PV/UV数据，存储访问者的IP和UA
+        # 数据先缓冲在进程内存中，由IOLoop定时批量写入Redis
+        stats_recorder.ensure_started()
+        stats_recorder.record(handler.request.remote_ip,
+                              handler.request.headers.get('User-Agent', ''))
+
+
+class MiddlewareChain(object):
+    """编译好的中间件链，在`create_app()`中根据`MIDDLEWARES`配置创建一次
+
+    配置的格式是`{中间件类的引入字符串: 参数}`，除了传给中间件构造函数的参数以外，
+    还可以使用这几个保留的参数:
+
+    - `order`: 执行顺序，小的先执行，相同时按配置中的顺序(默认为0)
+    - `include`: 正则表达式的列表，设置以后只处理路径匹配其中之一的请求
+    - `exclude`: 正则表达式的列表，不处理路径匹配其中之一的请求
+
+    比如:
 
-    def before_request(self):
-        # 增量UV数据
-        SiteStats.incr_uv(self.request.remote_ip)
-        # 增量PV数据
-        SiteStats.incr_pv()
-        # 存储访问者的UA
-        SiteStats.save_access_ua(self.request.headers['User-Agent'],
-                                 self.request.remote_ip)
-        # 存储访问者的IP
-        SiteStats.save_access_ip(self.request.remote_ip)
+        MIDDLEWARES = {
+            'app.middlewares.StatsMiddleware': {'exclude': [r'/api/']},
+            'app.middlewares.CacheMiddleware': {
+                'cache': 'app.cache.TieredCache',
+                'order': 100,
+                'exclude': [r'/admin', r'/api/'],
+            },
+        }
 
+    每个请求中，`prepare()`依次执行匹配的中间件的`before_request()`，
+    `on_finish()`按相反的顺序只执行这些中间件的`after_request()`.
+    每个阶段的调用次数，出错次数和耗时记录在`stats()`中，用于监控.
+    """
+    reserved_options = ('order', 'include', 'exclude')
+    phases = ('before_request', 'after_request')
 
-class MiddlewareProcess(object):
-    """中间件处理方法"""
+    class Entry(object):
+        __slots__ = ['name', 'middleware', 'include', 'exclude',
+                     'before_request', 'after_request']
+
+    def __init__(self, middleware_dicts=None):
+        self._lock = threading.Lock()
+        self.entries = []
+        items = []
+        for index, (path, options) in enumerate(
+                (middleware_dicts or {}).items()):
+            options = dict(options or {})
+            order = options.pop('order', 0)
+            include = options.pop('include', None)
+            exclude = options.pop('exclude', None)
+            items.append((order, index, path, options, include, exclude))
+
+        for _, _, path, options, include, exclude in sorted(
+                items, key=lambda item: item[:2]):
+            middleware_cls = import_object(path)
+            entry = self.Entry()
+            entry.name = path.rsplit('.', 1)[-1]
+            entry.middleware = middleware_cls(**options)
+            entry.include = self._compile(include)
+            entry.exclude = self._compile(exclude)
+            # 子类没有实现的钩子不需要调用
+            for phase in self.phases:
+                hook = getattr(middleware_cls, phase)
+                setattr(entry, phase,
+                        getattr(entry.middleware, phase)
+                        if hook is not getattr(BaseMiddleware, phase)
+                        else None)
+            self.entries.append(entry)
+
+        # {中间件名称: {阶段: [调用次数, 出错次数, 总耗时]}}
+        self._timings = {
+            entry.name: {phase: [0, 0, 0.0] for phase in self.phases}
+            for entry in self.entries
+        }
 
     @staticmethod
-    def prepare(handler, middleware_dicts):
-        """嵌入到`prepare()`的处理流程中"""
-        for middleware, kwds in middleware_dicts.items():
-            middleware_cls = import_object(middleware)
-            middleware_obj = middleware_cls(handler, **kwds)
-            if 'cache' in middleware.lower():
-                if SysConfig.get(**SysConfig.cache_enable) is False:
-                    # 没有开启缓存，跳过缓存中间件
-                    middleware_obj.cache.flush_all()
-                    continue
+    def _compile(patterns):
+        if not patterns:
+            return None
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return re.compile("|".join("(?:{0})".format(pattern)
+                                   for pattern in patterns))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        """根据类名获取中间件实例，没有配置时返回None"""
+        for entry in self.entries:
+            if entry.name == name:
+                return entry.middleware
+        return None
+
+    def match(self, entry, handler):
+        path = handler.request.path
+        if entry.include is not None and not entry.include.match(path):
+            return False
+        if entry.exclude is not None and entry.exclude.match(path):
+            return False
+        return entry.middleware.enabled(handler)
+
+    def _record(self, entry, phase, start, failed=False):
+        elapsed = time.time() - start
+        with self._lock:
+            timing = self._timings[entry.name][phase]
+            timing[0] += 1
+            timing[1] += failed
+            timing[2] += elapsed
+
+    def prepare(self, handler):
+        """嵌入到`prepare()`的处理流程中
+
+        执行过`before_request()`的中间件记录在`handler._middleware_entries`中
+        """
+        entries = []
+        handler._middleware_entries = entries
+        for entry in self.entries:
+            start = time.time()
+            if not self.match(entry, handler):
+                continue
+            entries.append(entry)
+            if entry.before_request is None:
+                continue
             try:
-                middleware_obj.before_request()
-            except NotImplemented:
-                pass
+                entry.before_request(handler)
+            except Exception:
+                self._record(entry, 'before_request', start, failed=True)
+                raise
+            self._record(entry, 'before_request', start)
 
-    @staticmethod
-    def on_finish(handler, middleware_dicts):
-        """嵌入到`on_finish()`的处理流程中"""
-        for middleware, kwds in middleware_dicts.items():
-            if 'cache' in middleware.lower():
-                if SysConfig.get(**SysConfig.cache_enable) is False:
-                    # 没有开启缓存，跳过缓存中间件
-                    continue
-            middleware_cls = import_object(middleware)
-            middleware_obj = middleware_cls(handler, **kwds)
+    def on_finish(self, handler):
+        """嵌入到`on_finish()`的处理流程中
+
+        响应已经发送，出错时只记录日志，继续执行其它中间件
+        """
+        entries = getattr(handler, '_middleware_entries', None) or ()
+        for entry in reversed(entries):
+            if entry.after_request is None:
+                continue
+            start = time.time()
             try:
-                middleware_obj.after_request()
+                entry.after_request(handler)
             except Exception:
-                pass
+                self._record(entry, 'after_request', start, failed=True)
+                app_log.error("%s.after_request() error", entry.name,
+                              exc_info=True)
+            else:
+                self._record(entry, 'after_request', start)
 
+    def stats(self):
+        """每个中间件每个阶段的调用次数，出错次数，总耗时和平均耗时(毫秒)"""
+        with self._lock:
+            timings = {
+                name: {phase: list(timing) for phase, timing in item.items()}
+                for name, item in self._timings.items()
+            }
+        return {
+            name: {
+                phase: {
+                    "count": count,
+                    "errors": errors,
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total * 1000 / count, 3) if count else 0,
+                }
+                for phase, (count, errors, total) in item.items()
+            }
+            for name, item in timings.items()
+        }
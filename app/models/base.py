@@ -1,6 +1,9 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import json
+import time
+import threading
 import contextlib
 import datetime
 import redis
@@ -9,14 +12,16 @@ import redis
 from tornado.log import gen_log
 from sqlalchemy import create_engine, Column, DateTime, Integer
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.baked import bakery
 
 from config import CommonConfig
 from ..libs.utils import DateEncoder
 
-__all__ = ['redis_cli', 'Base', 'NativeBase', 'Session', 'session_context',
-           'ModelAPIMixin']
+__all__ = ['redis_cli', 'redis_binary_cli', 'Base', 'NativeBase', 'Session',
+           'session_context', 'ModelAPIMixin', 'get_engine', 'warm_up_engine',
+           'engine_pool_stats']
 
 
 class BaseCls(object):
@@ -38,11 +43,134 @@ redis_cli = redis.StrictRedis(
     password=CommonConfig.REDIS_PASSWORD,
     decode_responses=True
 )
+# 不解码响应的客户端，用于存储二进制数据(比如页面缓存)
+redis_binary_cli = redis.StrictRedis(
+    host=CommonConfig.REDIS_HOST,
+    port=CommonConfig.REDIS_PORT,
+    password=CommonConfig.REDIS_PASSWORD,
+)
+
+
+class TimedQueuePool(QueuePool):
+    """记录等待时间的连接池
+
+    在`QueuePool`的基础上统计获取连接的次数，以及需要等待的次数和等待总时长，用于监控.
+    获取连接时连接池中没有空闲的连接才算作等待(需要新建连接或者等待其它线程归还)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_count = 0
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        waited = self.checkedin() == 0
+        start = time.time()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.time() - start
+            with self._stats_lock:
+                self.checkout_count += 1
+                if waited:
+                    self.wait_count += 1
+                    self.wait_time += elapsed
+
+
+# engine注册表: {uri: (进程pid, engine)}
+_engine_registry = {}
+_engine_registry_lock = threading.Lock()
+
+
+def get_engine(uri=CommonConfig.SQLALCHEMY_URI, **pool_kwargs):
+    """获取进程内共享的engine
+
+    根据`uri`缓存engine，同一个进程内只会创建一次;
+    连接池参数以第一次调用时的为准，之后的调用不会再创建新的连接池.
+
+    如果发现engine是在父进程中创建的(fork以后)，
+    会先丢弃继承下来的连接(不关闭父进程的socket)，再重新创建.
+
+    :param uri: 数据库连接字符串
+    :param pool_kwargs: 连接池参数，比如`pool_size`, `pool_recycle`
+    :return: `sqlalchemy.engine.Engine`对象
+    """
+    pid = os.getpid()
+    with _engine_registry_lock:
+        item = _engine_registry.get(uri)
+        if item is not None:
+            engine_pid, engine = item
+            if engine_pid == pid:
+                return engine
+            # fork以后，父进程的连接不能在子进程中使用，
+            # 也不能调用`dispose()`(会关闭父进程正在使用的连接)，直接丢弃即可
+        if not uri.startswith('sqlite') or 'pool_size' in pool_kwargs:
+            pool_kwargs.setdefault('poolclass', TimedQueuePool)
+        engine = create_engine(uri, **pool_kwargs)
+        _engine_registry[uri] = (pid, engine)
+    return engine
+
+
+def warm_up_engine(engine, size=None):
+    """预热连接池，在服务启动时预先建立`size`个数据库连接"""
+    pool = engine.pool
+    if size is None:
+        size = pool.size() if hasattr(pool, 'size') else 1
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    except Exception:
+        gen_log.error('warm_up_engine() connect error', exc_info=True)
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def engine_pool_stats():
+    """返回当前进程所有engine的连接池统计信息，用于监控
+
+    :return: 以uri(隐藏密码)为键的字典
+
+        - size: 连接池大小
+        - checked_in: 空闲的连接数
+        - checked_out: 正在使用的连接数
+        - overflow: 溢出的连接数
+        - checkout_count: 获取连接的次数
+        - wait_count: 获取连接时没有空闲连接(需要等待)的次数
+        - wait_time: 获取连接等待的总时长(秒)
+    """
+    stats = {}
+    pid = os.getpid()
+    for engine_pid, engine in list(_engine_registry.values()):
+        if engine_pid != pid:
+            continue
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        stats[repr(engine.url)] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "checkout_count": getattr(pool, 'checkout_count', 0),
+            "wait_count": getattr(pool, 'wait_count', 0),
+            "wait_time": round(getattr(pool, 'wait_time', 0.0), 6),
+        }
+    return stats
 
 
 @contextlib.contextmanager
 def session_context(uri=CommonConfig.SQLALCHEMY_URI):
-    engine = create_engine(uri)
+    # 和请求中使用同样的连接池参数(先调用的一方决定连接池的大小)
+    engine = get_engine(
+        uri,
+        pool_size=getattr(CommonConfig, 'SQLALCHEMY_POOL_SIZE', 5),
+        pool_recycle=getattr(CommonConfig, 'SQLALCHEMY_POOL_RECYCLE', -1),
+    )
     session = Session(bind=engine)
     yield session
     try:
@@ -57,14 +185,27 @@ def session_context(uri=CommonConfig.SQLALCHEMY_URI):
 class ModelAPIMixin(object):
     """这个mixin为model提供操作方法，包括常见的增删查改..."""
 
+    # 加载策略: {名称: (loader option...)}，比如
+    # `{'list': (joinedload('image'), defer('content'))}`
+    # 用于一次性加载列表页需要的关联对象，避免N+1次的延迟加载
+    loading_profiles = {}
+
+    @classmethod
+    def apply_profile(cls, query, profile=None):
+        """为查询加上名为`profile`的加载策略，model没有定义这个策略时不做修改"""
+        options = cls.loading_profiles.get(profile) if profile else None
+        if not options:
+            return query
+        return query.options(*options)
+
     @classmethod
-    def get_object_list(cls, session, field_list=None):
+    def get_object_list(cls, session, field_list=None, profile=None):
         """返回该model的对象列表"""
         if field_list:
             fields = [getattr(cls, field) for field in field_list]
             object_list = session.query(*fields)
         else:
-            object_list = session.query(cls)
+            object_list = cls.apply_profile(session.query(cls), profile)
         object_list = object_list.order_by(cls.id.desc())
         return object_list
 
@@ -77,13 +218,13 @@ class ModelAPIMixin(object):
         return obj
 
     @classmethod
-    def get_object_by_id(cls, session, id, field_list=None):
+    def get_object_by_id(cls, session, id, field_list=None, profile=None):
         """根据id来获取对象"""
         if field_list:
             fields = [getattr(cls, field) for field in field_list]
             obj = session.query(*fields).filter_by(id=id).one_or_none()
         else:
-            obj = session.query(cls).get(id)
+            obj = cls.apply_profile(session.query(cls), profile).get(id)
         return obj
 
     @classmethod
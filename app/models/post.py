@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import math
+import json
+import heapq
 import hashlib
-import markdown
+import secrets
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 
 from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey,
-                        bindparam, Text, Boolean, func, text, select, and_)
-from sqlalchemy.orm import relationship, backref
+                        bindparam, Text, Boolean, func, text, select, and_,
+                        event, inspect, case, Index)
+from sqlalchemy.orm import (relationship, backref, object_session,
+                            joinedload, subqueryload, load_only, deferred,
+                            undefer_group)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy_utils import ChoiceType
+from tornado.log import gen_log
 
-from .base import Base, sql_bakery, ModelAPIMixin, redis_cli
+from .base import Base, Session, sql_bakery, ModelAPIMixin, redis_cli
+from ..libs.markup import render_markdown, content_hash
 from ..models.sys_config import SysConfig
+from .rate_limit import comment_limiter
 
 __all__ = ['Category', 'Image', 'Post', 'Comment', 'Tag', 'PostTag',
-           'PostCollection']
+           'PostCollection', 'PostArchive', 'PostSlugMap', 'PostRelation']
 
 
 # ========================================================
@@ -39,6 +48,10 @@ class Category(ModelAPIMixin, Base):
         backref=backref('parent', remote_side=id),
     )
 
+    loading_profiles = {
+        'api_list': (joinedload('parent'),),
+    }
+
     @staticmethod
     def exists(name, session):
         """检查分类名是否已经存在"""
@@ -69,6 +82,10 @@ class Category(ModelAPIMixin, Base):
         }
         return self.jsonify(data)
 
+    def cache_tags(self):
+        """依赖这个分类的页面缓存标签"""
+        return ['category:{0}'.format(self.id), 'sidebar']
+
 
 class Image(ModelAPIMixin, Base):
     __tablename__ = 'image'
@@ -141,6 +158,10 @@ class Tag(ModelAPIMixin, Base):
     def to_detail_json(self):
         return self.to_list_json()
 
+    def cache_tags(self):
+        """依赖这个标签的页面缓存标签"""
+        return ['tag:{0}'.format(self.id), 'sidebar']
+
 
 class PostTag(Base):
     __tablename__ = 'post_tag'
@@ -182,13 +203,25 @@ class Post(ModelAPIMixin, Base):
 
     id = Column(Integer, primary_key=True)
     title = Column(String(64), index=True, nullable=False)
-    slug = Column(String(128), nullable=False)
+    slug = Column(String(128), nullable=False, unique=True, index=True)
     type = Column(ChoiceType(TYPES))
     meta_description = Column(String(128))
     meta_keywords = Column(String(128))
     brief = Column(String(512))
     view_num = Column(Integer)
-    content = Column(Text)
+    # 开启的评论数量(用于显示)，插入/删除/开启/关闭评论时通过一条`UPDATE`原子地修改
+    # (见`Comment.incr_comment_count()`)
+    comment_count = Column(Integer, nullable=False, default=0,
+                           server_default='0')
+    # 已经分配的最大楼层，只增不减，删除评论以后楼层也不会重复
+    comment_floor_seq = Column(Integer, nullable=False, default=0,
+                               server_default='0')
+    # 正文和渲染结果默认延迟加载(`body`组)，第一次访问其中一个时一起加载，
+    # 需要正文的查询使用`undefer_group('body')`(比如'detail'加载策略)
+    content = deferred(Column(Text), group='body')
+    content_html = deferred(Column(Text), group='body')     # 渲染好的HTML
+    content_toc = deferred(Column(Text), group='body')      # 渲染好的目录
+    content_hash = Column(String(40))       # 渲染时content的摘要
     status = Column(Boolean, default=True)
     publish_time = Column(DateTime, default=datetime.now, index=True)
     image_id = Column(Integer, ForeignKey('image.id'))
@@ -217,44 +250,112 @@ class Post(ModelAPIMixin, Base):
         backref='post_set'
     )
 
+    loading_profiles = {
+        # 文章列表(首页，后台): 图片，分类，标签(正文默认不加载)
+        'list': (
+            joinedload('image'),
+            joinedload('category'),
+            subqueryload('post_tags'),
+        ),
+        # 文章详情: 正文，图片，分类，标签(评论单独分页读取)
+        'detail': (
+            undefer_group('body'),
+            joinedload('image'),
+            joinedload('category'),
+            subqueryload('post_tags'),
+        ),
+        # 链接(相关文章，上一篇/下一篇): 只加载生成地址和标题需要的字段
+        'link': (
+            load_only('id', 'title', 'slug', 'publish_time'),
+        ),
+        # 列表API: 只加载`to_list_json()`需要的字段
+        'api_list': (
+            load_only('id', 'title', 'slug', 'status', 'publish_time',
+                      'image_id', 'category_id', 'comment_count'),
+            joinedload('image').load_only('url'),
+            joinedload('category').load_only('name'),
+        ),
+    }
+
     @hybrid_property
     def sibling_posts(self):
         """同一个集合内的其它post"""
-        if not self.collection:
+        if not self.collection_id:
             return None
-        result = list(self.collection.post_set)
-        result.remove(self)
-        return result
+        return object_session(self).query(Post).filter(
+            Post.collection_id == self.collection_id,
+            Post.id != self.id
+        ).order_by(Post.publish_time).all()
+
+    # 只改动这些字段时不需要清除页面缓存
+    cache_ignored_attrs = ('content_html', 'content_toc', 'content_hash',
+                           'view_num')
+
+    def content_is_stale(self):
+        """保存的渲染结果是否和当前的content不一致"""
+        return (self.content_html is None or
+                self.content_hash != content_hash(self.content))
+
+    def set_rendered_content(self, html, toc, source=None):
+        """保存渲染结果
+
+        :param source: 渲染时使用的markdown文本，默认为当前的content
+        """
+        self.content_html = html
+        self.content_toc = toc
+        self.content_hash = content_hash(
+            self.content if source is None else source
+        )
+
+    def render_content(self):
+        """同步渲染content，并保存渲染结果"""
+        self.set_rendered_content(*render_markdown(self.content))
 
-    _markdown_content = None
     @property
     def markdown_content(self):
-        if not self._markdown_content:
-            self._markdown_content = markdown.markdown(
-                self.content,
-                ['extra', 'toc', 'markdown.extensions.tables']
-            )
-        return self._markdown_content
+        """渲染好的HTML，渲染结果过期时才重新渲染(随请求结束提交到数据库)"""
+        if self.content_is_stale():
+            self.render_content()
+        return self.content_html
+
+    @property
+    def markdown_toc(self):
+        if self.content_is_stale():
+            self.render_content()
+        return self.content_toc
 
     @staticmethod
-    def get_published_post(session):
-        result = session.query(Post).filter(
+    def get_published_post(session, profile=None):
+        result = Post.apply_profile(session.query(Post), profile).filter(
             Post.publish_time <= datetime.now() + timedelta(minutes=1),
             Post.status == True
         ).order_by(Post.publish_time.desc())
         return result
 
     @staticmethod
-    def get_object_by_slug(session, slug, field_list=None):
+    def get_object_by_slug(session, slug, field_list=None, profile=None):
         baked_sql = sql_bakery(lambda session: session.query(Post))
         baked_sql += lambda q: q.filter(
             Post.slug == bindparam("slug")
         )
+        if profile:
+            # 加载策略会改变SQL，需要作为缓存键的一部分
+            baked_sql.add_criteria(lambda q: Post.apply_profile(q, profile),
+                                   profile)
         result = baked_sql(session).params(
             slug=slug
         ).one_or_none()
         return result
 
+    @staticmethod
+    def get_id_by_slug(session, slug):
+        """根据slug查询文章id，只使用slug上的索引"""
+        baked_query = sql_bakery(lambda session: session.query(Post.id))
+        baked_query += lambda q: q.filter(
+            Post.slug == bindparam('slug')
+        )
+        return baked_query(session).params(slug=slug).scalar()
+
     @staticmethod
     def exists(title, session):
         """根据标题判断文章是否存在"""
@@ -287,7 +388,6 @@ class Post(ModelAPIMixin, Base):
                 slug = raw_slug + "-" + str(index)
                 index += 1
             else:
-                slug = raw_slug
                 break
         obj = cls(slug=slug, **kwargs)
         if tags:
@@ -295,45 +395,69 @@ class Post(ModelAPIMixin, Base):
         session.add(obj)
         return obj
 
+    @staticmethod
+    def month_range(month):
+        """将`%Y%m`格式的月份转换为`[start, end)`的时间范围，用于`publish_time`的范围查询
+
+        :raise ValueError: 月份格式不正确
+        """
+        start = datetime.strptime(month, "%Y%m")
+        if start.month == 12:
+            end = start.replace(year=start.year + 1, month=1)
+        else:
+            end = start.replace(month=start.month + 1)
+        return start, end
+
     @classmethod
-    def get_archive_month(cls, session):
-        """获取所有有文章发布的月份和这个月份发布的文章数量，用于显示归档(archive)信息
+    def update_view_num(cls, session, views, batch_size=500):
+        """批量更新点击量，每`batch_size`篇文章一条`UPDATE ... CASE`语句
 
-        :return: 返回二维元组(month, article_count)的列表
+        不经过ORM的flush，所以不会触发事件(清除缓存)，也不修改`modified_time`
+
+        :param views: {post_id: view_num}
+        :return: 更新的行数
         """
+        post_ids = sorted(views)
+        rowcount = 0
+        for index in range(0, len(post_ids), batch_size):
+            batch = {post_id: views[post_id]
+                     for post_id in post_ids[index:index + batch_size]}
+            rowcount += session.query(cls).filter(
+                cls.id.in_(list(batch))
+            ).update({
+                cls.view_num: case(batch, value=cls.id),
+                cls.modified_time: cls.modified_time,
+            }, synchronize_session=False)
+        return rowcount
+
+    @classmethod
+    def count_by_month(cls, session):
+        """使用一个`GROUP BY`查询统计每个月发布的文章数量
 
-        final_result = []
-        # 获取所有发布过文章的月份
-        month_baked_sql = sql_bakery(
+        :return: {"%Y%m": article_count}
+        """
+        baked_sql = sql_bakery(
             lambda session: session.query(
                 func.DATE_FORMAT(Post.publish_time, "%Y%m")
-                    .distinct()
-                    .label("publish_month")
-            )
-        )
-        month_baked_sql += lambda q: q.filter(
-            Post.publish_time < bindparam('now')
-        ).order_by(text("publish_month desc"))
-        # 获取特定月份发布的文章数量
-        article_count_query = sql_bakery(
-            lambda session: session.query(
+                    .label("publish_month"),
                 func.COUNT(Post.id)
             )
         )
-        article_count_query += lambda q: q.filter(
-            func.DATE_FORMAT(Post.publish_time, "%Y%m") == bindparam('month')
-        )
+        baked_sql += lambda q: q.filter(
+            Post.status == True,
+            Post.publish_time < bindparam('now')
+        ).group_by(text("publish_month"))
+        return dict(baked_sql(session).params(now=datetime.now()).all())
 
-        month_results = month_baked_sql(session).\
-            params(now=datetime.now()).all()
-        for result in month_results:
-            article_count = article_count_query(session).\
-                                params(month=result.publish_month).scalar()
-            final_result.append(
-                (datetime.strptime(result.publish_month, "%Y%m"),
-                 article_count)
-            )
-        return final_result
+    @classmethod
+    def get_archive_month(cls, session):
+        """获取所有有文章发布的月份和这个月份发布的文章数量，用于显示归档(archive)信息
+
+        数据来自`PostArchive`维护的归档汇总，不存在时才查询数据库
+
+        :return: 返回二维元组(month, article_count)的列表
+        """
+        return PostArchive.get(session)
 
     def to_list_json(self):
         data = {
@@ -343,7 +467,8 @@ class Post(ModelAPIMixin, Base):
             'status': self.status,
             'image': self.image.url,
             'category': self.category.name,
-            'publish_time': self.publish_time
+            'publish_time': self.publish_time,
+            'comment_count': self.comment_count
         }
         return self.jsonify(data)
 
@@ -361,9 +486,17 @@ class Post(ModelAPIMixin, Base):
         }
         return self.jsonify(data)
 
+    def cache_tags(self):
+        """依赖这篇文章的页面缓存标签(文章详情，文章列表和归档)"""
+        return ['post:{0}'.format(self.id), 'post-list', 'archive']
+
 
 class Comment(ModelAPIMixin, Base):
     __tablename__ = 'comment'
+    # 文章详情页按楼层分页读取评论
+    __table_args__ = (
+        Index('ix_comment_post_id_floor', 'post_id', 'floor'),
+    )
 
     id = Column(Integer, primary_key=True)
     email = Column(String(64))
@@ -375,9 +508,10 @@ class Comment(ModelAPIMixin, Base):
 
     # 关联post
     post_id = Column(Integer, ForeignKey('post.id'), nullable=False)
+    # 删除评论时不能级联删除文章，所以不使用'all'
     post = relationship(
         'Post',
-        cascade='all',
+        cascade='save-update, merge',
         backref=backref(
             'comment_set',
             order_by='Comment.floor',
@@ -392,7 +526,31 @@ class Comment(ModelAPIMixin, Base):
         backref=backref('reply', remote_side=id)
     )
 
-    _black_list_key = "_blacklist:comment"     # 评论黑名单的redis set键
+    _black_list_key = comment_limiter.blacklist_key     # 评论黑名单的redis set键
+
+    def cache_tags(self):
+        """评论显示在所属文章的详情页中，评论数量显示在文章列表中"""
+        return ['post:{0}'.format(self.post_id), 'post-list']
+
+    @staticmethod
+    def incr_comment_count(connection, post_id, amount=1, next_floor=False):
+        """通过一条`UPDATE`原子地修改文章的评论数量(不修改`modified_time`)
+
+        :param next_floor: 是否同时把楼层序号加1(插入评论时);
+            并发插入评论时，数据库的行锁保证每个事务读取到的是自己增加以后的序号
+        """
+        post_table = Post.__table__
+        values = {
+            'comment_count': post_table.c.comment_count + amount,
+            'modified_time': post_table.c.modified_time
+        }
+        if next_floor:
+            values['comment_floor_seq'] = post_table.c.comment_floor_seq + 1
+        connection.execute(
+            post_table.update().where(post_table.c.id == post_id).values(
+                **values
+            )
+        )
 
     def avatar(self, size):
         """评论者头像"""
@@ -401,10 +559,82 @@ class Comment(ModelAPIMixin, Base):
             email_md5, urlencode({'s': str(size)})
         )
 
+    def to_thread_json(self):
+        """评论列表("加载更多")中的评论，不包括邮箱和IP"""
+        return {
+            'id': self.id,
+            'floor': self.floor,
+            'title': self.title,
+            'content': self.content,
+            'avatar': self.avatar(60),
+            'status': self.status,
+            'reply_id': self.reply_id,
+            'created_time': self.created_time.strftime('%Y-%m-%d %H:%M:%S')
+            if self.created_time else None,
+        }
+
+    @classmethod
+    def get_thread_query(cls, session, post_id, approved_only=True):
+        """文章的评论，使用`(floor, id)`作为keyset按楼层分页
+
+        :param approved_only: 是否只包括开启(状态为True)的评论
+        """
+        query = session.query(cls).filter(cls.post_id == post_id)
+        if approved_only:
+            query = query.filter(cls.status == True)
+        return query
+
+    @staticmethod
+    def build_threads(comments):
+        """把按楼层排序的评论(通过`reply_id`组成的邻接表)一次遍历组装为回复树
+
+        回复的评论总是在被回复的评论之后，所以遍历到回复时父节点已经存在;
+        被回复的评论不在`comments`中(比如在上一页)时，回复作为根节点
+
+        :return: [(comment, [(reply, [...])...])...]
+        """
+        nodes = {}
+        threads = []
+        for comment in comments:
+            node = nodes[comment.id] = (comment, [])
+            parent = nodes.get(comment.reply_id)
+            (parent[1] if parent is not None else threads).append(node)
+        return threads
+
+    @staticmethod
+    def walk_threads(threads):
+        """深度优先遍历回复树，用于模版中按缩进显示
+
+        :return: [(comment, depth)...]
+        """
+        result = []
+        stack = [(node, 0) for node in reversed(threads)]
+        while stack:
+            (comment, replies), depth = stack.pop()
+            result.append((comment, depth))
+            stack.extend((reply, depth + 1) for reply in reversed(replies))
+        return result
+
+    @classmethod
+    def threads_to_json(cls, threads):
+        """回复树转换为嵌套的字典: `{..., "replies": [...]}`"""
+        result = []
+        stack = [(node, result) for node in reversed(threads)]
+        while stack:
+            (comment, replies), siblings = stack.pop()
+            data = comment.to_thread_json()
+            data['replies'] = []
+            siblings.append(data)
+            stack.extend((reply, data['replies'])
+                         for reply in reversed(replies))
+        return result
+
     @staticmethod
     def comment_restricted(remote_ip):
         """根据对方IP决定是否评论受限
 
+        每个IP每分钟最多评论`comment_limit`条，超过时加入黑名单，
+        黑名单检查和计数在一次Redis往返中完成(见`app.models.rate_limit`)
 
         :param remote_ip: 评论者的IP
         :return: bool，返回评论是否受限
@@ -412,18 +642,637 @@ class Comment(ModelAPIMixin, Base):
         # 判断是否开启评论限制
         if SysConfig.get(**SysConfig.comment_limit_enable) is False:
             return False
+        result = comment_limiter.hit(
+            remote_ip, limit=SysConfig.get(**SysConfig.comment_limit)
+        )
+        return not result.allowed
 
-        # 判断IP是否在黑名单中
-        if redis_cli.sismember(Comment._black_list_key, remote_ip):
-            return True
 
-        # 判断IP是否超过评论限制(1分钟内)，并加入到黑名单中
-        comment_key = "_num:comment:{ip}".format(ip=remote_ip)
-        redis_cli.incr(comment_key)
-        redis_cli.expire(comment_key, 60)
-        if (int(redis_cli.get(comment_key))
-                > SysConfig.get(**SysConfig.comment_limit)):
-            redis_cli.sadd(Comment._black_list_key, remote_ip)
+def track_old_value(target, value, oldvalue, initiator):
+    """只用于开启`active_history`: 过期的属性在修改之前也会先加载旧值，
+    这样`after_update`才能从属性的历史中得到修改前的值
+    """
+
+
+def old_value(state, name):
+    """属性在本次flush之前的值"""
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state.object, name)
+
+
+class PostArchive(object):
+    """文章的归档汇总: 每个月发布的文章数量
+
+    使用Redis哈希存储(`{"%Y%m": article_count}`)，不存在时通过
+    `Post.count_by_month()`重建.
+
+    文章在发布/取消发布/删除/修改发布时间时，在事务提交以后增量更新汇总，
+    回滚时丢弃. 在哈希不存在的时候不做增量更新，等待下一次读取时重建.
+
+    重建期间的增量更新和`ContentCounter`一样通过`building_key`标记检测，
+    有增量更新时放弃这次重建的结果.
+
+    注意: 定时发布(发布时间在本月稍后)的文章会提前计入本月的数量.
+    """
+    key = "_archive:month"
+    building_key = "_archive:month:building"
+    building_expire = 30
+
+    # KEYS: [归档汇总, 重建标记], ARGV: [month1, increment1, month2, increment2...]
+    incr_script = """
+    redis.call('DEL', KEYS[2])
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    for i = 1, #ARGV, 2 do
+        if redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1]) <= 0 then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        end
+    end
+    return 1
+    """
+    _incr = None
+
+    # KEYS: [归档汇总, 重建标记], ARGV: [token, month1, count1, month2, count2...]
+    save_script = """
+    if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1], KEYS[2])
+    for i = 2, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+    """
+    _save = None
+
+    @classmethod
+    def rebuild(cls, session):
+        """从数据库重建归档汇总
+
+        有其它进程正在重建，或者重建期间有增量更新时，只返回统计结果，不写入Redis
+        """
+        token = secrets.token_hex(16)
+        building = redis_cli.set(cls.building_key, token, nx=True,
+                                 ex=cls.building_expire)
+        counts = Post.count_by_month(session)
+        if building:
+            args = [token]
+            for month, count in counts.items():
+                args.extend([month, count])
+            if PostArchive._save is None:
+                PostArchive._save = redis_cli.register_script(
+                    cls.save_script
+                )
+            cls._save(keys=[cls.key, cls.building_key], args=args)
+        return counts
+
+    @classmethod
+    def get(cls, session):
+        """返回(month, article_count)的列表，最近的月份在前"""
+        counts = redis_cli.hgetall(cls.key)
+        if not counts:
+            counts = cls.rebuild(session)
+        current_month = datetime.now().strftime("%Y%m")
+        return [
+            (datetime.strptime(month, "%Y%m"), int(count))
+            for month, count in sorted(counts.items(), reverse=True)
+            if month <= current_month
+        ]
+
+    @classmethod
+    def incr(cls, delta):
+        """增量更新归档汇总
+
+        :param delta: {"%Y%m": increment}
+        """
+        args = []
+        for month, increment in delta.items():
+            if increment:
+                args.extend([month, increment])
+        if not args:
+            return
+        if PostArchive._incr is None:
+            PostArchive._incr = redis_cli.register_script(cls.incr_script)
+        cls._incr(keys=[cls.key, cls.building_key], args=args)
+
+    # SQLAlchemy事件 ----------------------------------------------
+
+    @staticmethod
+    def _month(status, publish_time):
+        """文章计入归档的月份，没有发布时返回None"""
+        if not status or publish_time is None:
+            return None
+        return publish_time.strftime("%Y%m")
+
+    @classmethod
+    def _collect(cls, target, old_month, new_month):
+        if old_month == new_month:
+            return
+        session = object_session(target)
+        if session is None:
+            return
+        delta = session.info.setdefault('archive_delta', {})
+        if old_month:
+            delta[old_month] = delta.get(old_month, 0) - 1
+        if new_month:
+            delta[new_month] = delta.get(new_month, 0) + 1
+
+    @classmethod
+    def after_insert(cls, mapper, connection, target):
+        cls._collect(target, None,
+                     cls._month(target.status, target.publish_time))
+
+    @classmethod
+    def after_update(cls, mapper, connection, target):
+        state = inspect(target)
+        old_month = cls._month(old_value(state, 'status'),
+                               old_value(state, 'publish_time'))
+        cls._collect(target, old_month,
+                     cls._month(target.status, target.publish_time))
+
+    @classmethod
+    def after_delete(cls, mapper, connection, target):
+        cls._collect(target,
+                     cls._month(target.status, target.publish_time), None)
+
+    @classmethod
+    def after_commit(cls, session):
+        delta = session.info.pop('archive_delta', None)
+        if not delta:
+            return
+        # 事务已经提交，Redis出错不能影响请求
+        try:
+            cls.incr(delta)
+        except Exception:
+            gen_log.error('PostArchive.incr() error', exc_info=True)
+            # 丢失了增量，删除汇总，下一次读取时重建
+            try:
+                redis_cli.delete(cls.key)
+            except Exception:
+                pass
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('archive_delta', None)
+
+
+class PostSlugMap(object):
+    """文章slug到id的映射，用于把文章详情页的查询变成主键查询
+
+    - 当前的slug存储在Redis哈希`key`中(`{slug: id}`)，
+      修改过的旧slug存储在`renamed_key`中，访问旧slug时重定向到新的地址
+    - 每个进程在本地保存最近使用的映射(最多`local_size`个)，
+      本地的映射可能过期，所以查询到文章以后要再比较一次slug
+    - 文章新建/修改slug/删除时，在事务提交以后更新Redis，回滚时丢弃;
+      Redis中没有的slug在第一次访问时从数据库中读取
+    """
+    key = "_post:slug"
+    renamed_key = "_post:slug:renamed"
+    local_size = 10000
+    _local = {}
+
+    @classmethod
+    def _remember(cls, slug, post_id):
+        if len(cls._local) >= cls.local_size:
+            cls._local.clear()
+        cls._local[slug] = post_id
+
+    @classmethod
+    def lookup(cls, session, slug):
+        """查询slug(当前的或者修改前的)对应的文章id
+
+        :return: (post_id, renamed)，不存在时post_id为None
+        """
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.hget(cls.key, slug)
+        pipe.hget(cls.renamed_key, slug)
+        post_id, renamed_id = pipe.execute()
+        if post_id is not None:
+            return int(post_id), False
+        if renamed_id is not None:
+            return int(renamed_id), True
+        post_id = Post.get_id_by_slug(session, slug)
+        if post_id is not None:
+            redis_cli.hset(cls.key, slug, post_id)
+        return post_id, False
+
+    @classmethod
+    def get_id(cls, session, slug):
+        """返回slug对应的文章id，不存在或者是修改前的旧slug时返回None"""
+        post_id = cls._local.get(slug)
+        if post_id is not None:
+            return post_id
+        post_id, renamed = cls.lookup(session, slug)
+        if post_id is None or renamed:
+            return None
+        cls._remember(slug, post_id)
+        return post_id
+
+    @classmethod
+    def forget(cls, slug):
+        cls._local.pop(slug, None)
+        pipe = redis_cli.pipeline()
+        pipe.hdel(cls.key, slug)
+        pipe.hdel(cls.renamed_key, slug)
+        pipe.execute()
+
+    @classmethod
+    def get_post(cls, session, slug, profile=None):
+        """根据slug获取文章
+
+        :return: Post对象，不存在时返回None;
+            返回的文章的slug和参数不同时，说明`slug`是修改前的旧slug
+        """
+        post_id = cls._local.get(slug)
+        if post_id is not None:
+            post_obj = Post.get_object_by_id(session, post_id, profile=profile)
+            if post_obj is not None and post_obj.slug == slug:
+                return post_obj
+            # 本进程中的映射已经过期(文章被删除或者修改了slug)
+            cls._local.pop(slug, None)
+
+        post_id, renamed = cls.lookup(session, slug)
+        if post_id is None:
+            return None
+        # 旧的slug只需要得到新的地址，不需要加载整篇文章
+        post_obj = Post.get_object_by_id(session, post_id,
+                                         profile=None if renamed else profile)
+        if post_obj is None:
+            cls.forget(slug)
+        elif post_obj.slug == slug:
+            cls._remember(slug, post_id)
+        return post_obj
+
+    # SQLAlchemy事件 ----------------------------------------------
+
+    @staticmethod
+    def _collect(target, slug, old_slug):
+        session = object_session(target)
+        if session is None:
+            return
+        changes = session.info.setdefault('post_slug', [])
+        changes.append((slug, target.id, old_slug))
+
+    @classmethod
+    def after_insert(cls, mapper, connection, target):
+        cls._collect(target, target.slug, None)
+
+    @classmethod
+    def after_update(cls, mapper, connection, target):
+        slug = old_value(inspect(target), 'slug')
+        if slug != target.slug:
+            cls._collect(target, target.slug, slug)
+
+    @classmethod
+    def after_delete(cls, mapper, connection, target):
+        cls._collect(target, None, target.slug)
+
+    @classmethod
+    def after_commit(cls, session):
+        changes = session.info.pop('post_slug', None)
+        if not changes:
+            return
+        pipe = redis_cli.pipeline()
+        for slug, post_id, old_slug in changes:
+            if old_slug:
+                cls._local.pop(old_slug, None)
+                pipe.hdel(cls.key, old_slug)
+                if slug:
+                    pipe.hset(cls.renamed_key, old_slug, post_id)
+            if slug:
+                cls._local.pop(slug, None)
+                pipe.hset(cls.key, slug, post_id)
+                pipe.hdel(cls.renamed_key, slug)
+        # 事务已经提交，Redis出错不能影响请求;
+        # Redis中过期的映射在查询到文章以后比较slug时会被发现
+        try:
+            pipe.execute()
+        except Exception:
+            gen_log.error('PostSlugMap update error', exc_info=True)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('post_slug', None)
+
+
+class PostRelation(object):
+    """预先计算的文章关系: 相关文章，按发布时间的上一篇/下一篇，系列(集合)内的上一篇/下一篇
+
+    结果以很小的id列表存储在Redis哈希`key`中:
+    `{post_id: '{"related": [id...], "prev": id, "next": id,
+    "series_prev": id, "series_next": id}'}`，
+    文章详情页只需要一次`HGET`和一次主键`IN`查询.
+
+    相关度是标签/分类的加权余弦相似度(稀疏向量): 每个特征的权重为
+    `log(1 + N / df)`，分类的权重再乘以`category_weight`;
+    通过"特征 -> 文章"的倒排表只计算有共同特征的文章对，
+    超过`max_df`篇文章的特征太常见，不参与计算.
+
+    文章新建/删除/修改(状态，发布时间，分类，集合，标签)时在事务提交以后标记`dirty_key`，
+    由Celery定时任务`tasks.cron.update_post_relations`重新计算全部结果.
+    """
+    key = "_post:relation"
+    dirty_key = "_post:relation:dirty"
+    computed_at_key = "_post:relation:computed_at"
+    related_num = 5
+    category_weight = 0.5
+    max_df = 1000
+    # 修改这些属性时需要重新计算
+    related_attrs = ('status', 'publish_time', 'category', 'category_id',
+                     'collection', 'collection_id', 'post_tags')
+
+    @classmethod
+    def _features(cls, session):
+        """发布的文章的(id, 发布时间, 集合id)，和每篇文章的特征集合"""
+        now = datetime.now()
+        posts = session.query(
+            Post.id, Post.publish_time, Post.collection_id, Post.category_id
+        ).filter(
+            Post.status == True,
+            Post.publish_time <= now
+        ).order_by(Post.publish_time, Post.id).all()
+        features = {post_id: set() for post_id, _, _, _ in posts}
+        for post_id, _, _, category_id in posts:
+            if category_id:
+                features[post_id].add(('category', category_id))
+        for post_id, tag_id in session.query(PostTag.post_id, PostTag.tag_id):
+            if post_id in features:
+                features[post_id].add(('tag', tag_id))
+        return posts, features
+
+    @classmethod
+    def compute_related(cls, features):
+        """计算每篇文章最相关的`related_num`篇文章
+
+        :param features: {post_id: set(feature)}
+        :return: {post_id: [related_id...]}
+        """
+        postings = {}
+        for post_id, post_features in features.items():
+            for feature in post_features:
+                postings.setdefault(feature, []).append(post_id)
+        total = len(features)
+        weights = {}
+        for feature, post_ids in postings.items():
+            if len(post_ids) > cls.max_df:
+                continue
+            weight = math.log(1 + total / len(post_ids))
+            if feature[0] == 'category':
+                weight *= cls.category_weight
+            weights[feature] = weight
+        norms = {
+            post_id: math.sqrt(sum(weights.get(feature, 0) ** 2
+                                   for feature in post_features))
+            for post_id, post_features in features.items()
+        }
+
+        related = {}
+        for post_id, post_features in features.items():
+            scores = {}
+            for feature in post_features:
+                weight = weights.get(feature)
+                if weight is None:
+                    continue
+                for other_id in postings[feature]:
+                    if other_id != post_id:
+                        scores[other_id] = (scores.get(other_id, 0) +
+                                            weight * weight)
+            # 相关度相同时，id大的(较新的)文章在前
+            top = heapq.nlargest(
+                cls.related_num, scores.items(),
+                key=lambda item: (item[1] / (norms[item[0]] or 1), item[0])
+            )
+            related[post_id] = [other_id for other_id, _ in top]
+        return related
+
+    @classmethod
+    def compute(cls, session):
+        """计算所有发布的文章的关系
+
+        :return: {post_id: {"related": [...], "prev": ..., "next": ...,
+            "series_prev": ..., "series_next": ...}}
+        """
+        posts, features = cls._features(session)
+        related = cls.compute_related(features)
+        result = {}
+        series = {}
+        for index, (post_id, _, collection_id, _) in enumerate(posts):
+            result[post_id] = {
+                "related": related.get(post_id, []),
+                "prev": posts[index - 1][0] if index > 0 else None,
+                "next": (posts[index + 1][0]
+                         if index + 1 < len(posts) else None),
+                "series_prev": None,
+                "series_next": None,
+            }
+            if collection_id:
+                series.setdefault(collection_id, []).append(post_id)
+        for post_ids in series.values():
+            for prev_id, next_id in zip(post_ids, post_ids[1:]):
+                result[prev_id]["series_next"] = next_id
+                result[next_id]["series_prev"] = prev_id
+        return result
+
+    @classmethod
+    def needs_update(cls, session):
+        """是否需要重新计算: 文章改动过，或者有定时发布的文章在上次计算以后发布了"""
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.exists(cls.dirty_key)
+        pipe.exists(cls.key)
+        pipe.get(cls.computed_at_key)
+        dirty, exists, computed_at = pipe.execute()
+        if dirty or not exists or not computed_at:
             return True
+        computed_at = datetime.fromtimestamp(float(computed_at))
+        published = session.query(Post.id).filter(
+            Post.status == True,
+            Post.publish_time > computed_at,
+            Post.publish_time <= datetime.now()
+        ).first()
+        return published is not None
+
+    @classmethod
+    def update(cls, session, batch_size=1000, cache=None):
+        """重新计算并替换全部结果
+
+        :param cache: 页面缓存类(比如`app.cache.RedisCache`)，
+            替换以后清除关系改变了的文章的页面缓存(`post:<id>`标签)
+        :return: 计算的文章数量
+        """
+        started_at = datetime.now().timestamp()
+        redis_cli.delete(cls.dirty_key)
+        result = cls.compute(session)
+        old_items = redis_cli.hgetall(cls.key)
+        tmp_key = cls.key + ":tmp"
+        pipe = redis_cli.pipeline()
+        pipe.delete(tmp_key)
+        items = [(post_id, json.dumps(value, separators=(',', ':')))
+                 for post_id, value in result.items()]
+        for index in range(0, len(items), batch_size):
+            pipe.hmset(tmp_key, dict(items[index:index + batch_size]))
+        if items:
+            pipe.rename(tmp_key, cls.key)
+        else:
+            pipe.delete(cls.key)
+        pipe.set(cls.computed_at_key, started_at)
+        pipe.execute()
+
+        if cache is not None:
+            changed = {str(post_id) for post_id, value in items
+                       if old_items.pop(str(post_id), None) != value}
+            # 不再发布的文章
+            changed.update(old_items)
+            cls.invalidate_pages(cache, changed)
+        return len(result)
+
+    @staticmethod
+    def invalidate_pages(cache, post_ids):
+        """清除这些文章的页面缓存(详情页显示了相关文章和上一篇/下一篇)"""
+        if not post_ids:
+            return
+        try:
+            cache.invalidate_tags(*['post:{0}'.format(post_id)
+                                    for post_id in sorted(post_ids)])
+        except Exception:
+            gen_log.error('PostRelation invalidate error', exc_info=True)
+
+    @classmethod
+    def get(cls, session, post_id):
+        """文章的关系，值为Post对象(只加载了'link'策略的字段)
+
+        :return: {"related": [Post...], "prev": Post, "next": Post,
+            "series_prev": Post, "series_next": Post}，
+            还没有计算过的文章返回空的结果
+        """
+        value = redis_cli.hget(cls.key, post_id)
+        value = json.loads(value) if value else {}
+        post_ids = set(value.get("related", []))
+        post_ids.update(value.get(name) for name in
+                        ("prev", "next", "series_prev", "series_next"))
+        post_ids.discard(None)
+        posts = {}
+        if post_ids:
+            posts = {
+                post_obj.id: post_obj for post_obj in
+                Post.get_published_post(session, profile='link').filter(
+                    Post.id.in_(post_ids)
+                )
+            }
+        data = {
+            "related": [posts[related_id]
+                        for related_id in value.get("related", [])
+                        if related_id in posts]
+        }
+        for name in ("prev", "next", "series_prev", "series_next"):
+            data[name] = posts.get(value.get(name))
+        return data
+
+    # SQLAlchemy事件 ----------------------------------------------
+
+    @staticmethod
+    def _collect(target):
+        session = object_session(target)
+        if session is not None:
+            session.info['post_relation_dirty'] = True
+
+    @classmethod
+    def after_insert(cls, mapper, connection, target):
+        cls._collect(target)
+
+    @classmethod
+    def after_update(cls, mapper, connection, target):
+        attrs = inspect(target).attrs
+        if any(attrs[name].history.has_changes()
+               for name in cls.related_attrs):
+            cls._collect(target)
+
+    @classmethod
+    def after_delete(cls, mapper, connection, target):
+        cls._collect(target)
+
+    @classmethod
+    def after_commit(cls, session):
+        if not session.info.pop('post_relation_dirty', None):
+            return
+        # 事务已经提交，Redis出错不能影响请求
+        try:
+            redis_cli.set(cls.dirty_key, 1)
+        except Exception:
+            gen_log.error('PostRelation mark dirty error', exc_info=True)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('post_relation_dirty', None)
+
+
+def render_stale_content(mapper, connection, target):
+    """保存文章之前，如果渲染结果已经过期就重新渲染"""
+    if target.content_is_stale():
+        target.render_content()
+
+
+def render_changed_content(mapper, connection, target):
+    """更新文章之前，只有content改变时才检查渲染结果(避免加载延迟加载的正文)"""
+    if inspect(target).attrs.content.history.has_changes():
+        render_stale_content(mapper, connection, target)
+
+
+def assign_comment_floor(mapper, connection, target):
+    """插入评论之前把文章的楼层序号加1作为楼层，开启的评论同时增加文章的评论数量
+
+    楼层总是在这里分配，`comment_set`的`ordering_list`按列表位置设置的楼层会被覆盖
+    """
+    post_id = target.post_id if target.post_id is not None else target.post.id
+    approved = target.status is None or target.status
+    Comment.incr_comment_count(connection, post_id, 1 if approved else 0,
+                               next_floor=True)
+    post_table = Post.__table__
+    target.floor = connection.execute(
+        select([post_table.c.comment_floor_seq]).where(
+            post_table.c.id == post_id
+        )
+    ).scalar()
+
+
+def update_comment_count(mapper, connection, target):
+    """开启/关闭评论时修改文章的评论数量"""
+    approved = bool(target.status)
+    if bool(old_value(inspect(target), 'status')) != approved:
+        Comment.incr_comment_count(connection, target.post_id,
+                                   1 if approved else -1)
+
+
+def decr_comment_count(mapper, connection, target):
+    if target.status:
+        Comment.incr_comment_count(connection, target.post_id, -1)
+
 
-        return False
+event.listen(Post, 'before_insert', render_stale_content)
+event.listen(Post, 'before_update', render_changed_content)
+event.listen(Post.status, 'set', track_old_value, active_history=True)
+event.listen(Post.publish_time, 'set', track_old_value, active_history=True)
+event.listen(Post.slug, 'set', track_old_value, active_history=True)
+event.listen(Comment.status, 'set', track_old_value, active_history=True)
+event.listen(Comment, 'before_insert', assign_comment_floor)
+event.listen(Comment, 'after_update', update_comment_count)
+event.listen(Comment, 'after_delete', decr_comment_count)
+event.listen(Post, 'after_insert', PostArchive.after_insert)
+event.listen(Post, 'after_update', PostArchive.after_update)
+event.listen(Post, 'after_delete', PostArchive.after_delete)
+event.listen(Session, 'after_commit', PostArchive.after_commit)
+event.listen(Session, 'after_rollback', PostArchive.after_rollback)
+event.listen(Post, 'after_insert', PostSlugMap.after_insert)
+event.listen(Post, 'after_update', PostSlugMap.after_update)
+event.listen(Post, 'after_delete', PostSlugMap.after_delete)
+event.listen(Session, 'after_commit', PostSlugMap.after_commit)
+event.listen(Session, 'after_rollback', PostSlugMap.after_rollback)
+event.listen(Post, 'after_insert', PostRelation.after_insert)
+event.listen(Post, 'after_update', PostRelation.after_update)
+event.listen(Post, 'after_delete', PostRelation.after_delete)
+event.listen(Session, 'after_commit', PostRelation.after_commit)
+event.listen(Session, 'after_rollback', PostRelation.after_rollback)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""频率限制
+
+令牌桶算法: 每个限制对象(比如IP，用户id)一个桶，容量为`limit`，
+每`period`秒匀速补满，每次操作消耗`cost`个令牌，令牌不足时拒绝.
+
+Redis中的实现是一个Lua脚本，一次往返完成黑名单检查，补充令牌，扣除令牌和加入黑名单，
+并发的请求之间不会出现竞争. 测试时可以换成进程内的`LocalBackend`.
+"""
+import math
+import time
+import threading
+from collections import namedtuple
+
+from tornado.log import gen_log
+
+from .base import redis_cli
+
+__all__ = ['RateLimitResult', 'RedisBackend', 'LocalBackend', 'RateLimiter',
+           'comment_limiter', 'login_limiter', 'api_write_limiter']
+
+# allowed: 是否允许，remaining: 剩余的令牌数，
+# retry_after: 多少秒以后可以重试(-1表示在黑名单中)
+RateLimitResult = namedtuple('RateLimitResult',
+                             ['allowed', 'remaining', 'retry_after'])
+
+
+class RedisBackend(object):
+    """Redis实现，每个限制对象是一个哈希`{tokens, ts}`"""
+    client = redis_cli
+
+    # KEYS: [令牌桶, 黑名单集合]
+    # ARGV: [限制对象, 容量, 周期(秒), 当前时间(秒), 消耗, 是否使用黑名单]
+    # 返回: {是否允许, 剩余令牌数, 重试等待时间(毫秒，-1表示在黑名单中)}
+    hit_script = """
+    local blacklist = ARGV[6] == '1'
+    if blacklist and redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+        return {0, 0, -1}
+    end
+    local capacity = tonumber(ARGV[2])
+    local period = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local cost = tonumber(ARGV[5])
+    local rate = capacity / period
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local need = math.max(cost, 1)
+    if tokens < need then
+        if blacklist and cost > 0 then
+            redis.call('SADD', KEYS[2], ARGV[1])
+            return {0, 0, -1}
+        end
+        return {0, math.floor(tokens), math.ceil((need - tokens) / rate * 1000)}
+    end
+    if cost > 0 then
+        tokens = tokens - cost
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(period * 1000))
+    end
+    return {1, math.floor(tokens), 0}
+    """
+    _hit = None
+
+    def hit(self, key, blacklist_key, identity, limit, period, cost):
+        if RedisBackend._hit is None:
+            RedisBackend._hit = self.client.register_script(self.hit_script)
+        allowed, remaining, retry_after = self._hit(
+            keys=[key, blacklist_key or key],
+            args=[identity, limit, period, time.time(), cost,
+                  1 if blacklist_key else 0]
+        )
+        if retry_after > 0:
+            retry_after = retry_after / 1000
+        return RateLimitResult(bool(allowed), remaining, retry_after)
+
+    def reset(self, key):
+        self.client.delete(key)
+
+    def unblock(self, blacklist_key, identity):
+        self.client.srem(blacklist_key, identity)
+
+
+class LocalBackend(object):
+    """进程内的实现(和`RedisBackend`的行为一致)，用于测试或者单进程部署"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}      # {key: (tokens, ts)}
+        self._blacklists = {}   # {blacklist_key: set(identity)}
+
+    def hit(self, key, blacklist_key, identity, limit, period, cost):
+        now = time.time()
+        rate = limit / period
+        with self._lock:
+            blacklist = (self._blacklists.setdefault(blacklist_key, set())
+                         if blacklist_key else None)
+            if blacklist is not None and identity in blacklist:
+                return RateLimitResult(False, 0, -1)
+            tokens, ts = self._buckets.get(key, (limit, now))
+            tokens = min(limit, tokens + max(0, now - ts) * rate)
+            need = max(cost, 1)
+            if tokens < need:
+                if blacklist is not None and cost > 0:
+                    blacklist.add(identity)
+                    return RateLimitResult(False, 0, -1)
+                return RateLimitResult(False, math.floor(tokens),
+                                       (need - tokens) / rate)
+            if cost > 0:
+                tokens -= cost
+                self._buckets[key] = (tokens, now)
+        return RateLimitResult(True, math.floor(tokens), 0)
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def unblock(self, blacklist_key, identity):
+        with self._lock:
+            self._blacklists.get(blacklist_key, set()).discard(identity)
+
+
+class RateLimiter(object):
+    """频率限制器
+
+    >>> limiter = RateLimiter('login', limit=10, period=300)
+    >>> limiter.hit(remote_ip).allowed
+
+    :param name: 名称，用于键名和统计
+    :param limit: 令牌桶的容量(一个周期内最多允许的次数)
+    :param period: 补满令牌桶的时间(秒)
+    :param blacklist_key:
+        黑名单集合的键，设置以后超过限制的对象会被加入黑名单，之后一直被拒绝，
+        直到调用`unblock()`
+    """
+    prefix = "_ratelimit"
+    backend = RedisBackend()
+    registry = {}       # {name: RateLimiter}，用于监控
+
+    def __init__(self, name, limit, period, blacklist_key=None):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.blacklist_key = blacklist_key
+        self._lock = threading.Lock()
+        self.counters = {
+            "allowed": 0,
+            "limited": 0,
+            "blocked": 0,
+            "errors": 0,
+        }
+        RateLimiter.registry[name] = self
+
+    @classmethod
+    def use_backend(cls, backend):
+        """替换所有限制器的实现，比如测试时使用`LocalBackend()`"""
+        RateLimiter.backend = backend
+
+    def _key(self, identity):
+        return "{0}:{1}:{2}".format(self.prefix, self.name, identity)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def hit(self, identity, cost=1, limit=None):
+        """消耗`cost`个令牌
+
+        Redis出错时允许这次操作(限制频率不应该影响正常使用)
+
+        :param limit: 这次检查使用的容量，默认为`self.limit`，用于可以修改的配置
+        :return: `RateLimitResult`
+        """
+        limit = limit or self.limit
+        try:
+            result = self.backend.hit(self._key(identity), self.blacklist_key,
+                                      identity, limit, self.period, cost)
+        except Exception:
+            self._count('errors')
+            gen_log.error('RateLimiter(%s).hit() error', self.name,
+                          exc_info=True)
+            return RateLimitResult(True, limit, 0)
+        if result.allowed:
+            self._count('allowed')
+        elif result.retry_after < 0:
+            self._count('blocked')
+        else:
+            self._count('limited')
+        return result
+
+    def peek(self, identity, limit=None):
+        """检查是否还有令牌，不消耗令牌"""
+        return self.hit(identity, cost=0, limit=limit)
+
+    def reset(self, identity):
+        """清空限制对象的计数(不会从黑名单中删除)"""
+        self.backend.reset(self._key(identity))
+
+    def unblock(self, identity):
+        """从黑名单中删除"""
+        if self.blacklist_key:
+            self.backend.unblock(self.blacklist_key, identity)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, limit=self.limit, period=self.period)
+
+    @classmethod
+    def all_stats(cls):
+        return {name: limiter.stats()
+                for name, limiter in cls.registry.items()}
+
+
+# 评论: 每个IP每分钟的评论数量(容量由系统配置`comment_limit`决定)，超过时加入黑名单
+comment_limiter = RateLimiter('comment', limit=20, period=60,
+                              blacklist_key="_blacklist:comment")
+# 登录: 每个IP的登录失败次数，登录成功时清空
+login_limiter = RateLimiter('login', limit=10, period=300)
+# API的写操作(POST/PUT/PATCH/DELETE): 每个用户每分钟的次数
+api_write_limiter = RateLimiter('api_write', limit=120, period=60)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import math
+import hashlib
+from collections import Counter
+
+from tornado.log import gen_log
+from redis import WatchError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session, subqueryload, undefer
+
+from .base import redis_cli, Session
+from .post import Post
+from ..libs.search import tokenize, strip_markdown
+
+__all__ = ['PostSearchIndex']
+
+
+class PostSearchIndex(object):
+    """文章的全文搜索: Redis中的倒排索引，BM25排序
+
+    索引的内容是发布(状态为True)的文章的标题，标签，简介和正文(去掉markdown标记)，
+    分词方式见`app.libs.search.tokenize()`.
+
+    - `_search:term:<term>`: 有序集合，{post_id: 词在文章中的BM25权重(不含idf)}
+    - `_search:doc`: 哈希，{post_id: 文章包含的词(空格分隔)}，更新/删除时使用;
+      比每篇文章一个集合节省很多内存
+    - `_search:doclen`: 哈希，{post_id: 文章的长度(词数)}
+    - `_search:total_len`: 所有文章的总长度，用于计算平均长度
+    - `_search:version`: 索引的版本，每次修改加1
+
+    文章的长度归一化在建立索引时使用当时的平均长度计算，
+    平均长度变化较大以后可以通过`rebuild()`重建.
+
+    搜索时根据文档频率计算每个词的idf，再通过一次`ZUNIONSTORE ... WEIGHTS`
+    在Redis中合并打分，结果(以索引版本和查询词为键)缓存`result_expire`秒，
+    翻页只需要`ZREVRANGE`.
+
+    文章新建/修改/删除时，在事务提交以后增量更新索引.
+    """
+    prefix = "_search"
+    term_key = "_search:term:"
+    doc_key = "_search:doc"
+    doclen_key = "_search:doclen"
+    total_len_key = "_search:total_len"
+    version_key = "_search:version"
+    result_key = "_search:result:{version}:{digest}"
+
+    k1 = 1.2
+    b = 0.75
+    # (字段, 权重): 标题/标签中的词在词频中多计几次
+    field_weights = (('title', 3), ('tags', 2), ('brief', 1), ('content', 1))
+    # 修改这些属性时才需要重建文章的索引
+    indexed_attrs = ('title', 'brief', 'content', 'status', 'post_tags')
+    max_query_terms = 16
+    result_expire = 60
+
+    @classmethod
+    def document(cls, post_obj):
+        """文章的(加权的)词频和长度
+
+        :return: (Counter({term: weighted_tf}), length)
+        """
+        term_freq = Counter()
+        length = 0
+        for name, weight in cls.field_weights:
+            if name == 'tags':
+                text = ' '.join(tag.name for tag in post_obj.tags)
+            elif name == 'content':
+                text = strip_markdown(post_obj.content)
+            else:
+                text = getattr(post_obj, name)
+            tokens = tokenize(text, unigrams=True)
+            length += len(tokens)
+            for token in tokens:
+                term_freq[token] += weight
+        return term_freq, length
+
+    @classmethod
+    def _write(cls, pipe, post_id, term_freq, length, avg_length):
+        norm = cls.k1 * (1 - cls.b + cls.b * length / (avg_length or 1))
+        for term, freq in term_freq.items():
+            score = freq * (cls.k1 + 1) / (freq + norm)
+            pipe.zadd(cls.term_key + term, round(score, 6), post_id)
+        pipe.hset(cls.doc_key, post_id, ' '.join(term_freq))
+        pipe.hset(cls.doclen_key, post_id, length)
+        pipe.incrby(cls.total_len_key, length)
+
+    @classmethod
+    def _avg_length(cls, length):
+        """再加入一篇长度为`length`的文章以后的平均长度"""
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.get(cls.total_len_key)
+        pipe.hlen(cls.doclen_key)
+        total_len, doc_count = pipe.execute()
+        return (int(total_len or 0) + length) / (doc_count + 1)
+
+    @classmethod
+    def remove(cls, post_id):
+        """从索引中删除一篇文章
+
+        `remove()`/`index()`不修改索引版本，由调用者在修改完成以后调用`incr_version()`
+
+        读取文章包含的词以后在一个`MULTI`事务中删除，
+        `WATCH`文章的词哈希，期间有其它修改时重试
+        """
+        with redis_cli.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(cls.doc_key, cls.doclen_key)
+                    terms = pipe.hget(cls.doc_key, post_id)
+                    length = pipe.hget(cls.doclen_key, post_id)
+                    pipe.multi()
+                    for term in (terms or '').split():
+                        pipe.zrem(cls.term_key + term, post_id)
+                    pipe.hdel(cls.doc_key, post_id)
+                    if length is not None:
+                        pipe.hdel(cls.doclen_key, post_id)
+                        pipe.decr(cls.total_len_key, length)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+    @classmethod
+    def index(cls, post_obj):
+        """(重新)建立一篇文章的索引，没有发布的文章只从索引中删除"""
+        cls.remove(post_obj.id)
+        if post_obj.status:
+            term_freq, length = cls.document(post_obj)
+            pipe = redis_cli.pipeline()
+            cls._write(pipe, post_obj.id, term_freq, length,
+                       cls._avg_length(length))
+            pipe.execute()
+
+    @classmethod
+    def incr_version(cls):
+        """索引修改以后增加版本，缓存的搜索结果随之失效"""
+        redis_cli.incr(cls.version_key)
+
+    @classmethod
+    def _query_posts(cls, session):
+        return session.query(Post).options(
+            undefer('content'),
+            subqueryload('post_tags').joinedload('tag'),
+        )
+
+    @classmethod
+    def update(cls, session, post_ids):
+        """重新建立`post_ids`中的文章的索引，已经删除的文章从索引中删除"""
+        post_list = cls._query_posts(session).filter(
+            Post.id.in_(list(post_ids))
+        ).all()
+        for post_obj in post_list:
+            cls.index(post_obj)
+        for post_id in set(post_ids) - {post_obj.id for post_obj in post_list}:
+            cls.remove(post_id)
+        cls.incr_version()
+
+    @classmethod
+    def _iter_posts(cls, session, batch_size):
+        """按id分批读取所有发布的文章"""
+        last_id = 0
+        while True:
+            post_list = cls._query_posts(session).filter(
+                Post.status == True,
+                Post.id > last_id
+            ).order_by(Post.id).limit(batch_size).all()
+            if not post_list:
+                return
+            for post_obj in post_list:
+                yield post_obj
+            last_id = post_list[-1].id
+            session.expunge_all()
+
+    @classmethod
+    def rebuild(cls, session, batch_size=200):
+        """重建整个索引
+
+        需要读取两遍文章: 第一遍计算平均长度，第二遍写入索引.
+        重建的过程中搜索结果是不完整的.
+
+        :return: 建立索引的文章数量
+        """
+        lengths = {}
+        for post_obj in cls._iter_posts(session, batch_size):
+            lengths[post_obj.id] = cls.document(post_obj)[1]
+        avg_length = sum(lengths.values()) / (len(lengths) or 1)
+
+        keys = list(redis_cli.scan_iter(match=cls.prefix + ':*', count=500))
+        for index in range(0, len(keys), 500):
+            redis_cli.delete(*keys[index:index + 500])
+
+        pipe = redis_cli.pipeline(transaction=False)
+        for count, post_obj in enumerate(cls._iter_posts(session, batch_size),
+                                         start=1):
+            term_freq, length = cls.document(post_obj)
+            cls._write(pipe, post_obj.id, term_freq, length, avg_length)
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.incr(cls.version_key)
+        pipe.execute()
+        return len(lengths)
+
+    @classmethod
+    def search(cls, keyword, offset=0, limit=10):
+        """搜索文章
+
+        :return: (total, [(post_id, score)...])，按相关度从高到低排序
+        """
+        terms = sorted(set(tokenize(keyword)))[:cls.max_query_terms]
+        if not terms:
+            return 0, []
+        digest = hashlib.sha1('\x00'.join(terms).encode()).hexdigest()
+        version = redis_cli.get(cls.version_key) or '0'
+        result_key = cls.result_key.format(version=version, digest=digest)
+
+        if not redis_cli.exists(result_key):
+            pipe = redis_cli.pipeline(transaction=False)
+            pipe.hlen(cls.doclen_key)
+            for term in terms:
+                pipe.zcard(cls.term_key + term)
+            doc_count, *doc_freqs = pipe.execute()
+            weights = {
+                cls.term_key + term: math.log(
+                    1 + (doc_count - df + 0.5) / (df + 0.5)
+                )
+                for term, df in zip(terms, doc_freqs) if df
+            }
+            if not weights:
+                return 0, []
+            pipe = redis_cli.pipeline()
+            pipe.zunionstore(result_key, weights)
+            pipe.expire(result_key, cls.result_expire)
+            pipe.execute()
+
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.zcard(result_key)
+        pipe.zrevrange(result_key, offset, offset + limit - 1,
+                       withscores=True)
+        total, items = pipe.execute()
+        return total, [(int(post_id), score) for post_id, score in items]
+
+    @classmethod
+    def search_posts(cls, session, keyword, offset=0, limit=10,
+                     profile=None):
+        """搜索发布的文章
+
+        :return: (total, post_list)，`total`是索引中匹配的文章数量(包括定时发布的)
+        """
+        total, items = cls.search(keyword, offset, limit)
+        if not items:
+            return total, []
+        post_ids = [post_id for post_id, _ in items]
+        posts = {
+            post_obj.id: post_obj for post_obj in
+            Post.get_published_post(session, profile).filter(
+                Post.id.in_(post_ids)
+            )
+        }
+        return total, [posts[post_id] for post_id in post_ids
+                       if post_id in posts]
+
+    # SQLAlchemy事件 ----------------------------------------------
+
+    @staticmethod
+    def _collect(target):
+        session = object_session(target)
+        if session is None:
+            return
+        session.info.setdefault('search_dirty', set()).add(target.id)
+
+    @classmethod
+    def after_insert(cls, mapper, connection, target):
+        cls._collect(target)
+
+    @classmethod
+    def after_update(cls, mapper, connection, target):
+        attrs = inspect(target).attrs
+        if any(attrs[name].history.has_changes()
+               for name in cls.indexed_attrs):
+            cls._collect(target)
+
+    @classmethod
+    def after_delete(cls, mapper, connection, target):
+        cls._collect(target)
+
+    @classmethod
+    def after_commit(cls, session):
+        post_ids = session.info.pop('search_dirty', None)
+        if not post_ids:
+            return
+        # 提交以后原来的session不能再执行SQL，使用一个新的session读取文章
+        index_session = Session(bind=session.bind)
+        try:
+            cls.update(index_session, post_ids)
+        except Exception:
+            # 索引可以通过`manager.py search rebuild`重建，不影响请求
+            gen_log.error('PostSearchIndex.update() error', exc_info=True)
+        finally:
+            index_session.close()
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_dirty', None)
+
+
+event.listen(Post, 'after_insert', PostSearchIndex.after_insert)
+event.listen(Post, 'after_update', PostSearchIndex.after_update)
+event.listen(Post, 'after_delete', PostSearchIndex.after_delete)
+event.listen(Session, 'after_commit', PostSearchIndex.after_commit)
+event.listen(Session, 'after_rollback', PostSearchIndex.after_rollback)
@@ -1,135 +1,396 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import os
 import datetime
+import secrets
+import threading
+from collections import namedtuple
 
 import arrow
 
-from sqlalchemy import func, bindparam
+from tornado.ioloop import PeriodicCallback
+from tornado.log import gen_log
+from sqlalchemy import func, event, inspect
+from sqlalchemy.orm import object_session
 
-from .base import redis_cli
+from .base import redis_cli, Session
 from .base import sql_bakery
-from .post import Post, Comment
+from .post import Post, Comment, track_old_value, old_value
 from ..libs.utils import get_next_weekday
 
 
+# 首页显示的统计信息，不可变，可以在多个请求之间共享
+BaseStats = namedtuple('BaseStats', [
+    'pv', 'pv_today', 'uv', 'uv_today', 'post_count', 'post_origin_count',
+    'post_reproduce_count', 'post_translation_count', 'comment_count',
+])
+
+
+class ContentCounter(object):
+    """文章/评论数量的计数器
+
+    使用Redis哈希存储(`{field: count}`):
+
+    - post: 发布(状态为True)的文章数量
+    - post:<type>: 各类型发布的文章数量
+    - comment: 状态为True的评论数量
+
+    不存在时通过一次`GROUP BY type`查询重建. 文章/评论在新建/删除/
+    修改状态(或类型)时，在事务提交以后增量更新，回滚时丢弃.
+
+    重建期间(统计数据库和写入Redis之间)的增量更新会丢失，所以重建时先设置
+    `building_key`标记，增量更新时删除这个标记，重建只在标记没有变化时写入结果.
+    """
+    key = "_stats:count"
+    building_key = "_stats:count:building"
+    building_expire = 30
+    fields = ('post', 'post:origin', 'post:reproduce', 'post:translation',
+              'comment')
+
+    # KEYS: [计数器, 重建标记], ARGV: [field1, increment1, field2, increment2...]
+    incr_script = """
+    redis.call('DEL', KEYS[2])
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    for i = 1, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+    """
+    _incr = None
+
+    # KEYS: [计数器, 重建标记], ARGV: [token, field1, count1, field2, count2...]
+    save_script = """
+    if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1], KEYS[2])
+    for i = 2, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+    """
+    _save = None
+
+    @classmethod
+    def count(cls, session):
+        """从数据库统计各个计数"""
+        counts = dict.fromkeys(cls.fields, 0)
+        post_count_sql = sql_bakery(lambda session: session.query(
+            Post.type, func.count(Post.id)
+        ).filter(
+            Post.status == True
+        ).group_by(Post.type))
+        for post_type, num in post_count_sql(session).all():
+            counts['post'] += num
+            if post_type is not None:
+                counts['post:' + cls._code(post_type)] = num
+
+        comment_count_sql = sql_bakery(lambda session: session.query(
+            func.count(Comment.id)
+        ).filter(
+            Comment.status == True
+        ))
+        counts['comment'] = comment_count_sql(session).scalar()
+        return counts
+
+    @classmethod
+    def rebuild(cls, session):
+        """从数据库重建计数器
+
+        有其它进程正在重建，或者重建期间有增量更新时，只返回统计结果，不写入Redis
+        """
+        token = secrets.token_hex(16)
+        building = redis_cli.set(cls.building_key, token, nx=True,
+                                 ex=cls.building_expire)
+        counts = cls.count(session)
+        if building:
+            args = [token]
+            for field, count in counts.items():
+                args.extend([field, count])
+            if ContentCounter._save is None:
+                ContentCounter._save = redis_cli.register_script(
+                    cls.save_script
+                )
+            cls._save(keys=[cls.key, cls.building_key], args=args)
+        return counts
+
+    @classmethod
+    def incr(cls, delta):
+        """增量更新计数器，计数器不存在时不做修改(等待下一次读取时重建)"""
+        args = []
+        for field, increment in delta.items():
+            if increment:
+                args.extend([field, increment])
+        if not args:
+            return
+        if ContentCounter._incr is None:
+            ContentCounter._incr = redis_cli.register_script(cls.incr_script)
+        cls._incr(keys=[cls.key, cls.building_key], args=args)
+
+    # SQLAlchemy事件 ----------------------------------------------
+
+    @staticmethod
+    def _code(post_type):
+        """`ChoiceType`的值可能是`Choice`对象，也可能是刚赋值的字符串"""
+        return getattr(post_type, 'code', post_type)
+
+    @classmethod
+    def _post_fields(cls, status, post_type):
+        if not status:
+            return []
+        if post_type is None:
+            return ['post']
+        return ['post', 'post:' + cls._code(post_type)]
+
+    @staticmethod
+    def _comment_fields(status):
+        return ['comment'] if status else []
+
+    @staticmethod
+    def _collect(target, old_fields, new_fields):
+        if old_fields == new_fields:
+            return
+        session = object_session(target)
+        if session is None:
+            return
+        delta = session.info.setdefault('content_count_delta', {})
+        for field in old_fields:
+            delta[field] = delta.get(field, 0) - 1
+        for field in new_fields:
+            delta[field] = delta.get(field, 0) + 1
+
+    @classmethod
+    def post_after_insert(cls, mapper, connection, target):
+        cls._collect(target, [],
+                     cls._post_fields(target.status, target.type))
+
+    @classmethod
+    def post_after_update(cls, mapper, connection, target):
+        state = inspect(target)
+        cls._collect(target,
+                     cls._post_fields(old_value(state, 'status'),
+                                      old_value(state, 'type')),
+                     cls._post_fields(target.status, target.type))
+
+    @classmethod
+    def post_after_delete(cls, mapper, connection, target):
+        cls._collect(target,
+                     cls._post_fields(target.status, target.type), [])
+
+    @classmethod
+    def comment_after_insert(cls, mapper, connection, target):
+        cls._collect(target, [], cls._comment_fields(target.status))
+
+    @classmethod
+    def comment_after_update(cls, mapper, connection, target):
+        cls._collect(target,
+                     cls._comment_fields(old_value(inspect(target), 'status')),
+                     cls._comment_fields(target.status))
+
+    @classmethod
+    def comment_after_delete(cls, mapper, connection, target):
+        cls._collect(target, cls._comment_fields(target.status), [])
+
+    @classmethod
+    def after_commit(cls, session):
+        delta = session.info.pop('content_count_delta', None)
+        if not delta:
+            return
+        # 事务已经提交，Redis出错不能影响请求
+        try:
+            cls.incr(delta)
+        except Exception:
+            gen_log.error('ContentCounter.incr() error', exc_info=True)
+            # 丢失了增量，删除计数器，下一次读取时重建
+            try:
+                redis_cli.delete(cls.key)
+            except Exception:
+                pass
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('content_count_delta', None)
+
+
 class SiteStats(object):
-    """网站的数据统计/分析"""
+    """网站的数据统计/分析
+
+    UV使用Redis的HyperLogLog(`PFADD`/`PFCOUNT`)统计，
+    每个HyperLogLog最多占用12KB内存，和访问者的数量无关，
+    代价是结果是近似值: 标准误差为0.81%.
+
+    在`manager.py stats migrate-uv`完成(设置`uv_migrated`标记)之前，
+    存在旧的UV计数器时仍然使用旧的计数器，避免历史UV从总数中消失.
+    """
     _prefix = '_stats'
-    access_ip = "_stats:access:ip"
-    access_ip_day = "_stats:access:ip:{day}"
+    access_ip = "_stats:access:ip"                  # 已废弃，见`migrate_uv()`
+    access_ip_day = "_stats:access:ip:{day}"        # 已废弃，见`migrate_uv()`
     pv_amount = "_stats:pv:amount"
     pv_day = "_stats:pv:{day}"
-    uv_amount = "_stats:uv:amount"
-    uv_day = "_stats:uv:{day}"
+    uv_amount = "_stats:uv:amount"                  # 旧的UV计数器
+    uv_day = "_stats:uv:{day}"                      # 旧的UV计数器
+    uv_hll_amount = "_stats:uv:hll:amount"
+    uv_hll_day = "_stats:uv:hll:{day}"
+    uv_hll_range = "_stats:uv:hll:{start}:{end}"
+    uv_migrated = "_stats:uv:hll:migrated"          # 旧的IP集合已经转换完成
     ua_day = "_stats:access:ua:{day}"
+    post_view = "_stats:post:view:{id}"
+    post_view_dirty = "_stats:post:view:dirty"      # 有新点击的文章id
+    uv_hll_day_keep_days = 62   # 每日UV的HyperLogLog保留的天数(用于计算月UV)
+    uv_hll_range_expire = 60 * 10
 
     @classmethod
     def generate_key(cls, key):
         """生成加入前缀的KEY"""
         return "{0}:{1}".format(cls._prefix, key)
 
+    @staticmethod
+    def _pick_uv(hll_exists, hll_value, counter_value, migrated):
+        """选择HyperLogLog或者旧的计数器的UV数据"""
+        if hll_exists and (migrated or counter_value is None):
+            return int(hll_value)
+        return int(counter_value or 0)
+
     @classmethod
     def get_base_info(cls, session):
         """返回基本的统计信息，用于首页显示
 
-        :return:
+        PV和旧的UV计数器使用一次`MGET`读取，和UV的HyperLogLog，
+        文章/评论的计数器(`ContentCounter`)一起在一个pipeline中完成，
+        只在计数器不存在时查询数据库.
+
+        :return: `BaseStats`
 
             - pv: 总pv数据
             - pv_today: 今天的pv数据
-            - uv: 总uv数据
-            - uv_today: 今天的uv数据
+            - uv: 总uv数据(HyperLogLog近似值，标准误差0.81%)
+            - uv_today: 今天的uv数据(HyperLogLog近似值，标准误差0.81%)
             - post_count: 总博客数量(状态为True)
             - post_origin_count: 原创类型博客数量
             - post_reproduce_count: 转载类型博客数量
             - post_translation_count: 翻译类型博客数量
             - comment_count: 评论数量
         """
-        # post总数
-        post_count_sql = sql_bakery(lambda session: session.query(
-            func.count(Post.id)
-        ).filter(
-            Post.status == True
-        ))
-        post_count = post_count_sql(session).scalar()
-
-        post_count_sql += lambda q: q.filter(
-            Post.type == bindparam("type")
+        today = str(datetime.date.today())
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.mget(cls.pv_amount, cls.pv_day.format(day=today),
+                  cls.uv_amount, cls.uv_day.format(day=today),
+                  cls.uv_migrated)
+        for hll_key in (cls.uv_hll_amount, cls.uv_hll_day.format(day=today)):
+            pipe.exists(hll_key)
+            pipe.pfcount(hll_key)
+        pipe.hgetall(ContentCounter.key)
+        (values, uv_exists, uv, uv_today_exists, uv_today,
+         counts) = pipe.execute()
+        pv, pv_today, uv_counter, uv_today_counter, migrated = values
+        if not all(field in counts for field in ContentCounter.fields):
+            counts = ContentCounter.rebuild(session)
+
+        return BaseStats(
+            pv=int(pv or 0),
+            pv_today=int(pv_today or 0),
+            uv=cls._pick_uv(uv_exists, uv, uv_counter, migrated),
+            uv_today=cls._pick_uv(uv_today_exists, uv_today,
+                                  uv_today_counter, migrated),
+            post_count=int(counts['post']),
+            post_origin_count=int(counts['post:origin']),
+            post_reproduce_count=int(counts['post:reproduce']),
+            post_translation_count=int(counts['post:translation']),
+            comment_count=int(counts['comment']),
         )
-        # 转载数量
-        post_reproduce_count = post_count_sql(
-            session
-        ).params(
-            type='reproduce'
-        ).scalar()
-        # 原创数量
-        post_origin_count = post_count_sql(
-            session
-        ).params(
-            type='origin'
-        ).scalar()
-        # 翻译数量
-        post_translation_count = post_count_sql(
-            session
-        ).params(
-            type='translation'
-        ).scalar()
-
-        # 评论数量
-        comment_count_sql = sql_bakery(lambda session: session.query(
-            func.count(Comment.id)
-        ).filter(
-            Comment.status == True
-        ))
-        comment_count = comment_count_sql(session).scalar()
-
-        today = datetime.date.today()
-        return {
-            "pv": cls.get_pv(),
-            "pv_today": cls.get_pv(today),
-            "uv": cls.get_uv(),
-            "uv_today": cls.get_uv(today),
-            "post_count": post_count,
-            "post_reproduce_count": post_reproduce_count,
-            "post_origin_count": post_origin_count,
-            "post_translation_count": post_translation_count,
-            "comment_count": comment_count
-        }
 
     @classmethod
-    def incr_post_view(cls, slug):
-        """增加某post的点击量
-
-        TODO: 在post更改slug以后也要修改这个REDIS键
-        """
-        redis_key = cls.generate_key(slug)
-        redis_cli.incr(redis_key, 1)
+    def incr_post_view(cls, post_id):
+        """增加某post的点击量，同时标记该post需要同步到数据库"""
+        pipe = redis_cli.pipeline()
+        pipe.incr(cls.post_view.format(id=post_id), 1)
+        pipe.sadd(cls.post_view_dirty, post_id)
+        pipe.execute()
 
     @classmethod
-    def get_post_view(cls, slug):
+    def get_post_view(cls, post_id):
         """获取某post的点击量"""
-        redis_key = cls.generate_key(slug)
-        value = redis_cli.get(redis_key)
+        value = redis_cli.get(cls.post_view.format(id=post_id))
         if value is None:
             return 0
         return int(value)
 
     @classmethod
-    def save_access_ip(cls, ip):
-        """建立一个集合类型来存储访问者的IP
+    def pop_dirty_post_views(cls):
+        """取出并清空有新点击的post(一个`MULTI`事务)，再用`MGET`读取点击量
 
-        另外每天建立一个集合来存储当天访问的IP，但是只保存一周(下周一刷新)
+        :return: {post_id: view_num}
         """
-        redis_cli.sadd(cls.access_ip, ip)
+        pipe = redis_cli.pipeline()
+        pipe.smembers(cls.post_view_dirty)
+        pipe.delete(cls.post_view_dirty)
+        post_ids, _ = pipe.execute()
+        if not post_ids:
+            return {}
+        post_ids = sorted(int(post_id) for post_id in post_ids)
+        values = redis_cli.mget(
+            [cls.post_view.format(id=post_id) for post_id in post_ids]
+        )
+        return {post_id: int(value)
+                for post_id, value in zip(post_ids, values)
+                if value is not None}
 
-        today = datetime.date.today()
-        day_redis_key = cls.access_ip_day.format(day=str(today))
-        redis_cli.sadd(day_redis_key, ip)
+    @classmethod
+    def mark_post_view_dirty(cls, post_ids):
+        """重新标记需要同步的post，用于同步失败时"""
+        if post_ids:
+            redis_cli.sadd(cls.post_view_dirty, *post_ids)
+
+    @classmethod
+    def migrate_post_view(cls, session, delete=False, batch_size=500):
+        """将旧的以slug为键的点击量(`_stats:{slug}`)转换为以id为键
 
-        # 过期时间(下周一)
-        next_monday_timestamp = arrow.get(
-            get_next_weekday(today, 1)
+        :param delete: 转换完成后是否删除旧的键
+        :return: 转换的文章数量
+        """
+        posts = session.query(Post.id, Post.slug).order_by(Post.id).all()
+        migrated = 0
+        for index in range(0, len(posts), batch_size):
+            batch = posts[index:index + batch_size]
+            old_keys = [cls.generate_key(slug) for _, slug in batch]
+            values = redis_cli.mget(old_keys)
+            pipe = redis_cli.pipeline()
+            for (post_id, _), old_key, value in zip(batch, old_keys, values):
+                if value is None:
+                    continue
+                pipe.incrby(cls.post_view.format(id=post_id), int(value))
+                pipe.sadd(cls.post_view_dirty, post_id)
+                if delete:
+                    pipe.delete(old_key)
+                migrated += 1
+            pipe.execute()
+        return migrated
+
+    @classmethod
+    def uv_hll_day_expire_at(cls, day):
+        """每日UV的HyperLogLog的过期时间戳"""
+        if isinstance(day, str):
+            day = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+        return arrow.get(
+            day + datetime.timedelta(days=cls.uv_hll_day_keep_days)
         ).timestamp
-        redis_cli.expireat(day_redis_key, next_monday_timestamp)
+
+    @classmethod
+    def save_access_ip(cls, ip):
+        """将访问者的IP加入到总UV和当天UV的HyperLogLog中
+
+        :return: 该IP是否是今天的新访问者(近似值)
+        """
+        today = datetime.date.today()
+        day_hll_key = cls.uv_hll_day.format(day=str(today))
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.pfadd(day_hll_key, ip)
+        pipe.pfadd(cls.uv_hll_amount, ip)
+        pipe.expireat(day_hll_key, cls.uv_hll_day_expire_at(today))
+        is_new, _, _ = pipe.execute()
+        return bool(is_new)
 
     @classmethod
     def get_access_ip(cls):
@@ -178,17 +439,11 @@ class SiteStats(object):
 
         我们会根据IP是否已经访问过本站来统计这个UV数据.
         """
-        today = datetime.date.today()
-        day_ip_key = cls.access_ip_day.format(day=str(today))
-        if not redis_cli.sismember(day_ip_key, ip):
-            day_uv_key = cls.uv_day.format(day=str(today))
-            redis_cli.incr(day_uv_key, 1)
-        if not redis_cli.sismember(cls.access_ip, ip):
-            redis_cli.incr(cls.uv_amount, 1)
+        return cls.save_access_ip(ip)
 
     @classmethod
     def get_uv(cls, date=None):
-        """获取pv数据
+        """获取uv数据
 
         :param date:
 
@@ -198,24 +453,114 @@ class SiteStats(object):
 
         :return:
 
-            uv数据，或者None
+            uv数据(HyperLogLog的近似值，标准误差0.81%)，没有数据时返回0.
+
+            对于使用HyperLogLog之前的日期，以及转换完成之前存在旧的计数器时，
+            返回旧的计数器数据
         """
         if date is None:
-            redis_key = cls.uv_amount
+            hll_key, counter_key = cls.uv_hll_amount, cls.uv_amount
         else:
-            redis_key = cls.uv_day.format(day=str(date))
+            hll_key = cls.uv_hll_day.format(day=str(date))
+            counter_key = cls.uv_day.format(day=str(date))
 
-        value = redis_cli.get(redis_key)
-        if value is None:
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.exists(hll_key)
+        pipe.pfcount(hll_key)
+        pipe.get(counter_key)
+        pipe.exists(cls.uv_migrated)
+        exists, value, counter_value, migrated = pipe.execute()
+        return cls._pick_uv(exists, value, counter_value, migrated)
+
+    @classmethod
+    def get_range_uv(cls, start, end):
+        """获取一段时间内(包括`start`和`end`)的UV数据
+
+        使用`PFMERGE`合并每天的HyperLogLog，合并结果会缓存`uv_hll_range_expire`秒.
+        最多只能统计最近`uv_hll_day_keep_days`天的数据.
+
+        :param start: date对象，开始日期
+        :param end: date对象，结束日期
+        """
+        range_key = cls.uv_hll_range.format(start=str(start), end=str(end))
+        day_keys = []
+        day = start
+        while day <= end:
+            day_keys.append(cls.uv_hll_day.format(day=str(day)))
+            day += datetime.timedelta(days=1)
+        if not day_keys:
             return 0
-        return int(value)
+        if not redis_cli.exists(range_key):
+            pipe = redis_cli.pipeline()
+            pipe.pfmerge(range_key, *day_keys)
+            pipe.expire(range_key, cls.uv_hll_range_expire)
+            pipe.execute()
+        return int(redis_cli.pfcount(range_key))
+
+    @classmethod
+    def get_week_uv(cls, date=None):
+        """获取`date`所在那一周(周一到周日)的UV数据"""
+        date = date or datetime.date.today()
+        start = date - datetime.timedelta(days=date.weekday())
+        return cls.get_range_uv(start, start + datetime.timedelta(days=6))
+
+    @classmethod
+    def get_month_uv(cls, date=None):
+        """获取`date`所在那一个月的UV数据"""
+        date = date or datetime.date.today()
+        start = date.replace(day=1)
+        next_month = (start + datetime.timedelta(days=32)).replace(day=1)
+        return cls.get_range_uv(start, next_month - datetime.timedelta(days=1))
+
+    @classmethod
+    def migrate_uv(cls, delete=False, batch_size=1000):
+        """将旧的IP集合转换为HyperLogLog
+
+        - `_stats:access:ip` -> `_stats:uv:hll:amount`
+        - `_stats:access:ip:{day}` -> `_stats:uv:hll:{day}`
+
+        全部转换以后设置`uv_migrated`标记，之后UV只使用HyperLogLog.
+        PFADD是幂等的，转换可以重复执行.
+
+        :param delete: 转换完成后是否删除旧的IP集合
+        :param batch_size: 每次`SSCAN`/`PFADD`的数量
+        :return: 转换的(集合键, HyperLogLog键)列表
+        """
+        migrated = []
+        key_pairs = [(cls.access_ip, cls.uv_hll_amount, None)]
+        day_prefix = cls.access_ip_day.format(day='')
+        for key in redis_cli.scan_iter(match=day_prefix + '*',
+                                       count=batch_size):
+            day = key[len(day_prefix):]
+            key_pairs.append((key, cls.uv_hll_day.format(day=day), day))
+
+        for set_key, hll_key, day in key_pairs:
+            if redis_cli.type(set_key) != 'set':
+                continue
+            members = []
+            for member in redis_cli.sscan_iter(set_key, count=batch_size):
+                members.append(member)
+                if len(members) >= batch_size:
+                    redis_cli.pfadd(hll_key, *members)
+                    members = []
+            if members:
+                redis_cli.pfadd(hll_key, *members)
+            if day is not None:
+                redis_cli.expireat(hll_key, cls.uv_hll_day_expire_at(day))
+            if delete:
+                redis_cli.delete(set_key)
+            migrated.append((set_key, hll_key))
+        redis_cli.set(cls.uv_migrated, 1)
+        return migrated
 
     @classmethod
     def save_access_ua(cls, ua, ip):
-        """存储ua信息，默认保留一个星期(每周7更新)，同一个IP每天只保存一个UA"""
+        """存储ua信息，默认保留一个星期(每周7更新)，同一个IP每天只保存一个UA
+
+        会同时通过`save_access_ip()`记录UV
+        """
         today = datetime.date.today()
-        day_ip_key = cls.access_ip_day.format(day=str(today))
-        if not redis_cli.sismember(day_ip_key, ip):
+        if cls.save_access_ip(ip):
             redis_key = cls.ua_day.format(day=str(today))
             redis_cli.lpush(redis_key, ua)
 
@@ -230,3 +575,140 @@ class SiteStats(object):
         redis_key = cls.ua_day.format(str(date))
         # TODO
 
+
+class StatsRecorder(object):
+    """访问数据的缓冲记录器
+
+    `StatsMiddleware`不再在每个请求中同步调用约10次Redis命令，
+    而是把访问事件聚合在进程内存中，然后由IOLoop定时回调一次性写入Redis
+    (一个pipeline: PV使用`INCRBY`，UV/UA使用一个Lua脚本)，
+    写入的结果和逐条调用`SiteStats.incr_pv()`/`save_access_ua()`一致.
+
+    - 同一天同一个IP在一个周期内只保留第一条记录(只有第一次访问会影响UV/UA)
+    - 缓冲区的IP数量有上限`max_buffer`，超出的事件会被丢弃并计数
+    - 写入失败时PV增量放回缓冲区，下次再写入；UV/UA记录被丢弃并计数
+    - 服务器停止时需要调用`flush()`，见`manager.start_server()`
+    """
+    flush_interval = 2          # 定时写入的间隔(秒)
+    max_buffer = 10000          # 缓冲的(日期, IP)最大数量
+    script_batch_size = 500     # 每次执行Lua脚本处理的IP数量，避免长时间阻塞Redis
+
+    # KEYS: [总UV, (日UV, 日UA列表)...]
+    # ARGV: [(ip, ua, 日UV过期时间戳, UA过期时间戳)...]
+    visit_script = """
+    for i = 1, #ARGV / 4 do
+        local uv_day_key = KEYS[i * 2]
+        local ua_day_key = KEYS[i * 2 + 1]
+        local ip = ARGV[i * 4 - 3]
+        if redis.call('PFADD', uv_day_key, ip) == 1 then
+            redis.call('LPUSH', ua_day_key, ARGV[i * 4 - 2])
+            redis.call('EXPIREAT', ua_day_key, ARGV[i * 4])
+        end
+        redis.call('EXPIREAT', uv_day_key, ARGV[i * 4 - 1])
+        redis.call('PFADD', KEYS[1], ip)
+    end
+    return #ARGV / 4
+    """
+
+    def __init__(self, client=redis_cli):
+        self.client = client
+        self._script = client.register_script(self.visit_script)
+        self._lock = threading.Lock()
+        self._pv = {}           # {day: pv增量}
+        self._visits = {}       # {(day, ip): ua}
+        self._callback = None
+        self._pid = None
+        self.counters = {
+            "recorded": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+        }
+
+    def ensure_started(self):
+        """在当前进程的IOLoop中启动定时写入(fork以后每个进程单独启动)"""
+        pid = os.getpid()
+        if self._callback is not None and self._pid == pid:
+            return
+        self._pid = pid
+        self._callback = PeriodicCallback(self.flush,
+                                          self.flush_interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+        self.flush()
+
+    def record(self, ip, ua):
+        """记录一次访问(增量PV，UV，访问IP和UA)"""
+        day = str(datetime.date.today())
+        with self._lock:
+            self._pv[day] = self._pv.get(day, 0) + 1
+            self.counters['recorded'] += 1
+            if (day, ip) not in self._visits:
+                if len(self._visits) >= self.max_buffer:
+                    self.counters['dropped'] += 1
+                else:
+                    self._visits[(day, ip)] = ua
+
+    def flush(self):
+        """将缓冲的数据通过一次往返写入Redis"""
+        with self._lock:
+            pv, self._pv = self._pv, {}
+            visits, self._visits = self._visits, {}
+        if not pv and not visits:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for day, amount in pv.items():
+            pipe.incr(SiteStats.pv_amount, amount)
+            pipe.incr(SiteStats.pv_day.format(day=day), amount)
+        # 过期时间(日UV: 保留若干天，UA: 下周一)
+        expire_at_dict = {
+            day: (SiteStats.uv_hll_day_expire_at(day),
+                  arrow.get(get_next_weekday(
+                      datetime.datetime.strptime(day, '%Y-%m-%d').date(), 1
+                  )).timestamp)
+            for day, _ in visits
+        }
+        items = list(visits.items())
+        for start in range(0, len(items), self.script_batch_size):
+            keys = [SiteStats.uv_hll_amount]
+            args = []
+            for (day, ip), ua in items[start:start + self.script_batch_size]:
+                keys.extend([SiteStats.uv_hll_day.format(day=day),
+                             SiteStats.ua_day.format(day=day)])
+                args.extend((ip, ua) + expire_at_dict[day])
+            self._script(keys=keys, args=args, client=pipe)
+        try:
+            pipe.execute()
+        except Exception:
+            gen_log.error('StatsRecorder.flush() error', exc_info=True)
+            with self._lock:
+                for day, amount in pv.items():
+                    self._pv[day] = self._pv.get(day, 0) + amount
+                self.counters['flush_errors'] += 1
+                self.counters['dropped'] += len(visits)
+        else:
+            with self._lock:
+                self.counters['flushes'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, buffered=len(self._visits),
+                        buffered_pv=sum(self._pv.values()))
+
+
+stats_recorder = StatsRecorder()
+
+
+event.listen(Post.type, 'set', track_old_value, active_history=True)
+event.listen(Post, 'after_insert', ContentCounter.post_after_insert)
+event.listen(Post, 'after_update', ContentCounter.post_after_update)
+event.listen(Post, 'after_delete', ContentCounter.post_after_delete)
+event.listen(Comment, 'after_insert', ContentCounter.comment_after_insert)
+event.listen(Comment, 'after_update', ContentCounter.comment_after_update)
+event.listen(Comment, 'after_delete', ContentCounter.comment_after_delete)
+event.listen(Session, 'after_commit', ContentCounter.after_commit)
+event.listen(Session, 'after_rollback', ContentCounter.after_rollback)
@@ -1,16 +1,47 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import os
+import time
+import threading
+
+from tornado.log import gen_log
+
 from .base import redis_cli
 
 
 class SysConfig(object):
+    """系统配置
+
+    配置值存储在Redis的`_sysconfig:<key>`中，很少修改，但是每个请求都要读取多次，
+    所以每个进程保存一份快照(`_snapshot`)，通过一次`MGET`读取所有配置:
+
+    - `set()`/`incr()`写入时增加版本号`_sysconfig:_version`，
+      并在`channel`上发布消息，所有进程收到以后丢弃快照
+    - 订阅连接断开等情况下可能收不到消息，所以每隔`check_interval`秒
+      还会检查一次版本号，版本号变化时重新读取
+    """
     _prefix = '_sysconfig'
+    version_key = '_sysconfig:_version'
+    channel = '_sysconfig:changed'
+    check_interval = 5
+    _snapshot = None            # {key: 原始值}
+    _version = None
+    _checked_at = 0
+    _lock = threading.Lock()
+    _pubsub_thread = None
+    _pubsub_pid = None
     session_expire = {
         'key': 'expire_time',
         'default': 60 * 60 * 1,
         'type': int,
         'desc': "session过期时间"
     }
+    session_refresh_threshold = {
+        'key': 'session_refresh_threshold',
+        'default': 60 * 30,
+        'type': int,
+        'desc': "session剩余时间低于这个值时才会延期"
+    }
     per_page = {
         'key': 'per_page',
         'default': 100,
@@ -60,9 +91,82 @@ class SysConfig(object):
         "desc": "评论限制(条/每分钟)"
     }
 
+    @classmethod
+    def options(cls):
+        """所有定义的配置项(包括`key`, `default`, `type`, `desc`的字典)"""
+        return [value for name, value in vars(cls).items()
+                if not name.startswith('_') and isinstance(value, dict)
+                and 'key' in value]
+
+    @classmethod
+    def _redis_key(cls, key):
+        return "{0}:{1}".format(cls._prefix, key)
+
+    @classmethod
+    def load(cls):
+        """通过一次`MGET`读取所有配置项和版本号，替换当前进程的快照"""
+        keys = [option['key'] for option in cls.options()]
+        values = redis_cli.mget(
+            [cls.version_key] + [cls._redis_key(key) for key in keys]
+        )
+        with cls._lock:
+            SysConfig._version = values[0]
+            SysConfig._snapshot = dict(zip(keys, values[1:]))
+            SysConfig._checked_at = time.time()
+        return cls._snapshot
+
+    @classmethod
+    def invalidate(cls):
+        """丢弃当前进程的快照，下次读取时重新加载"""
+        SysConfig._snapshot = None
+
+    @classmethod
+    def snapshot(cls):
+        """当前进程的配置快照，超过`check_interval`秒以后检查版本号"""
+        cls.ensure_subscribed()
+        snapshot = cls._snapshot
+        if snapshot is None:
+            return cls.load()
+        if time.time() - cls._checked_at >= cls.check_interval:
+            SysConfig._checked_at = time.time()
+            if redis_cli.get(cls.version_key) != cls._version:
+                return cls.load()
+        return snapshot
+
+    @classmethod
+    def ensure_subscribed(cls):
+        """在当前进程中启动订阅配置改动消息的线程(fork以后每个进程单独启动)"""
+        pid = os.getpid()
+        if cls._pubsub_thread is not None and cls._pubsub_pid == pid:
+            return
+        with cls._lock:
+            if cls._pubsub_thread is not None and cls._pubsub_pid == pid:
+                return
+            SysConfig._pubsub_pid = pid
+            try:
+                pubsub = redis_cli.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{cls.channel: cls._on_message})
+                SysConfig._pubsub_thread = pubsub.run_in_thread(
+                    sleep_time=1, daemon=True
+                )
+            except Exception:
+                # 订阅失败时只依靠定时检查版本号
+                SysConfig._pubsub_thread = False
+                gen_log.error('SysConfig subscribe error', exc_info=True)
+
+    @classmethod
+    def _on_message(cls, message):
+        cls.invalidate()
+
+    @classmethod
+    def _changed(cls, pipe):
+        """在写入配置的事务中增加版本号并通知所有进程"""
+        pipe.incr(cls.version_key)
+        pipe.publish(cls.channel, 1)
+
     @classmethod
     def get(cls, key, default=None, type=None, **kwargs):
-        """获取系统配置
+        """获取系统配置(从当前进程的快照中读取)
 
         :param key: 系统配置"键"
         :param default: 当系统配置不存在时使用的默认值
@@ -71,8 +175,12 @@ class SysConfig(object):
             如果type==bool，就会先将它转换为整数再转换为布尔值
         :return: 返回最终的系统配置值
         """
-        redis_key = "{0}:{1}".format(cls._prefix, key)
-        value = redis_cli.get(redis_key)
+        snapshot = cls.snapshot()
+        if key in snapshot:
+            value = snapshot[key]
+        else:
+            # 没有定义的配置项不在快照中
+            value = redis_cli.get(cls._redis_key(key))
         if not value:
             return default
         if type:
@@ -91,22 +199,30 @@ class SysConfig(object):
             用于对系统配置值作类型转换的可调用对象,
             如果type==bool，将这个值转换为整数类型
         """
-        redis_key = "{0}:{1}".format(cls._prefix, key)
         if type:
             if type == bool:
                 value = int(value)
             else:
                 value = type(value)
-        redis_cli.set(redis_key, value)
+        pipe = redis_cli.pipeline()
+        pipe.set(cls._redis_key(key), value)
+        cls._changed(pipe)
+        pipe.execute()
+        cls.invalidate()
 
     @classmethod
     def incr(cls, key, increment=1):
         """为KEY增量"""
-        redis_key = "{0}:{1}".format(cls._prefix, key)
-        redis_cli.incr(redis_key, increment)
+        pipe = redis_cli.pipeline()
+        pipe.incr(cls._redis_key(key), increment)
+        cls._changed(pipe)
+        pipe.execute()
+        cls.invalidate()
 
     @classmethod
     def expire(cls, key, seconds):
-        """为KEY加入过期时间"""
-        redis_key = "{0}:{1}".format(cls._prefix, key)
-        redis_cli.expire(redis_key, seconds)
\ No newline at end of file
+        """为KEY加入过期时间
+
+        过期不会通知其它进程，快照中的值在重新加载之前仍然有效
+        """
+        redis_cli.expire(cls._redis_key(key), seconds)
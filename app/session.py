@@ -1,42 +1,77 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 import os
+import json
 import time
+import base64
 import hashlib
 
+from cryptography.fernet import Fernet, InvalidToken
+from redis import RedisError
+from tornado.log import gen_log
+
+from app.models.base import redis_cli
 from app.models.sys_config import SysConfig
 
 
 class Session(object):
+    """基于Redis哈希的session
+
+    每个请求只在第一次使用时通过一次往返(`HGETALL`+`TTL`)读取整个session，
+    之后的读取都来自这个快照；写入会先缓冲起来，
+    在请求结束时通过`save()`以一个`MULTI`事务一次性写回.
+    """
     _prefix = '_session:'
     _id = None
-    _skip = ['_redis', '_handler', '_id']
+    _skip = ['_redis', '_handler', '_id', '_data', '_ttl', '_dirty',
+             '_deleted', '_touched', '_new']
 
     def __init__(self, handler_instance):
         self._redis = handler_instance.redis_cli
         self._handler = handler_instance
-        _id = handler_instance.get_secure_cookie("session_id")
+        self._data = {}
+        self._ttl = None
+        self._dirty = {}
+        self._deleted = set()
+        self._touched = False
+        self._new = False
+        _id = self._request_session_id()
+        if _id:
+            self.load(_id)
+
+    def _request_session_id(self):
+        """从cookie或者`Session-ID`请求头中读取session id"""
+        _id = self._handler.get_secure_cookie("session_id")
         if not _id:
-            _id = handler_instance.request.headers.get("Session-ID", None)
-        if _id and self._redis.exists(_id):
+            _id = self._handler.request.headers.get("Session-ID", None)
+        if isinstance(_id, bytes):
+            _id = _id.decode()
+        if _id and _id.startswith(self._prefix):
+            return _id
+        return None
+
+    def load(self, _id):
+        """一次往返读取session的全部数据和剩余的过期时间"""
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hgetall(_id)
+        pipe.ttl(_id)
+        data, ttl = pipe.execute()
+        if data:
             self._id = _id
+            self._data = data
+            self._ttl = ttl
 
     def init_session(self):
         if not self._id:
             self._id = self.generate_session_id()
+            self._new = True
             self._handler.set_secure_cookie("session_id", self._id)
             self._handler.set_header('Session-ID', self._id)
-        # 设置延期时间
-        self._redis.hset(self._id, 'last_active', time.time())
         # 设置用户IP
-        if self._redis.hget(self._id, "remote_ip") is None:
-            self._redis.hset(self._id,
-                             "remote_ip",
-                             self._handler.request.remote_ip)
-        self._redis.expire(
-            self._id,
-            SysConfig.get(**SysConfig.session_expire)
-        )
+        if self._data.get("remote_ip") is None:
+            self._set("remote_ip", self._handler.request.remote_ip)
+        # 标记需要延期，在`save()`中决定是否真正写入
+        self._touched = True
 
     def generate_session_id(self):
         secret_key = self._handler.settings['cookie_secret']
@@ -52,23 +87,246 @@ class Session(object):
                 break
         return session_id
 
+    def session_expire(self):
+        """session的有效期(秒)"""
+        return SysConfig.get(**SysConfig.session_expire)
+
+    def refresh_threshold(self):
+        """剩余时间低于这个值(秒)时才延长session的过期时间"""
+        return SysConfig.get(**SysConfig.session_refresh_threshold)
+
+    def _need_refresh(self, expire):
+        """判断是否需要延长session的过期时间
+
+        只有在剩余时间低于阈值时才刷新，避免每个请求都写一次Redis
+        """
+        if self._new or self._ttl is None or self._ttl < 0:
+            return True
+        return self._ttl < min(self.refresh_threshold(), expire)
+
+    def save(self):
+        """将缓冲的写入以一个`MULTI`事务写回Redis"""
+        if not (self._id and (self._dirty or self._deleted or self._touched)):
+            return
+        expire = self.session_expire()
+        refresh = self._touched and self._need_refresh(expire)
+        if not (self._dirty or self._deleted or refresh):
+            return
+        if refresh:
+            self._set('last_active', time.time())
+        pipe = self._redis.pipeline()
+        if self._dirty:
+            pipe.hmset(self._id, self._dirty)
+        if self._deleted:
+            pipe.hdel(self._id, *self._deleted)
+        pipe.expire(self._id, expire)
+        pipe.execute()
+        self._ttl = expire
+        self._dirty = {}
+        self._deleted = set()
+        self._touched = False
+        self._new = False
+
     def logout(self):
-        self._redis.delete(self._id)
+        if self._id:
+            self._redis.delete(self._id)
+        self._id = None
+        self._data = {}
+        self._dirty = {}
+        self._deleted = set()
+        self._touched = False
+
+    def _set(self, key, value):
+        value = str(value)      # 和Redis中读取出来的值保持一致
+        self._data[key] = value
+        self._dirty[key] = value
+        self._deleted.discard(key)
 
     def __getattr__(self, item):
         if self._id:
-            return self._redis.hget(self._id, item)
+            return self._data.get(item)
         return None
 
     def __setattr__(self, key, value):
         """在为session对象设置属性后，进行session的更新或创建"""
-        if not key in self._skip:
-            self.init_session()
-            self._redis.hset(self._id, key, value)
-        super().__setattr__(key, value)
+        if key in self._skip:
+            return super().__setattr__(key, value)
+        self.init_session()
+        self._set(key, value)
 
     def __delattr__(self, item):
-        if not item in self._skip:
-            return self._redis.hdel(self._id, item)
-        super().__delattr__(item)
+        if item in self._skip:
+            return super().__delattr__(item)
+        self._data.pop(item, None)
+        self._dirty.pop(item, None)
+        if self._id:
+            self._deleted.add(item)
+
+
+class SessionDenyList(object):
+    """已注销的无状态session的黑名单
+
+    使用Redis有序集合存储，score为session的过期时间，过期的条目会被清除，
+    所以集合的大小只和"有效期内注销的session数量"有关.
+
+    每个进程在本地保存一份副本，每隔`refresh_interval`秒才同步一次，
+    检查session时不需要访问Redis; 同步失败时继续使用本地的副本.
+    """
+    key = '_session:denylist'
+    refresh_interval = 5
+    _local = {}
+    _loaded_at = 0
+
+    @classmethod
+    def add(cls, sid, expire_at):
+        """注销一个session，直到它本来的过期时间为止"""
+        redis_cli.zadd(cls.key, expire_at, sid)
+        cls._local[sid] = expire_at
+
+    @classmethod
+    def refresh(cls):
+        now = time.time()
+        pipe = redis_cli.pipeline()
+        pipe.zremrangebyscore(cls.key, '-inf', now)
+        pipe.zrangebyscore(cls.key, now, '+inf', withscores=True)
+        try:
+            _, items = pipe.execute()
+        except RedisError:
+            gen_log.error('SessionDenyList refresh error', exc_info=True)
+        else:
+            cls._local = dict(items)
+        # 失败时也等到下一个间隔再重试，不让每个请求都访问出错的Redis
+        cls._loaded_at = now
+
+    @classmethod
+    def contains(cls, sid):
+        if time.time() - cls._loaded_at > cls.refresh_interval:
+            cls.refresh()
+        return sid in cls._local
+
 
+class CookieSession(Session):
+    """无状态的session
+
+    session数据(user_id, remote_ip, last_active...)以JSON格式通过
+    `cryptography.fernet.Fernet`(AES-CBC + HMAC-SHA256)加密和签名以后
+    直接存储在cookie中，密钥由`cookie_secret`派生.
+    读取和保存session都不需要访问Redis，所以有效期和延期阈值来自应用配置
+    (`SESSION_EXPIRE`, `SESSION_REFRESH_THRESHOLD`)，而不是系统配置.
+
+    API客户端仍然可以通过`Session-ID`请求头传递这个值.
+    注销(`logout()`)的session会加入到`SessionDenyList`中.
+    """
+    _cookie_name = 'session_id'
+    _skip = Session._skip + ['_secret']
+    _fernets = {}       # {cookie_secret: Fernet}
+
+    def __init__(self, handler_instance):
+        self._secret = handler_instance.settings['cookie_secret']
+        super().__init__(handler_instance)
+
+    def _request_session_id(self):
+        token = self._handler.get_cookie(self._cookie_name)
+        if not token:
+            token = self._handler.request.headers.get("Session-ID", None)
+        return token or None
+
+    @classmethod
+    def _fernet(cls, secret):
+        fernet = cls._fernets.get(secret)
+        if fernet is None:
+            key = hashlib.sha256(
+                (secret + ':' + cls.__name__).encode()
+            ).digest()
+            fernet = cls._fernets[secret] = Fernet(
+                base64.urlsafe_b64encode(key)
+            )
+        return fernet
+
+    @classmethod
+    def encode(cls, secret, data):
+        """加密并签名session数据，返回字符串"""
+        plaintext = json.dumps(data, separators=(',', ':')).encode()
+        return cls._fernet(secret).encrypt(plaintext).decode()
+
+    @classmethod
+    def decode(cls, secret, token):
+        """验证签名并解密session数据，失败时返回None"""
+        if isinstance(token, str):
+            token = token.encode()
+        try:
+            plaintext = cls._fernet(secret).decrypt(token)
+            data = json.loads(plaintext.decode())
+        except (InvalidToken, ValueError, TypeError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        return data
+
+    def session_expire(self):
+        return getattr(self._handler.config, 'SESSION_EXPIRE',
+                       SysConfig.session_expire['default'])
+
+    def refresh_threshold(self):
+        return getattr(self._handler.config, 'SESSION_REFRESH_THRESHOLD',
+                       SysConfig.session_refresh_threshold['default'])
+
+    def load(self, token):
+        data = self.decode(self._secret, token)
+        if not data or 'sid' not in data:
+            return
+        remaining = data.get('expire_at', 0) - time.time()
+        if remaining <= 0:
+            return
+        if SessionDenyList.contains(data['sid']):
+            return
+        self._id = token
+        self._data = data
+        self._ttl = int(remaining)
+
+    def init_session(self):
+        if 'sid' not in self._data:
+            self._data['sid'] = self.generate_session_id()
+            self._new = True
+        if self._data.get("remote_ip") is None:
+            self._set("remote_ip", self._handler.request.remote_ip)
+        self._touched = True
+
+    def generate_session_id(self):
+        return hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+
+    def save(self):
+        """重新生成cookie，注意必须在响应头发送之前调用"""
+        if not (self._data and (self._dirty or self._deleted or self._touched)):
+            return
+        expire = self.session_expire()
+        refresh = self._touched and self._need_refresh(expire)
+        if not (self._dirty or self._deleted or refresh):
+            return
+        now = time.time()
+        if refresh:
+            self._data['last_active'] = str(now)
+            self._data['expire_at'] = int(now + expire)
+        self._id = self.encode(self._secret, self._data)
+        self._handler.set_cookie(self._cookie_name, self._id,
+                                 expires=self._data['expire_at'],
+                                 httponly=True)
+        self._handler.set_header('Session-ID', self._id)
+        self._ttl = int(self._data['expire_at'] - now)
+        self._dirty = {}
+        self._deleted = set()
+        self._touched = False
+        self._new = False
+
+    def logout(self):
+        if 'sid' in self._data and 'expire_at' in self._data:
+            SessionDenyList.add(self._data['sid'], self._data['expire_at'])
+        self._handler.clear_cookie(self._cookie_name)
+        self._id = None
+        self._data = {}
+        self._dirty = {}
+        self._deleted = set()
+        self._touched = False
+
+    def __getattr__(self, item):
+        return self._data.get(item)
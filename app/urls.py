@@ -15,6 +15,9 @@ urlpatterns = [
     (r"/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d+)/(?P<slug>[\w-]+)",
      blog_handlers.PostHandler,
      {}, "post"),
+    # 搜索
+    (r"/search", blog_handlers.SearchHandler,
+     {}, "search"),
     
 
     # 后台页面
@@ -81,6 +84,13 @@ urlpatterns = [
      {}, "api:v1:post:list"),
     (r"/api/v1/post/(?P<id>\d+)", api_v1_handlers.PostDetailHandler,
      {}, "api:v1:post:detail"),
+    (r"/api/v1/post/(?P<id>\d+)/comments",
+     api_v1_handlers.PostCommentHandler,
+     {}, "api:v1:post:comments"),
+
+    # 搜索API
+    (r"/api/v1/search", api_v1_handlers.SearchHandler,
+     {}, "api:v1:search"),
 
     # 评论API
     (r"/api/v1/comment", api_v1_handlers.CommentListHandler,
@@ -99,4 +109,8 @@ urlpatterns = [
      {}, "api:v1:image:list"),
     (r"/api/v1/image/(?P<id>\d+)", api_v1_handlers.ImageDetailHandler,
      {}, "api:v1:image:detail"),
+
+    # 监控API
+    (r"/api/v1/metrics", api_v1_handlers.MetricsHandler,
+     {}, "api:v1:metrics"),
 ]
\ No newline at end of file
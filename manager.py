@@ -4,6 +4,7 @@
 
 import argparse
 import os
+import signal
 import getpass
 
 from tornado.httpserver import HTTPServer
@@ -12,7 +13,9 @@ from tornado.options import parse_command_line
 
 from app import create_app
 from config import config_dict
-from app.models import session_context, User
+from app.models import session_context, User, get_engine, warm_up_engine
+from app.models.stats import SiteStats, stats_recorder
+from app.models.search import PostSearchIndex
 
 
 parser = argparse.ArgumentParser()
@@ -29,6 +32,35 @@ user_parser.add_argument(
     help='user command include createsuperuser...'
 )
 
+# 统计数据相关命令
+stats_parser = sub_parser.add_parser(
+    'stats',
+    help='stats commands'
+)
+stats_parser.add_argument(
+    'stats_command',
+    choices=('migrate-uv', 'migrate-post-view'),
+    help='stats command include migrate-uv(convert ip sets to hyperloglog), '
+         'migrate-post-view(key post view counters by post id)'
+)
+stats_parser.add_argument(
+    '--delete',
+    dest='stats_delete',
+    action='store_true',
+    help='delete the old keys after migrate-uv/migrate-post-view'
+)
+
+# 全文搜索相关命令
+search_parser = sub_parser.add_parser(
+    'search',
+    help='search index commands'
+)
+search_parser.add_argument(
+    'search_command',
+    choices=('rebuild',),
+    help='search command include rebuild(rebuild the post search index)'
+)
+
 # 服务器启动的子命令
 server_parser = sub_parser.add_parser(
     'start',
@@ -114,12 +146,30 @@ def start_server(args):
     http_server = HTTPServer(app, xheaders=True)
     http_server.bind(args.server_port, args.server_host)
     http_server.start()
+    # 预热数据库连接池(在fork之后，每个worker进程各自建立连接)
+    config_cls = config_dict[start_mode]
+    warm_up_engine(get_engine(
+        config_cls.SQLALCHEMY_URI,
+        pool_size=config_cls.SQLALCHEMY_POOL_SIZE,
+        pool_recycle=config_cls.SQLALCHEMY_POOL_RECYCLE,
+    ))
     # 打印启动提示日志
     parse_command_line()
     app.logger.info('server start at {0}:{1}'.format(
         args.server_host, args.server_port
     ))
-    IOLoop.current().start()
+    # 收到SIGTERM时停止IOLoop，以便执行下面的清理工作
+    signal.signal(
+        signal.SIGTERM,
+        lambda *_: IOLoop.current().add_callback_from_signal(
+            IOLoop.current().stop
+        )
+    )
+    try:
+        IOLoop.current().start()
+    finally:
+        # 将缓冲的访问统计数据写入Redis
+        stats_recorder.stop()
 
 
 def create_superuser():
@@ -132,6 +182,29 @@ def create_superuser():
     print("创建成功")
 
 
+def migrate_uv(args):
+    """将旧的UV数据(IP集合)转换为HyperLogLog"""
+    migrated = SiteStats.migrate_uv(delete=args.stats_delete)
+    for set_key, hll_key in migrated:
+        print("{0} -> {1}".format(set_key, hll_key))
+    print("转换完成: {0}个集合".format(len(migrated)))
+
+
+def migrate_post_view(args):
+    """将以slug为键的文章点击量转换为以id为键"""
+    with session_context() as session:
+        migrated = SiteStats.migrate_post_view(session,
+                                               delete=args.stats_delete)
+    print("转换完成: {0}篇文章".format(migrated))
+
+
+def rebuild_search_index():
+    """重建文章的全文搜索索引"""
+    with session_context() as session:
+        count = PostSearchIndex.rebuild(session)
+    print("重建完成: {0}篇文章".format(count))
+
+
 def main(args):
     if getattr(args, 'start_mode', None):
         # 触发服务器启动的函数
@@ -141,6 +214,14 @@ def main(args):
     if getattr(args, 'user_command', None):
         if args.user_command == 'createsuperuser':
             create_superuser()
+    if getattr(args, 'stats_command', None):
+        if args.stats_command == 'migrate-uv':
+            migrate_uv(args)
+        elif args.stats_command == 'migrate-post-view':
+            migrate_post_view(args)
+    if getattr(args, 'search_command', None):
+        if args.search_command == 'rebuild':
+            rebuild_search_index()
 
 
 
@@ -0,0 +1,25 @@
+"""table comment add index on post_id floor
+
+Revision ID: 2c6d8e0f4a91
+Revises: 7b1f3c9a2e60
+Create Date: 2026-10-18 18:20:35.614027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c6d8e0f4a91'
+down_revision = '7b1f3c9a2e60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_comment_post_id_floor', 'comment',
+                    ['post_id', 'floor'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_post_id_floor', table_name='comment')
@@ -0,0 +1,28 @@
+"""table post add rendered content columns
+
+Revision ID: 3b9e5a7c2d41
+Revises: abdcb9f6d98c
+Create Date: 2026-10-18 10:12:31.208415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e5a7c2d41'
+down_revision = 'abdcb9f6d98c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('post', sa.Column('content_html', sa.Text(), nullable=True))
+    op.add_column('post', sa.Column('content_toc', sa.Text(), nullable=True))
+    op.add_column('post', sa.Column('content_hash', sa.String(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('post', 'content_hash')
+    op.drop_column('post', 'content_toc')
+    op.drop_column('post', 'content_html')
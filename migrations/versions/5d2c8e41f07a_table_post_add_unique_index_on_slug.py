@@ -0,0 +1,56 @@
+"""table post add unique index on slug
+
+Revision ID: 5d2c8e41f07a
+Revises: 3b9e5a7c2d41
+Create Date: 2026-10-18 14:05:47.532918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models.base import redis_cli
+from app.models.post import PostSlugMap
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e41f07a'
+down_revision = '3b9e5a7c2d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 重复的slug只保留最早的文章，其它文章改为`slug-<id>`，
+    # 并记录到`PostSlugMap.renamed_key`中
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT id, slug FROM post WHERE slug IN "
+        "(SELECT slug FROM post GROUP BY slug HAVING COUNT(*) > 1) "
+        "ORDER BY slug, id"
+    )).fetchall()
+    kept = {}
+    renamed = []
+    for post_id, slug in rows:
+        if slug not in kept:
+            kept[slug] = post_id
+            continue
+        new_slug = '{0}-{1}'.format(slug, post_id)
+        bind.execute(
+            sa.text("UPDATE post SET slug = :slug WHERE id = :id"),
+            slug=new_slug, id=post_id
+        )
+        renamed.append((slug, new_slug, post_id))
+    if renamed:
+        pipe = redis_cli.pipeline()
+        for slug, new_slug, post_id in renamed:
+            pipe.hset(PostSlugMap.renamed_key, slug, post_id)
+            pipe.hset(PostSlugMap.key, new_slug, post_id)
+        # 旧的slug仍然属于保留的文章(优先于`renamed_key`)
+        for slug, post_id in kept.items():
+            pipe.hset(PostSlugMap.key, slug, post_id)
+        pipe.execute()
+    op.create_index(op.f('ix_post_slug'), 'post', ['slug'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_post_slug'), table_name='post')
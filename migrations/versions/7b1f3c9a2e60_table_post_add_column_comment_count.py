@@ -0,0 +1,30 @@
+"""table post add column comment_count
+
+Revision ID: 7b1f3c9a2e60
+Revises: 5d2c8e41f07a
+Create Date: 2026-10-18 16:42:13.208411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b1f3c9a2e60'
+down_revision = '5d2c8e41f07a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('post', sa.Column('comment_count', sa.Integer(),
+                                    nullable=False, server_default='0'))
+    # 根据已有的评论初始化评论数量
+    op.execute(
+        "UPDATE post SET comment_count = "
+        "(SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)"
+    )
+
+
+def downgrade():
+    op.drop_column('post', 'comment_count')
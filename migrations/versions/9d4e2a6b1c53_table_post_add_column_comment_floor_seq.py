@@ -0,0 +1,41 @@
+"""table post add column comment_floor_seq
+
+Revision ID: 9d4e2a6b1c53
+Revises: 2c6d8e0f4a91
+Create Date: 2026-10-18 20:12:48.305517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e2a6b1c53'
+down_revision = '2c6d8e0f4a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('post', sa.Column('comment_floor_seq', sa.Integer(),
+                                    nullable=False, server_default='0'))
+    # 楼层序号从已有的最大楼层开始
+    op.execute(
+        "UPDATE post SET comment_floor_seq = "
+        "(SELECT COALESCE(MAX(floor), 0) FROM comment "
+        "WHERE comment.post_id = post.id)"
+    )
+    # 评论数量只包括开启的评论
+    op.execute(
+        "UPDATE post SET comment_count = "
+        "(SELECT COUNT(*) FROM comment "
+        "WHERE comment.post_id = post.id AND comment.status = 1)"
+    )
+
+
+def downgrade():
+    op.execute(
+        "UPDATE post SET comment_count = "
+        "(SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)"
+    )
+    op.drop_column('post', 'comment_floor_seq')
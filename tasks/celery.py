@@ -33,6 +33,11 @@ app.conf.beat_schedule = {
     'every-10-minute-sync_post_view_data': {
         'task': 'tasks.cron.sync_post_view',
         'schedule': 600.0,
+    },
+    # 每分钟检查一次文章关系(相关文章，上一篇/下一篇)是否需要重新计算
+    'every-minute-update_post_relations': {
+        'task': 'tasks.cron.update_post_relations',
+        'schedule': 60.0,
     }
 }
 
@@ -2,20 +2,39 @@
 # -*- coding:utf-8 -*-
 
 from app.models.stats import SiteStats
-from app.models.post import Post
+from app.models.post import Post, PostRelation
 from app.models import session_context
+from app.cache import RedisCache
 from .celery import app
 
 
 @app.task
 def sync_post_view():
-    """同步所有文章的点击量数据"""
-    with session_context() as session:
-        all_post = session.query(Post).all()
+    """同步有新点击的文章的点击量数据
+
+    只处理上次同步以后被访问过的文章，失败时重新标记，等待下一次同步
+    """
+    views = SiteStats.pop_dirty_post_views()
+    if not views:
+        return 0
+    try:
+        with session_context() as session:
+            rowcount = Post.update_view_num(session, views)
+            session.commit()
+    except Exception:
+        SiteStats.mark_post_view_dirty(list(views))
+        raise
+    return rowcount
 
-        for post_obj in all_post:
-            view_num = SiteStats.get_post_view(post_obj.slug)
-            post_obj.view_num = view_num
-            session.add(post_obj)
 
+@app.task
+def update_post_relations(force=False):
+    """重新计算相关文章和上一篇/下一篇
 
+    文章保存时只标记需要更新(见`PostRelation`)，这个任务定时检查标记，
+    短时间内的多次修改只计算一次，关系改变了的文章的页面缓存随之清除
+    """
+    with session_context() as session:
+        if not force and not PostRelation.needs_update(session):
+            return 0
+        return PostRelation.update(session, cache=RedisCache)
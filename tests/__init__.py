@@ -2,4 +2,9 @@
 # -*- coding:utf-8 -*-
 
 from .test_models import *
-from .test_api import *
\ No newline at end of file
+from .test_api import *
+from .test_session import *
+from .test_cache import *
+from .test_paginator import *
+from .test_search import *
+from .test_middlewares import *
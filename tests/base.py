@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
-from sqlalchemy import create_engine
+import contextlib
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 
 from config import TestingConfig
 from app.models import *
@@ -18,4 +21,31 @@ class ModelTestMixin(object):
     def tearDown(self):
         super().tearDown()
         self.db.close()
-        Base.metadata.drop_all(test_engine)
\ No newline at end of file
+        Base.metadata.drop_all(test_engine)
+
+
+class QueryCountMixin(object):
+    """统计SQL查询的数量，用于发现N+1查询"""
+
+    @contextlib.contextmanager
+    def assertMaxQueries(self, num):
+        """代码块中执行的SQL查询(所有engine)不能超过`num`条
+
+        >>> with self.assertMaxQueries(3):
+        ...     self.fetch('/')
+        """
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        self.assertLessEqual(
+            len(statements), num,
+            "{0} queries executed:\n{1}".format(len(statements),
+                                               "\n".join(statements))
+        )
@@ -2,13 +2,16 @@
 # -*- coding:utf-8 -*-
 import json
 from io import BytesIO
+from datetime import datetime
 
 from tornado.testing import AsyncHTTPTestCase
 
 from app.models import *
 from app import create_app
-from .base import ModelTestMixin
-from app.models.sys_config import redis_cli
+from .base import ModelTestMixin, QueryCountMixin
+from app.models.sys_config import SysConfig, redis_cli
+from app.models.rate_limit import (RateLimiter, RedisBackend, LocalBackend,
+                                   login_limiter)
 
 __all__ = ['APIV1TestCase']
 
@@ -17,10 +20,16 @@ __all__ = ['APIV1TestCase']
 # ========================================================
 
 
-class APIV1TestCase(ModelTestMixin, AsyncHTTPTestCase):
+class APIV1TestCase(QueryCountMixin, ModelTestMixin, AsyncHTTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 每个测试使用新的进程内频率限制，不受之前的测试(和Redis中的数据)影响
+        RateLimiter.use_backend(LocalBackend())
 
     def tearDown(self):
         super().tearDown()
+        RateLimiter.use_backend(RedisBackend())
         # 清理所有的session-id
         session_keys = redis_cli.keys("session:*")
         for key in session_keys:
@@ -134,6 +143,19 @@ class APIV1TestCase(ModelTestMixin, AsyncHTTPTestCase):
         self.assertTrue(data['error'] != 0)
         self.assertEqual(data['msg'], 'email or password error')
 
+    def test_session_id_create_fail_429_by_too_many_failures(self):
+        body = json.dumps({
+            'email': "example@qq.com",
+            'password': 'a1234567'
+        })
+        for _ in range(login_limiter.limit):
+            data = self.api_fetch(self.reverse_url("api:v1:user:session_id"),
+                                  method='POST', body=body)
+            self.assertEqual(data['error'], 2)
+        response = self.fetch(self.reverse_url("api:v1:user:session_id"),
+                              method='POST', body=body)
+        self.assertEqual(response.code, 429)
+
     def test_get_session_id_fail_401_by_not_login(self):
         response = self.fetch(
             self.reverse_url("api:v1:user:session_id"),
@@ -542,6 +564,62 @@ class APIV1TestCase(ModelTestMixin, AsyncHTTPTestCase):
         self.assertEqual(obj.category, c1)
         self.assertTrue(obj.title == 'post1')
 
+    def test_post_list_without_lazy_load(self):
+        c1 = Category(name='category1')
+        i1 = Image(name='image1', url='http://example.com/image1')
+        self.db.add_all([
+            Post(title='post%d' % i, slug='post%d' % i,
+                 category=c1, image=i1)
+            for i in range(10)
+        ])
+        self.db.commit()
+        session_id = self.login()
+        # 用户 + 文章列表 + 总数
+        with self.assertMaxQueries(3):
+            response = self.fetch(self.reverse_url("api:v1:post:list"),
+                                  headers={"Session-ID": session_id})
+        data = json.loads(response.body)
+        self.assertEqual(len(data['object_list']), 10)
+
+    def test_post_list_page_number_and_cursor(self):
+        c1 = Category(name='category1')
+        i1 = Image(name='image1', url='http://example.com/image1')
+        self.db.add_all([
+            Post(title='post%d' % i, slug='post%d' % i,
+                 category=c1, image=i1)
+            for i in range(25)
+        ])
+        self.db.commit()
+        url = self.reverse_url("api:v1:post:list")
+        SysConfig.set('per_page', 10, type=int)
+        try:
+            data = self.auth_api_fetch(url + '?page=2')
+            self.assertEqual(data['current_page'], 2)
+            self.assertEqual(len(data['object_list']), 10)
+            self.assertTrue(data['has_prev'])
+
+            data = self.auth_api_fetch(url)
+            self.assertEqual(data['current_page'], 1)
+            self.assertEqual(data['count'], 25)
+            self.assertNotIn('next_cursor', data)
+
+            data = self.auth_api_fetch(url + '?cursor=')
+            self.assertIsNone(data['current_page'])
+            data = self.auth_api_fetch(
+                url + '?cursor=' + data['next_cursor']
+            )
+            self.assertIsNone(data['current_page'])
+            self.assertEqual(len(data['object_list']), 10)
+        finally:
+            redis_cli.delete('_sysconfig:per_page')
+            SysConfig.invalidate()
+
+        # 总数缓存的键不受筛选以外的参数影响
+        redis_cli.delete('_count:{0}:[]'.format(url))
+        self.auth_api_fetch(url + '?cursor=&foo=1')
+        self.assertTrue(redis_cli.exists('_count:{0}:[]'.format(url)))
+        self.assertEqual(redis_cli.keys('_count:*foo*'), [])
+
     def test_post_update_error_400_by_without_arg(self):
         c1 = Category(name='category1')
         p1 = Post(title='post1', slug='post1')
@@ -716,4 +794,46 @@ class APIV1TestCase(ModelTestMixin, AsyncHTTPTestCase):
         )
         self.assertTrue(204, response.code)
         obj = self.db.query(Comment).get(1)
-        self.assertEqual(obj, None)
\ No newline at end of file
+        self.assertEqual(obj, None)
+
+    def test_post_comments_paginated_by_floor(self):
+        p1 = Post(title='post1', slug='post1', publish_time=datetime.now())
+        self.db.add(p1)
+        self.db.commit()
+        comments = []
+        for i in range(3):
+            comments.append(Comment.create(
+                self.db, title='comment%d' % i, post_id=p1.id,
+                email='a@b.c', status=(i != 1)
+            ))
+            self.db.commit()
+        Comment.create(self.db, title='reply', post_id=p1.id,
+                       reply_id=comments[0].id, email='a@b.c', status=True)
+        self.db.commit()
+
+        url = self.reverse_url('api:v1:post:comments', p1.id)
+        data = self.api_fetch(url + '?per_page=2')
+        # 匿名用户看不到关闭的评论(2楼)
+        self.assertEqual([item['floor'] for item in data['object_list']],
+                         [1, 3])
+        self.assertTrue(data['has_next'])
+        data = self.api_fetch(
+            url + '?per_page=2&cursor=' + data['next_cursor']
+        )
+        self.assertEqual([item['title'] for item in data['object_list']],
+                         ['reply'])
+        self.assertFalse(data['has_next'])
+
+        # 管理员可以看到关闭的评论
+        session_id = self.login()
+        self.db.query(User).filter_by(
+            email='dont-duplicate@qq.com'
+        ).update({'is_superuser': True})
+        self.db.commit()
+        response = self.fetch(url, headers={"Session-ID": session_id})
+        data = json.loads(response.body)
+        self.assertEqual([item['floor'] for item in data['object_list']],
+                         [1, 2, 3])
+
+        response = self.fetch(self.reverse_url('api:v1:post:comments', 100))
+        self.assertEqual(404, response.code)
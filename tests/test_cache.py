@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import sys
+import time
+import unittest
+from unittest import mock
+from collections import OrderedDict
+
+from app.cache import RedisCache, TieredCache, FragmentCache
+from app.blog.handlers import SidebarMixin
+from app.models import Post, Tag
+from app.models.stats import SiteStats
+from .base import ModelTestMixin
+
+__all__ = ['CacheTagTestCase', 'TieredCacheTestCase', 'FragmentCacheTestCase']
+
+
+# ========================================================
+# cache testing ==========================================
+# ========================================================
+
+
+class CacheTagTestCase(unittest.TestCase):
+
+    class TestCache(RedisCache):
+        key = 'test-cache'
+
+    def tearDown(self):
+        super().tearDown()
+        self.TestCache.flush_all()
+
+    def test_invalidate_tags_only_remove_tagged_keys(self):
+        cache = self.TestCache
+        cache.set('/post-1', b'1', 60, tags=['post:1', 'sidebar'])
+        cache.set('/post-2', b'2', 60, tags=['post:2', 'sidebar'])
+        self.assertEqual(cache.invalidate_tags('post:1'), ['/post-1'])
+        self.assertIsNone(cache.get('/post-1'))
+        self.assertEqual(cache.get('/post-2'), b'2')
+
+    def test_tag_set_drop_expired_keys(self):
+        cache = self.TestCache
+        cache.set('/?page=1', b'1', 60, tags=['post-list'])
+        cache.set('/?page=2', b'2', 60, tags=['post-list'])
+        with mock.patch('app.cache.time.time',
+                        return_value=time.time() + 61):
+            cache.set('/?page=3', b'3', 60, tags=['post-list'])
+        self.assertEqual(cache.client.zrange(cache._tag_key('post-list'),
+                                             0, -1), [b'/?page=3'])
+        self.assertEqual(cache.invalidate_tags('post-list', 'sidebar'),
+                         ['/?page=3'])
+
+    def test_tag_set_ttl_only_extended(self):
+        cache = self.TestCache
+        cache.set('fragment:sidebar', b'data', 86400, tags=['sidebar'])
+        cache.set('sidebar-html', b'html', 60, tags=['sidebar'])
+        tag_key = cache._tag_key('sidebar')
+        self.assertGreater(cache.client.ttl(tag_key), 60)
+
+        # 短的缓存过期以后，清除标签仍然能清除长的缓存
+        cache.client.delete('test-cache:sidebar-html')
+        cache.client.zadd(tag_key, time.time() - 1, 'sidebar-html')
+        self.assertEqual(cache.invalidate_tags('sidebar'),
+                         ['fragment:sidebar', 'sidebar-html'])
+        self.assertIsNone(cache.get('fragment:sidebar'))
+
+    def test_tag_set_without_expire_persist(self):
+        cache = self.TestCache
+        cache.set('/post-1', b'1', 60, tags=['post:1'])
+        cache.set('/post-1/raw', b'1', tags=['post:1'])
+        cache.set('/post-1/amp', b'1', 60, tags=['post:1'])
+        self.assertEqual(cache.client.ttl(cache._tag_key('post:1')), -1)
+
+    def test_flush_all_keep_render_lock(self):
+        cache = self.TestCache
+        cache.set('/post-1', b'1', 60, tags=['post:1'])
+        cache.client.set('test-cache:lock:/post-1', b'1', ex=60)
+        cache.flush_all()
+        self.assertIsNone(cache.get('/post-1'))
+        self.assertFalse(cache.client.exists(cache._tag_key('post:1')))
+        self.assertTrue(cache.client.exists('test-cache:lock:/post-1'))
+        cache.client.delete('test-cache:lock:/post-1')
+
+
+class TieredCacheTestCase(unittest.TestCase):
+
+    class TestCache(TieredCache):
+        key = 'test-tiered'
+
+    def setUp(self):
+        cache = self.TestCache
+        cache._local = OrderedDict()
+        cache._local_bytes = 0
+        cache._counters = dict.fromkeys(TieredCache._counters, 0)
+        cache.max_bytes = TieredCache.max_bytes
+        cache.max_entry_bytes = TieredCache.max_entry_bytes
+
+    def tearDown(self):
+        self.TestCache.flush_all()
+
+    def test_local_lru_byte_accounting_and_eviction(self):
+        cache = self.TestCache
+        value = b'x' * 100
+        size = sys.getsizeof(value)
+        cache.max_bytes = size * 2
+        cache._local_set('a', value, 60)
+        cache._local_set('b', value, 60)
+        cache._local_get('a')           # a成为最近使用的条目
+        cache._local_set('c', value, 60)
+        self.assertEqual(list(cache._local), ['a', 'c'])
+        stats = cache.stats()
+        self.assertEqual(stats['local_bytes'], size * 2)
+        self.assertEqual(stats['local_evictions'], 1)
+
+        # 覆盖已有的条目不会重复计算大小，太大的条目不会放入LRU缓存
+        cache._local_set('a', value, 60)
+        cache.max_entry_bytes = size - 1
+        cache._local_set('c', value, 60)
+        self.assertEqual(list(cache._local), ['a'])
+        self.assertEqual(cache.stats()['local_bytes'], size)
+
+    def test_local_entry_expire(self):
+        cache = self.TestCache
+        cache._local_set('a', b'1', 10)
+        with mock.patch('app.cache.time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache._local_get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['local_entries'], stats['local_bytes']),
+                         (0, 0))
+        self.assertEqual(stats['local_expirations'], 1)
+
+    def test_get_through_local_and_redis(self):
+        cache = self.TestCache
+        cache.set('/post-1', b'1', 60)
+        self.assertEqual(cache.get('/post-1'), b'1')
+        cache._local_clear()
+        self.assertEqual(cache.get('/post-1'), b'1')   # 从Redis回填
+        self.assertEqual(cache.get('/post-1'), b'1')
+        self.assertIsNone(cache.get('/post-2'))
+        stats = cache.stats()
+        self.assertEqual(stats['local_hits'], 2)
+        self.assertEqual(stats['local_misses'], 2)
+        self.assertEqual((stats['redis_hits'], stats['redis_misses']), (1, 1))
+
+    def test_invalidate_message_from_other_process(self):
+        cache = self.TestCache
+        cache._local_set('/post-1', b'1', 60)
+        cache._local_set('/post-2', b'2', 60)
+        # 本进程自己发出的通知被忽略
+        cache._on_message({'data': '{0}:/post-1'.format(
+            cache._origin).encode()})
+        self.assertIn('/post-1', cache._local)
+        cache._on_message({'data': b'other:/post-1'})
+        self.assertEqual(list(cache._local), ['/post-2'])
+        cache._on_message({'data': b'other:*'})
+        self.assertEqual(len(cache._local), 0)
+        self.assertEqual(cache.stats()['invalidations'], 2)
+
+    def test_write_publish_invalidate_message(self):
+        cache = self.TestCache
+        pubsub = cache.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(cache.channel)
+        try:
+            cache.set('/post-1', b'1', 60)
+            message = None
+            for _ in range(20):
+                message = pubsub.get_message(timeout=0.1)
+                if message:
+                    break
+            self.assertEqual(message['data'], '{0}:/post-1'.format(
+                cache._origin).encode())
+        finally:
+            pubsub.close()
+
+
+class FragmentTestCache(RedisCache):
+    key = 'test-fragment'
+
+
+class SidebarHandler(SidebarMixin):
+    def __init__(self, db):
+        self.db = db
+
+
+class FragmentCacheTestCase(ModelTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._cache = FragmentCache.cache
+        FragmentCache.cache = FragmentTestCache
+
+    def tearDown(self):
+        super().tearDown()
+        FragmentCache.cache = self._cache
+        FragmentTestCache.flush_all()
+
+    def test_get_data_cached_until_tag_invalidated(self):
+        creator = mock.Mock(return_value={'tag_data': ((1, 'python'),)})
+        for _ in range(2):
+            data = FragmentCache.get_data('sidebar', creator,
+                                          tags=['sidebar'])
+            self.assertEqual(data, {'tag_data': ((1, 'python'),)})
+        self.assertEqual(creator.call_count, 1)
+
+        FragmentTestCache.invalidate_tags('sidebar')
+        FragmentCache.get_data('sidebar', creator, tags=['sidebar'])
+        self.assertEqual(creator.call_count, 2)
+
+    def test_get_data_recreate_invalid_value(self):
+        FragmentTestCache.set(FragmentCache._fragment_key('sidebar'),
+                              b'not marshal data')
+        self.assertEqual(FragmentCache.get_data('sidebar', lambda: [1]), [1])
+
+    def test_get_html_encode_str(self):
+        html = FragmentCache.get_html('sidebar:theme', lambda: '<p>中文</p>')
+        self.assertEqual(html, '<p>中文</p>'.encode())
+        self.assertEqual(FragmentCache.get_html('sidebar:theme', None), html)
+
+    def test_sidebar_tag_data_without_stats(self):
+        p1 = Post(title='post1', slug='post1', tags=[Tag(name='python')])
+        self.db.add(p1)
+        self.db.commit()
+        handler = SidebarHandler(self.db)
+        with mock.patch.object(Post, 'get_archive_month', return_value=[]), \
+                mock.patch.object(SiteStats, 'get_base_info') as base_info:
+            tags = handler.sidebar_tag_data()
+            base_info.assert_not_called()
+            self.assertEqual([tag.name for tag in tags], ['python'])
+            self.assertEqual(handler.sidebar_data()['tag_data'], tags)
+            base_info.assert_called_once_with(self.db)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import gzip
+import time
+import unittest
+from unittest import mock
+
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+from tornado.web import Application, RequestHandler
+
+from app import create_app
+from app.blog.handlers import PostHandler
+from app.cache import RedisCache
+from app.models.post import PostSlugMap
+from app.models.stats import SiteStats
+from app.middlewares import (BaseMiddleware, MiddlewareChain,
+                             CacheMiddleware, CachedResponse)
+
+__all__ = ['MiddlewareChainTestCase', 'CachedResponseTestCase',
+           'CacheMiddlewareTestCase']
+
+
+class RecordMiddleware(BaseMiddleware):
+    """记录钩子的调用顺序到`handler.calls`中"""
+
+    def before_request(self, handler):
+        handler.calls.append((self.label, 'before'))
+
+    def after_request(self, handler):
+        handler.calls.append((self.label, 'after'))
+        if getattr(self, 'fail', False):
+            raise ValueError(self.label)
+
+
+class BeforeOnlyMiddleware(BaseMiddleware):
+
+    def before_request(self, handler):
+        handler.calls.append(('before-only', 'before'))
+
+
+class FakeHandler(object):
+    def __init__(self, path):
+        self.request = HTTPServerRequest(uri=path)
+        self.calls = []
+
+
+class MiddlewareTestCache(RedisCache):
+    key = 'test-mw-cache'
+
+
+class PageHandler(RequestHandler):
+    _cache_tags = None
+
+    def get(self):
+        self.write('page')
+
+
+def make_page_handler(uri, headers=None, port=8888):
+    """创建一个响应写入到mock连接的handler"""
+    connection = mock.Mock()
+    connection.stream.socket.getsockname.return_value = ('0.0.0.0', port)
+    request = HTTPServerRequest(method='GET', uri=uri,
+                                headers=HTTPHeaders(headers or {}),
+                                connection=connection)
+    handler = PageHandler(Application(), request)
+    handler._transforms = []
+    return handler
+
+
+# ========================================================
+# middleware testing =====================================
+# ========================================================
+
+
+class MiddlewareChainTestCase(unittest.TestCase):
+
+    def test_chain_order_and_route_rules(self):
+        chain = MiddlewareChain({
+            'tests.test_middlewares.RecordMiddleware': {
+                'label': 'late', 'order': 10, 'fail': True,
+            },
+            'tests.test_middlewares.BeforeOnlyMiddleware': {
+                'include': [r'/blog'],
+            },
+        })
+        self.assertEqual([entry.name for entry in chain.entries],
+                         ['BeforeOnlyMiddleware', 'RecordMiddleware'])
+        self.assertIsNone(chain.entries[0].after_request)
+
+        handler = FakeHandler('/blog/1')
+        chain.prepare(handler)
+        chain.on_finish(handler)
+        self.assertEqual(handler.calls, [('before-only', 'before'),
+                                         ('late', 'before'),
+                                         ('late', 'after')])
+        handler = FakeHandler('/api/v1/posts')
+        chain.prepare(handler)
+        self.assertEqual(handler.calls, [('late', 'before')])
+
+        stats = chain.stats()
+        self.assertEqual(stats['RecordMiddleware']['before_request']['count'],
+                         2)
+        self.assertEqual(stats['RecordMiddleware']['after_request']['errors'],
+                         1)
+        self.assertEqual(
+            stats['BeforeOnlyMiddleware']['before_request']['count'], 1
+        )
+
+    def test_after_request_only_for_entered_middlewares(self):
+        chain = MiddlewareChain({
+            'tests.test_middlewares.RecordMiddleware': {
+                'label': 'record', 'exclude': r'/admin',
+            },
+        })
+        handler = FakeHandler('/admin/posts')
+        chain.prepare(handler)
+        chain.on_finish(handler)
+        self.assertEqual(handler.calls, [])
+        # prepare()之前就结束的请求(比如出错)也不会执行after_request()
+        handler = FakeHandler('/')
+        chain.on_finish(handler)
+        self.assertEqual(handler.calls, [])
+
+
+class CachedResponseTestCase(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        entry = CachedResponse(404, [('Content-Type', 'text/html; 中文')],
+                               '"abc"', gzip.compress(b'body'), 123.5)
+        result = CachedResponse.unpack(entry.pack())
+        self.assertEqual((result.status, result.headers, result.etag,
+                          result.fresh_until),
+                         (404, [('Content-Type', 'text/html; 中文')],
+                          '"abc"', 123.5))
+        self.assertEqual(gzip.decompress(result.body), b'body')
+
+    def test_unpack_invalid_data(self):
+        data = CachedResponse(200, [('Content-Type', 'text/html')], '',
+                              b'', 0).pack()
+        self.assertIsNone(CachedResponse.unpack(b'<html>'))
+        self.assertIsNone(CachedResponse.unpack(None))
+        self.assertIsNone(CachedResponse.unpack(data[:10]))
+
+
+class CacheMiddlewareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.middleware = CacheMiddleware(
+            'tests.test_middlewares.MiddlewareTestCache'
+        )
+
+    def tearDown(self):
+        CacheMiddleware._inflight.clear()
+        MiddlewareTestCache.flush_all()
+        for key in MiddlewareTestCache.client.scan_iter('test-mw-cache:*'):
+            MiddlewareTestCache.client.delete(key)
+
+    def cache_page(self, uri, body=b'cached', fresh_until=None):
+        entry = CachedResponse(200, [('Content-Type', 'text/html')],
+                               '"etag"', gzip.compress(body),
+                               fresh_until or time.time() + 60)
+        MiddlewareTestCache.set(uri, entry.pack(), 120)
+        return entry
+
+    def response(self, handler):
+        """(状态码, 响应头, 响应体)"""
+        start_line, headers, chunk = \
+            handler.request.connection.write_headers.call_args[0]
+        return start_line.code, headers, chunk
+
+    def test_finish_with_gzip_passthrough(self):
+        entry = self.cache_page('/post', b'cached')
+        handler = make_page_handler('/post', {'Accept-Encoding': 'gzip'})
+        self.middleware.finish_with(handler, entry)
+        status, headers, chunk = self.response(handler)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(chunk, entry.body)
+
+        handler = make_page_handler('/post')
+        self.middleware.finish_with(handler, entry)
+        status, headers, chunk = self.response(handler)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(chunk, b'cached')
+
+    def test_finish_with_not_modified(self):
+        entry = self.cache_page('/post')
+        handler = make_page_handler('/post', {'If-None-Match': '"etag"'})
+        self.middleware.finish_with(handler, entry)
+        status, headers, chunk = self.response(handler)
+        self.assertEqual(status, 304)
+        self.assertEqual(chunk, b'')
+
+    def test_vary_header_on_cache_miss(self):
+        handler = make_page_handler('/post')
+        self.middleware.before_request(handler)
+        handler.get()
+        handler.finish()
+        status, headers, chunk = self.response(handler)
+        self.assertEqual((status, chunk), (200, b'page'))
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.middleware.after_request(handler)
+
+    def test_page_cache_scope_in_key(self):
+        self.cache_page('/post', b'public')
+        handler = make_page_handler('/post')
+        handler.page_cache_scope = lambda: 'all-comments'
+        self.middleware.before_request(handler)
+        handler.get()
+        handler.finish()
+        self.middleware.after_request(handler)
+        status, headers, chunk = self.response(handler)
+        self.assertEqual(chunk, b'page')
+        entry = CachedResponse.unpack(
+            MiddlewareTestCache.get('/post#all-comments')
+        )
+        self.assertEqual(gzip.decompress(entry.body), b'page')
+
+        # 过期的有作用域的缓存不会在后台刷新，直接重新渲染
+        self.cache_page('/post#all-comments', b'stale',
+                        fresh_until=time.time() - 1)
+        handler = make_page_handler('/post')
+        handler.page_cache_scope = lambda: 'all-comments'
+        with mock.patch.object(self.middleware, 'revalidate') as revalidate:
+            self.middleware.before_request(handler)
+            handler.get()
+            handler.finish()
+            self.middleware.after_request(handler)
+        revalidate.assert_not_called()
+        self.assertEqual(self.response(handler)[2], b'page')
+
+    def test_lock_token_is_random(self):
+        token = self.middleware.acquire_lock('/post')
+        self.assertEqual(len(token), 32)
+        self.assertIsNone(self.middleware.acquire_lock('/post'))
+        self.assertEqual(self.middleware.lock_holder('/post'), token)
+        self.assertTrue(self.middleware.release_lock('/post', token))
+        self.assertNotEqual(self.middleware.acquire_lock('/post'), token)
+
+    def test_forged_revalidate_header_take_normal_path(self):
+        self.cache_page('/post')
+        handler = make_page_handler(
+            '/post', {CacheMiddleware.revalidate_header: '1'}
+        )
+        self.middleware.before_request(handler)
+        self.assertFalse(getattr(handler, '_cache_revalidation', False))
+        handler.get()
+        self.assertIn(b'cached', handler.request.connection.write_headers
+                      .call_args[0][2])
+
+    def test_revalidate_request_with_lock_token(self):
+        token = self.middleware.acquire_lock('/post')
+        handler = make_page_handler(
+            '/post', {CacheMiddleware.revalidate_header: token}
+        )
+        self.middleware.before_request(handler)
+        self.assertTrue(handler._cache_revalidation)
+        handler.get()
+        handler.finish()
+        self.middleware.after_request(handler)
+        entry = CachedResponse.unpack(MiddlewareTestCache.get('/post'))
+        self.assertEqual(gzip.decompress(entry.body), b'page')
+        self.assertIsNone(self.middleware.lock_holder('/post'))
+
+    def test_revalidate_request_not_counted_as_post_view(self):
+        app = create_app('test')
+        app.middleware_chain = MiddlewareChain({
+            'app.middlewares.CacheMiddleware': {
+                'cache': 'tests.test_middlewares.MiddlewareTestCache'
+            }
+        })
+        uri = '/2017/1/2/post1'
+
+        def prepare_post_handler(headers):
+            request = HTTPServerRequest(method='GET', uri=uri,
+                                        headers=HTTPHeaders(headers),
+                                        connection=mock.Mock())
+            handler = PostHandler(app, request)
+            handler.path_kwargs = {'slug': 'post1'}
+            with mock.patch.object(CacheMiddleware, 'enabled',
+                                   return_value=True), \
+                    mock.patch.object(PostSlugMap, 'get_id',
+                                      return_value=1), \
+                    mock.patch.object(SiteStats, 'incr_post_view') as incr:
+                handler.prepare()
+            self.middleware.after_request(handler)
+            return incr
+
+        token = self.middleware.acquire_lock(uri)
+        incr = prepare_post_handler({CacheMiddleware.revalidate_header: token})
+        incr.assert_not_called()
+        # 伪造的token按普通的访问统计
+        incr = prepare_post_handler({CacheMiddleware.revalidate_header: '1'})
+        incr.assert_called_once_with(1)
+
+    def test_revalidate_url_ignore_host_header(self):
+        handler = make_page_handler('/post?a=1', {'Host': 'evil.example'},
+                                    port=8001)
+        self.assertEqual(
+            self.middleware.revalidate_url(handler.request, '/post?a=1'),
+            'http://127.0.0.1:8001/post?a=1'
+        )
+        self.middleware.revalidate_origin = 'http://10.0.0.2:8000/'
+        self.assertEqual(
+            self.middleware.revalidate_url(handler.request, '/post'),
+            'http://10.0.0.2:8000/post'
+        )
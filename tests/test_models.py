@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 import unittest
-from datetime import datetime, timedelta
+from unittest import mock
+from datetime import datetime, timedelta, date
 
+from redis import ConnectionError
 from sqlalchemy import create_engine
 
+from config import TestingConfig
 from app.models import *
+from app.models.stats import SiteStats, ContentCounter, StatsRecorder
+from app.models.sys_config import SysConfig
+from app.models.rate_limit import (RateLimiter, RedisBackend, LocalBackend,
+                                   comment_limiter)
 from .base import ModelTestMixin
 
-__all__ = ['AuthModelTestCase', 'BlogPostModelTestCase']
+__all__ = ['AuthModelTestCase', 'BlogPostModelTestCase',
+           'EngineRegistryTestCase', 'SysConfigTestCase',
+           'RateLimiterTestCase', 'SiteStatsTestCase']
 
 
 # ========================================================
@@ -109,6 +118,99 @@ class BlogPostModelTestCase(ModelTestMixin, unittest.TestCase):
         self.assertEqual(c1.floor, 1)
         self.assertEqual(c2.floor, 2)
 
+    def test_comment_count_and_floor_assigned_on_insert(self):
+        p1 = Post(title='post1', slug='post1')
+        self.db.add(p1)
+        self.db.commit()
+        c1 = Comment.create(self.db, title='comment1', post_id=p1.id)
+        c2 = Comment.create(self.db, title='comment2', post_id=p1.id)
+        self.db.commit()
+        self.assertEqual((c1.floor, c2.floor), (1, 2))
+        self.assertEqual(p1.comment_count, 2)
+
+        self.db.delete(c2)
+        self.db.commit()
+        self.assertEqual(p1.comment_count, 1)
+        c3 = Comment.create(self.db, title='comment3', post_id=p1.id)
+        self.db.commit()
+        # 删除的楼层不会再分配
+        self.assertEqual((c3.floor, p1.comment_count), (3, 2))
+
+    def test_comment_floor_not_reused_after_deleting_middle(self):
+        p1 = Post(title='post1', slug='post1')
+        self.db.add(p1)
+        self.db.commit()
+        c1, c2, c3 = [Comment.create(self.db, title='comment%d' % i,
+                                     post_id=p1.id) for i in range(1, 4)]
+        self.db.commit()
+        self.db.delete(c2)
+        self.db.commit()
+        c4 = Comment.create(self.db, title='comment4', post_id=p1.id)
+        self.db.commit()
+        floors = [c.floor for c in self.db.query(Comment).filter_by(
+            post_id=p1.id).order_by(Comment.floor)]
+        self.assertEqual(floors, [1, 3, 4])
+        self.assertEqual(c4.floor, 4)
+        self.assertEqual(p1.comment_count, 3)
+
+    def test_comment_count_only_includes_approved(self):
+        p1 = Post(title='post1', slug='post1')
+        self.db.add(p1)
+        self.db.commit()
+        c1 = Comment.create(self.db, title='comment1', post_id=p1.id)
+        c2 = Comment.create(self.db, title='comment2', post_id=p1.id,
+                            status=False)
+        self.db.commit()
+        self.assertEqual((c1.floor, c2.floor), (1, 2))
+        self.assertEqual(p1.comment_count, 1)
+
+        c2.status = True
+        self.db.commit()
+        self.assertEqual(p1.comment_count, 2)
+        c1.status = False
+        self.db.commit()
+        self.assertEqual(p1.comment_count, 1)
+        self.db.delete(c1)
+        self.db.commit()
+        self.assertEqual(p1.comment_count, 1)
+        self.db.delete(c2)
+        self.db.commit()
+        self.assertEqual(p1.comment_count, 0)
+
+    def test_comment_threads_built_from_floor_order(self):
+        p1 = Post(title='post1', slug='post1')
+        self.db.add(p1)
+        self.db.commit()
+        c1 = Comment.create(self.db, title='comment1', post_id=p1.id,
+                            email='a@b.c', status=True)
+        c2 = Comment.create(self.db, title='comment2', post_id=p1.id,
+                            email='a@b.c', status=True)
+        self.db.commit()
+        c3 = Comment.create(self.db, title='comment3', post_id=p1.id,
+                            email='a@b.c', reply_id=c1.id, status=True)
+        self.db.commit()
+        c4 = Comment.create(self.db, title='comment4', post_id=p1.id,
+                            email='a@b.c', reply_id=c3.id, status=False)
+        self.db.commit()
+
+        comments = Comment.get_thread_query(self.db, p1.id,
+                                            approved_only=False).all()
+        threads = Comment.build_threads(comments)
+        self.assertEqual(Comment.walk_threads(threads),
+                         [(c1, 0), (c3, 1), (c4, 2), (c2, 0)])
+        data = Comment.threads_to_json(threads)
+        self.assertEqual([item['floor'] for item in data], [1, 2])
+        self.assertEqual(data[0]['replies'][0]['replies'][0]['title'],
+                         'comment4')
+        self.assertNotIn('email', data[0])
+
+        # 被回复的评论不在列表中时，回复作为根节点
+        comments = Comment.get_thread_query(self.db, p1.id).all()
+        self.assertEqual(
+            Comment.walk_threads(Comment.build_threads(comments[1:])),
+            [(c2, 0), (c3, 0)]
+        )
+
     def test_post_type_choices(self):
         p1 = Post(title='post1', slug='post1')
         p1.type = 'origin'
@@ -120,3 +222,430 @@ class BlogPostModelTestCase(ModelTestMixin, unittest.TestCase):
         self.assertNotEqual(obj.type.value, 'origin')
         self.assertEqual(obj.type.value, '原创')
 
+    def test_post_rendered_content_saved_with_hash(self):
+        p1 = Post(title='post1', slug='post1', content='# title')
+        self.db.add(p1)
+        self.db.commit()
+        self.assertIn('<h1 id="title">title</h1>', p1.content_html)
+        self.assertFalse(p1.content_is_stale())
+
+        p1.content = '# other'
+        self.assertTrue(p1.content_is_stale())
+        self.db.commit()
+        self.assertIn('other', p1.markdown_content)
+
+    def test_post_update_without_content_change_skip_render(self):
+        self.db.add(Post(title='post1', slug='post1', content='# title'))
+        self.db.commit()
+        self.db.expunge_all()
+
+        obj = self.db.query(Post).get(1)
+        with mock.patch.object(Post, 'render_content') as render:
+            obj.title = 'other'
+            self.db.flush()
+        render.assert_not_called()
+        self.assertNotIn('content', obj.__dict__)
+        self.db.commit()
+
+    def test_post_body_deferred_on_list_query(self):
+        self.db.add(Post(title='post1', slug='post1', content='# title',
+                         publish_time=datetime.now()))
+        self.db.commit()
+        self.db.expunge_all()
+        obj = Post.get_published_post(self.db, profile='list').first()
+        self.assertNotIn('content', obj.__dict__)
+        self.assertNotIn('content_html', obj.__dict__)
+        obj = Post.get_object_by_slug(self.db, 'post1', profile='detail')
+        self.assertEqual(obj.__dict__['content'], '# title')
+
+    def test_post_month_range(self):
+        start, end = Post.month_range('201712')
+        self.assertEqual(start, datetime(2017, 12, 1))
+        self.assertEqual(end, datetime(2018, 1, 1))
+        self.assertRaises(ValueError, Post.month_range, '2017-12')
+
+    def test_post_archive_incremental_update(self):
+        redis_cli.delete(PostArchive.key)
+        redis_cli.hmset(PostArchive.key, {'201701': 1})
+        p1 = Post(title='post1', slug='post1',
+                  publish_time=datetime(2017, 1, 2))
+        self.db.add(p1)
+        self.db.commit()
+        self.assertEqual(redis_cli.hget(PostArchive.key, '201701'), '2')
+
+        p1.publish_time = datetime(2017, 2, 2)
+        self.db.commit()
+        p1.status = False
+        self.db.rollback()
+        self.assertEqual(redis_cli.hgetall(PostArchive.key),
+                         {'201701': '1', '201702': '1'})
+        redis_cli.delete(PostArchive.key)
+
+    def test_post_archive_redis_error_after_commit(self):
+        redis_cli.hmset(PostArchive.key, {'201701': 1})
+        p1 = Post(title='post1', slug='post1',
+                  publish_time=datetime(2017, 1, 2))
+        self.db.add(p1)
+        with mock.patch.object(PostArchive, 'incr',
+                               side_effect=ConnectionError):
+            self.db.commit()
+        self.assertIsNotNone(p1.id)
+        # 汇总已经不准确，下一次读取时重建
+        self.assertFalse(redis_cli.exists(PostArchive.key))
+
+    def test_post_archive_rebuild_discarded_by_concurrent_incr(self):
+        redis_cli.delete(PostArchive.key, PostArchive.building_key)
+        redis_cli.hmset(PostArchive.key, {'201701': 1})
+
+        def count_and_incr(session):
+            # 统计以后，写入之前，其它进程发布了新的文章
+            PostArchive.incr({'201701': 1})
+            return {'201701': 1}
+
+        with mock.patch.object(Post, 'count_by_month',
+                               side_effect=count_and_incr):
+            PostArchive.rebuild(self.db)
+        self.assertEqual(redis_cli.hget(PostArchive.key, '201701'), '2')
+
+        with mock.patch.object(Post, 'count_by_month',
+                               return_value={'201701': 2}):
+            PostArchive.rebuild(self.db)
+        self.assertEqual(redis_cli.hgetall(PostArchive.key), {'201701': '2'})
+        self.assertFalse(redis_cli.exists(PostArchive.building_key))
+        redis_cli.delete(PostArchive.key)
+
+    def test_post_slug_map_redis_error_after_commit(self):
+        p1 = Post(title='post1', slug='post1')
+        self.db.add(p1)
+        self.db.commit()
+        p1.slug = 'renamed'
+        pipe = mock.Mock(**{'execute.side_effect': ConnectionError})
+        with mock.patch.object(redis_cli, 'pipeline', return_value=pipe):
+            self.db.commit()
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(p1.slug, 'renamed')
+
+    def test_post_slug_map_follows_rename(self):
+        redis_cli.delete(PostSlugMap.key, PostSlugMap.renamed_key)
+        p1 = Post.create(self.db, title='post1', slug='post1')
+        p2 = Post.create(self.db, title='post2', slug='post1')
+        self.db.commit()
+        self.assertEqual(p2.slug, 'post1-1')
+        self.assertEqual(PostSlugMap.get_post(self.db, 'post1'), p1)
+
+        p1.slug = 'renamed'
+        self.db.commit()
+        self.assertEqual(PostSlugMap.get_post(self.db, 'post1'), p1)
+        self.assertEqual(p1.slug, 'renamed')
+        self.db.delete(p1)
+        self.db.commit()
+        self.assertIsNone(PostSlugMap.get_post(self.db, 'renamed'))
+        redis_cli.delete(PostSlugMap.key, PostSlugMap.renamed_key)
+
+    def test_post_view_sync_only_dirty(self):
+        p1 = Post(title='post1', slug='post1', view_num=5)
+        p2 = Post(title='post2', slug='post2', view_num=7)
+        self.db.add_all([p1, p2])
+        self.db.commit()
+        redis_cli.delete(SiteStats.post_view_dirty,
+                         SiteStats.post_view.format(id=p1.id))
+        SiteStats.incr_post_view(p1.id)
+        SiteStats.incr_post_view(p1.id)
+
+        views = SiteStats.pop_dirty_post_views()
+        self.assertEqual(views, {p1.id: 2})
+        self.assertEqual(SiteStats.pop_dirty_post_views(), {})
+        self.assertEqual(Post.update_view_num(self.db, views), 1)
+        self.db.commit()
+        self.db.expire_all()
+        self.assertEqual((p1.view_num, p2.view_num), (2, 7))
+        redis_cli.delete(SiteStats.post_view.format(id=p1.id))
+
+    def test_content_counter_incremental_update(self):
+        redis_cli.delete(ContentCounter.key)
+        p1 = Post(title='post1', slug='post1', type='origin')
+        self.db.add_all([p1, Post(title='post2', slug='post2', type='origin',
+                                  status=False)])
+        self.db.commit()
+        stats = SiteStats.get_base_info(self.db)
+        self.assertEqual((stats.post_count, stats.post_origin_count), (1, 1))
+
+        p1.type = 'translation'
+        self.db.add(Comment(post=p1, title='comment1'))
+        self.db.commit()
+        stats = SiteStats.get_base_info(self.db)
+        self.assertEqual(stats.post_origin_count, 0)
+        self.assertEqual(stats.post_translation_count, 1)
+        self.assertEqual(stats.comment_count, 1)
+        self.assertEqual(ContentCounter.count(self.db),
+                         ContentCounter.rebuild(self.db))
+        redis_cli.delete(ContentCounter.key)
+
+    def test_content_counter_rebuild_discarded_by_concurrent_incr(self):
+        redis_cli.delete(ContentCounter.key, ContentCounter.building_key)
+        count = ContentCounter.count
+
+        def count_and_incr(session):
+            counts = count(session)
+            # 统计以后，写入之前，其它进程提交了新的评论
+            ContentCounter.incr({'comment': 1})
+            return counts
+
+        with mock.patch.object(ContentCounter, 'count',
+                               side_effect=count_and_incr):
+            ContentCounter.rebuild(self.db)
+        self.assertFalse(redis_cli.exists(ContentCounter.key))
+
+        ContentCounter.rebuild(self.db)
+        self.assertEqual(redis_cli.hget(ContentCounter.key, 'comment'), '0')
+        self.assertFalse(redis_cli.exists(ContentCounter.building_key))
+        redis_cli.delete(ContentCounter.key)
+
+    def test_content_counter_redis_error_after_commit(self):
+        ContentCounter.rebuild(self.db)
+        self.db.add(Post(title='post1', slug='post1'))
+        with mock.patch.object(ContentCounter, 'incr',
+                               side_effect=ConnectionError):
+            self.db.commit()
+        self.assertFalse(redis_cli.exists(ContentCounter.key))
+
+    def test_post_relation_related_and_navigation(self):
+        redis_cli.delete(PostRelation.key, PostRelation.dirty_key,
+                         PostRelation.computed_at_key)
+        t1, t2, t3 = Tag(name='tag1'), Tag(name='tag2'), Tag(name='tag3')
+        c1 = PostCollection(name='collection1')
+        now = datetime.now()
+        p1 = Post(title='post1', slug='post1', tags=[t1, t2], collection=c1,
+                  publish_time=now - timedelta(days=3))
+        p2 = Post(title='post2', slug='post2', tags=[t1, t2, t3],
+                  publish_time=now - timedelta(days=2))
+        p3 = Post(title='post3', slug='post3', tags=[t3], collection=c1,
+                  publish_time=now - timedelta(days=1))
+        p4 = Post(title='post4', slug='post4', tags=[t1],
+                  publish_time=now + timedelta(days=1))
+        self.db.add_all([p1, p2, p3, p4])
+        self.db.commit()
+        self.assertTrue(PostRelation.needs_update(self.db))
+        self.assertEqual(PostRelation.update(self.db), 3)
+        self.assertFalse(PostRelation.needs_update(self.db))
+
+        relation = PostRelation.get(self.db, p2.id)
+        self.assertEqual(relation['related'], [p1, p3])
+        self.assertEqual((relation['prev'], relation['next']), (p1, p3))
+        relation = PostRelation.get(self.db, p1.id)
+        self.assertEqual(relation['series_next'], p3)
+        self.assertIsNone(relation['prev'])
+
+        p3.status = False
+        self.db.commit()
+        self.assertTrue(PostRelation.needs_update(self.db))
+        # 关系改变了的文章(包括不再发布的文章)的页面缓存被清除
+        cache = mock.Mock()
+        self.assertEqual(PostRelation.update(self.db, cache=cache), 2)
+        cache.invalidate_tags.assert_called_once_with(*sorted(
+            'post:{0}'.format(post_obj.id) for post_obj in (p1, p2, p3)
+        ))
+        cache.reset_mock()
+        PostRelation.update(self.db, cache=cache)
+        cache.invalidate_tags.assert_not_called()
+        redis_cli.delete(PostRelation.key, PostRelation.dirty_key,
+                         PostRelation.computed_at_key)
+
+    def test_post_relation_redis_error_after_commit(self):
+        self.db.add(Post(title='post1', slug='post1'))
+        with mock.patch.object(redis_cli, 'set', side_effect=ConnectionError):
+            self.db.commit()
+        self.assertIsNotNone(self.db.query(Post).filter_by(slug='post1').one())
+
+
+# ========================================================
+# engine-registry testing ================================
+# ========================================================
+
+
+class EngineRegistryTestCase(unittest.TestCase):
+
+    def test_get_engine_shared_by_uri(self):
+        e1 = get_engine('sqlite:///:memory:', pool_size=2)
+        e2 = get_engine('sqlite:///:memory:', pool_size=3)
+        e3 = get_engine(TestingConfig.SQLALCHEMY_URI)
+        # 同一个uri只有一个连接池，以第一次调用的参数为准
+        self.assertIs(e1, e2)
+        self.assertEqual(e2.pool.size(), 2)
+        self.assertIsNot(e1, e3)
+
+    def test_engine_pool_stats(self):
+        engine = get_engine('sqlite:///:memory:', pool_size=2)
+        self.assertEqual(warm_up_engine(engine), 2)
+        stats = engine_pool_stats()[repr(engine.url)]
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checked_in'], 2)
+
+    def test_pool_wait_count_only_when_no_idle_connection(self):
+        engine = get_engine('sqlite:///:memory:', pool_size=2)
+        warm_up_engine(engine)
+        pool = engine.pool
+        checkout_count, wait_count = pool.checkout_count, pool.wait_count
+        connection = engine.connect()
+        connection.close()
+        # 有空闲的连接，不算等待
+        self.assertEqual(pool.checkout_count, checkout_count + 1)
+        self.assertEqual(pool.wait_count, wait_count)
+
+        connections = [engine.connect() for _ in range(pool.checkedin())]
+        engine.connect().close()
+        for connection in connections:
+            connection.close()
+        self.assertEqual(pool.wait_count, wait_count + 1)
+
+
+# ========================================================
+# sys-config testing =====================================
+# ========================================================
+
+
+class SysConfigTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        super().tearDown()
+        redis_cli.delete('_sysconfig:blog_per_page')
+        SysConfig.invalidate()
+
+    def test_sys_config_snapshot_reload_on_version_change(self):
+        SysConfig.set('blog_per_page', 20, type=int)
+        self.assertEqual(SysConfig.get(**SysConfig.blog_per_page), 20)
+
+        # 其它进程修改时增加了版本号，没有收到通知时定时检查版本号以后重新读取
+        redis_cli.set('_sysconfig:blog_per_page', 30)
+        redis_cli.incr(SysConfig.version_key)
+        SysConfig._checked_at = 0
+        self.assertEqual(SysConfig.get(**SysConfig.blog_per_page), 30)
+
+
+# ========================================================
+# rate-limit testing =====================================
+# ========================================================
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        RateLimiter.use_backend(RedisBackend())
+
+    def tearDown(self):
+        super().tearDown()
+        RateLimiter.use_backend(RedisBackend())
+        redis_cli.delete(comment_limiter._key('127.0.0.2'),
+                         comment_limiter.blacklist_key)
+
+    def test_rate_limiter_backends_agree(self):
+        limiter = RateLimiter('test', limit=2, period=60,
+                              blacklist_key='_blacklist:test')
+        for backend in (LocalBackend(), RedisBackend()):
+            RateLimiter.use_backend(backend)
+            redis_cli.delete(limiter._key('ip'), limiter.blacklist_key)
+            results = [limiter.hit('ip') for _ in range(3)]
+            self.assertEqual([result.allowed for result in results],
+                             [True, True, False])
+            self.assertEqual(results[1].remaining, 0)
+            # 超过限制以后加入黑名单
+            self.assertEqual(limiter.peek('ip').retry_after, -1)
+            limiter.unblock('ip')
+            self.assertFalse(limiter.peek('ip').allowed)
+            limiter.reset('ip')
+            self.assertTrue(limiter.peek('ip').allowed)
+        redis_cli.delete(limiter._key('ip'), limiter.blacklist_key)
+        RateLimiter.registry.pop('test')
+
+    def test_comment_restricted_by_comment_limit(self):
+        SysConfig.set('comment_limit', 2, type=int)
+        try:
+            self.assertEqual(
+                [Comment.comment_restricted('127.0.0.2') for _ in range(3)],
+                [False, False, True]
+            )
+            self.assertTrue(redis_cli.sismember(Comment._black_list_key,
+                                                '127.0.0.2'))
+        finally:
+            redis_cli.delete('_sysconfig:comment_limit')
+            SysConfig.invalidate()
+
+
+# ========================================================
+# site-stats testing =====================================
+# ========================================================
+
+
+class SiteStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        day = str(date.today())
+        self.keys = [SiteStats.pv_amount, SiteStats.pv_day.format(day=day),
+                     SiteStats.uv_hll_amount,
+                     SiteStats.uv_hll_day.format(day=day),
+                     SiteStats.ua_day.format(day=day)]
+        self.old_keys = [SiteStats.uv_amount, SiteStats.access_ip,
+                         SiteStats.uv_migrated]
+        redis_cli.delete(*self.keys + self.old_keys)
+        self.recorder = StatsRecorder()
+
+    def tearDown(self):
+        redis_cli.delete(*self.keys + self.old_keys)
+
+    def test_uv_uses_old_counter_until_migrated(self):
+        redis_cli.set(SiteStats.uv_amount, 100)
+        redis_cli.sadd(SiteStats.access_ip, '10.0.0.1', '10.0.0.2')
+        SiteStats.save_access_ip('10.0.0.3')
+        self.assertEqual(SiteStats.get_uv(), 100)
+
+        SiteStats.migrate_uv()
+        self.assertEqual(SiteStats.get_uv(), 3)
+
+    def test_stats_recorder_buffer_and_flush(self):
+        self.recorder.record('10.0.0.1', 'ua1')
+        self.recorder.record('10.0.0.1', 'ua1')
+        self.recorder.record('10.0.0.2', 'ua2')
+        self.assertIsNone(redis_cli.get(SiteStats.pv_amount))
+        self.assertEqual(self.recorder.stats()['buffered'], 2)
+
+        self.recorder.flush()
+        pv_amount, pv_day, uv_amount, uv_day, ua_day = self.keys
+        self.assertEqual(redis_cli.get(pv_amount), '3')
+        self.assertEqual(redis_cli.get(pv_day), '3')
+        self.assertEqual(redis_cli.pfcount(uv_day), 2)
+        self.assertEqual(redis_cli.lrange(ua_day, 0, -1), ['ua2', 'ua1'])
+        stats = self.recorder.stats()
+        self.assertEqual((stats['buffered'], stats['flushes']), (0, 1))
+
+        # 同一天再次访问的IP不会重复记录UA
+        self.recorder.record('10.0.0.1', 'ua1')
+        self.recorder.flush()
+        self.assertEqual(redis_cli.get(pv_amount), '4')
+        self.assertEqual(redis_cli.llen(ua_day), 2)
+
+    def test_stats_recorder_max_buffer(self):
+        self.recorder.max_buffer = 1
+        self.recorder.record('10.0.0.1', 'ua1')
+        self.recorder.record('10.0.0.2', 'ua2')
+        stats = self.recorder.stats()
+        self.assertEqual((stats['buffered'], stats['dropped']), (1, 1))
+        self.recorder.flush()
+        # PV不受缓冲区大小的限制
+        self.assertEqual(redis_cli.get(SiteStats.pv_amount), '2')
+        self.assertEqual(redis_cli.pfcount(self.keys[3]), 1)
+
+    def test_stats_recorder_keep_pv_when_flush_failed(self):
+        self.recorder.record('10.0.0.1', 'ua1')
+        self.recorder.record('10.0.0.2', 'ua2')
+        pipeline_cls = type(redis_cli.pipeline())
+        with mock.patch.object(pipeline_cls, 'execute',
+                               side_effect=ConnectionError):
+            self.recorder.flush()
+        stats = self.recorder.stats()
+        self.assertEqual(stats['flush_errors'], 1)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['buffered_pv'], 2)
+
+        self.recorder.flush()
+        self.assertEqual(redis_cli.get(SiteStats.pv_amount), '2')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import unittest
+from datetime import datetime, timedelta
+
+from app.models import *
+from app.libs.paginator import KeysetPaginator, InvalidCursor
+from .base import ModelTestMixin
+
+__all__ = ['KeysetPaginatorTestCase']
+
+
+# ========================================================
+# paginator testing ======================================
+# ========================================================
+
+
+class KeysetPaginatorTestCase(ModelTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = datetime(2018, 1, 1)
+        # 每两篇文章的发布时间相同，测试第二个排序键
+        self.db.add_all([
+            Post(title='post%d' % i, slug='post%d' % i,
+                 publish_time=now + timedelta(days=i // 2))
+            for i in range(7)
+        ])
+        self.db.commit()
+        self.paginator = KeysetPaginator(self.db.query(Post), 3,
+                                         keys=(Post.publish_time, Post.id))
+
+    def test_keyset_paginator_walk_forward_and_back(self):
+        expected = [obj.id for obj in self.db.query(Post).order_by(
+            Post.publish_time.desc(), Post.id.desc())]
+        pages = [self.paginator.page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.page(pages[-1].next_cursor))
+        self.assertEqual(len(pages), 3)
+        self.assertFalse(pages[0].has_previous())
+        self.assertEqual([obj.id for page in pages
+                          for obj in page.object_list], expected)
+
+        previous = self.paginator.page(pages[-1].previous_cursor)
+        self.assertEqual(previous.object_list, pages[1].object_list)
+
+    def test_keyset_paginator_invalid_cursor(self):
+        self.assertRaises(InvalidCursor, self.paginator.page, 'invalid')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import unittest
+from datetime import datetime
+
+from app.libs.search import tokenize, strip_markdown
+from app.models import *
+from app.models.search import PostSearchIndex
+from .base import ModelTestMixin
+
+__all__ = ['SearchTestCase']
+
+
+# ========================================================
+# search testing =========================================
+# ========================================================
+
+
+class SearchTestCase(ModelTestMixin, unittest.TestCase):
+
+    def clear_index(self):
+        keys = list(redis_cli.scan_iter(match=PostSearchIndex.prefix + ':*'))
+        if keys:
+            redis_cli.delete(*keys)
+
+    def setUp(self):
+        super().setUp()
+        self.clear_index()
+
+    def tearDown(self):
+        super().tearDown()
+        self.clear_index()
+
+    def test_tokenize_mixed_cjk_and_english(self):
+        self.assertEqual(tokenize('Tornado异步编程'),
+                         ['tornado', '异步', '步编', '编程'])
+        self.assertEqual(tokenize('异步', unigrams=True),
+                         ['异步', '异', '步'])
+        self.assertEqual(strip_markdown('[链接](http://a.com) **b**').split(),
+                         ['链接', 'b'])
+
+    def test_index_updated_on_commit(self):
+        p1 = Post(title='异步编程', slug='post1', content='tornado',
+                  publish_time=datetime.now())
+        p2 = Post(title='post2', slug='post2', content='tornado tornado',
+                  publish_time=datetime.now())
+        self.db.add_all([p1, p2])
+        self.db.commit()
+        total, post_list = PostSearchIndex.search_posts(self.db, '编程')
+        self.assertEqual((total, post_list), (1, [p1]))
+        total, post_list = PostSearchIndex.search_posts(self.db, '程')
+        self.assertEqual((total, post_list), (1, [p1]))
+        total, post_list = PostSearchIndex.search_posts(self.db, 'Tornado')
+        self.assertEqual(post_list, [p2, p1])
+
+        p1.status = False
+        self.db.delete(p2)
+        self.db.commit()
+        self.assertEqual(PostSearchIndex.search("tornado"), (0, []))
+        self.assertEqual(redis_cli.get(PostSearchIndex.total_len_key), '0')
+        self.assertEqual(list(redis_cli.scan_iter(
+            match=PostSearchIndex.term_key + '*'
+        )), [])
+
+    def test_rebuild(self):
+        self.db.add(Post(title='post1', slug='post1', content='sqlalchemy'))
+        self.db.commit()
+        self.clear_index()
+        self.assertEqual(PostSearchIndex.rebuild(self.db), 1)
+        self.assertEqual(PostSearchIndex.search('SQLAlchemy')[0], 1)
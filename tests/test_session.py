@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import time
+import unittest
+from unittest import mock
+
+from redis import ConnectionError
+from tornado.httputil import HTTPServerRequest
+
+from config import TestingConfig
+from app import create_app
+from app.base.handlers import BaseHandler
+from app.models.base import redis_cli
+from app.models.sys_config import SysConfig
+from app.session import Session, CookieSession, SessionDenyList
+
+__all__ = ['SessionTestCase', 'CookieSessionTestCase']
+
+
+class RecordingRedis(object):
+    """记录写入事务(`MULTI`)的次数，其他操作直接交给`redis_cli`"""
+
+    def __init__(self):
+        self.transactions = 0
+
+    def pipeline(self, transaction=True):
+        if transaction:
+            self.transactions += 1
+        return redis_cli.pipeline(transaction=transaction)
+
+    def __getattr__(self, item):
+        return getattr(redis_cli, item)
+
+
+class CookieSessionConfig(TestingConfig):
+    SESSION_BACKEND = 'app.session.CookieSession'
+    SESSION_EXPIRE = 600
+    SESSION_REFRESH_THRESHOLD = 300
+
+
+class FakeHandler(object):
+    config = CookieSessionConfig
+
+    def __init__(self, session_id=None):
+        self.redis_cli = RecordingRedis()
+        self.settings = {'cookie_secret': 'test-cookie-secret'}
+        self.request = HTTPServerRequest(uri='/')
+        self.request.remote_ip = '127.0.0.1'
+        if session_id:
+            self.request.headers['Session-ID'] = session_id
+        self.cookies = {}
+        self.headers = {}
+
+    def get_secure_cookie(self, name):
+        return self.cookies.get(name)
+
+    def set_secure_cookie(self, name, value, **kwargs):
+        self.cookies[name] = value
+
+    def get_cookie(self, name):
+        return self.cookies.get(name)
+
+    def set_cookie(self, name, value, **kwargs):
+        self.cookies[name] = value
+
+    def clear_cookie(self, name):
+        self.cookies.pop(name, None)
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+
+# ========================================================
+# session testing ========================================
+# ========================================================
+
+
+class SessionTestCase(unittest.TestCase):
+    session_id = '_session:test'
+
+    def setUp(self):
+        redis_cli.hmset(self.session_id, {'user_id': '1', 'remote_ip': 'x'})
+        self.expire = SysConfig.get(**SysConfig.session_expire)
+        self.threshold = SysConfig.get(**SysConfig.session_refresh_threshold)
+
+    def tearDown(self):
+        redis_cli.delete(self.session_id)
+
+    def test_session_unchanged_request_does_not_write(self):
+        redis_cli.expire(self.session_id, self.expire)
+        handler = FakeHandler(self.session_id)
+        session = Session(handler)
+        self.assertEqual(session.user_id, '1')
+        session.save()
+        # 剩余时间高于阈值，只是访问也不需要延期
+        session.init_session()
+        session.save()
+        self.assertEqual(handler.redis_cli.transactions, 0)
+
+    def test_session_changes_written_once_on_save(self):
+        redis_cli.expire(self.session_id, self.expire)
+        handler = FakeHandler(self.session_id)
+        session = Session(handler)
+        session.a = 1
+        session.b = 'b'
+        del session.remote_ip
+        self.assertEqual(session.a, '1')
+        self.assertEqual(handler.redis_cli.transactions, 0)
+        session.save()
+        session.save()
+        self.assertEqual(handler.redis_cli.transactions, 1)
+        data = redis_cli.hgetall(self.session_id)
+        self.assertEqual((data['a'], data['b']), ('1', 'b'))
+        self.assertNotIn('remote_ip', data)
+
+    def test_session_refreshed_below_threshold(self):
+        redis_cli.expire(self.session_id, self.threshold - 10)
+        handler = FakeHandler(self.session_id)
+        session = Session(handler)
+        session.init_session()
+        session.save()
+        self.assertEqual(handler.redis_cli.transactions, 1)
+        self.assertGreater(redis_cli.ttl(self.session_id), self.threshold)
+        self.assertIsNotNone(redis_cli.hget(self.session_id, 'last_active'))
+
+    def test_session_ignore_unknown_id(self):
+        handler = FakeHandler('not-a-session')
+        session = Session(handler)
+        self.assertIsNone(session.user_id)
+        session.save()
+        self.assertEqual(handler.redis_cli.transactions, 0)
+
+
+class CookieSessionTestCase(unittest.TestCase):
+    secret = 'test-cookie-secret'
+
+    def tearDown(self):
+        redis_cli.delete(SessionDenyList.key)
+        SessionDenyList._loaded_at = 0
+
+    def token(self, sid='abc', **data):
+        data.update(sid=sid, expire_at=int(time.time()) + 60)
+        return CookieSession.encode(self.secret, data)
+
+    def test_cookie_session_encode_decode(self):
+        data = {'sid': 'abc', 'user_id': '1', 'remote_ip': '127.0.0.1'}
+        token = CookieSession.encode(self.secret, data)
+        self.assertEqual(CookieSession.decode(self.secret, token), data)
+
+    def test_cookie_session_is_encrypted(self):
+        token = CookieSession.encode(self.secret, {'remote_ip': '10.0.0.1'})
+        self.assertNotIn('10.0.0.1', token)
+
+    def test_cookie_session_reject_tampered_value(self):
+        token = CookieSession.encode(self.secret, {'user_id': '1'})
+        self.assertIsNone(CookieSession.decode('another-secret', token))
+        self.assertIsNone(CookieSession.decode(self.secret, token[:-2] + 'xx'))
+
+    def test_cookie_session_from_session_id_header(self):
+        handler = FakeHandler(self.token(user_id='1'))
+        session = CookieSession(handler)
+        self.assertEqual(session.user_id, '1')
+        with mock.patch.object(SysConfig, 'get') as sys_config_get:
+            session.user_id = '2'
+            session.save()
+        # 有效期来自应用配置，不需要读取系统配置
+        sys_config_get.assert_not_called()
+        self.assertEqual(handler.redis_cli.transactions, 0)
+        token = handler.headers['Session-ID']
+        self.assertEqual(handler.cookies['session_id'], token)
+        data = CookieSession.decode(self.secret, token)
+        self.assertEqual((data['sid'], data['user_id']), ('abc', '2'))
+        self.assertLessEqual(data['expire_at'], time.time() + 600)
+
+    def test_cookie_session_rejected_after_logout(self):
+        token = self.token(user_id='1')
+        session = CookieSession(FakeHandler(token))
+        session.logout()
+        self.assertIsNone(CookieSession(FakeHandler(token)).user_id)
+        # 其他进程在同步黑名单以后也会拒绝这个session
+        SessionDenyList._local = {}
+        SessionDenyList.refresh()
+        self.assertTrue(SessionDenyList.contains('abc'))
+
+    def test_session_deny_list_drops_expired_entries(self):
+        SessionDenyList.add('expired', time.time() - 1)
+        SessionDenyList.refresh()
+        self.assertFalse(SessionDenyList.contains('expired'))
+        self.assertEqual(redis_cli.zcard(SessionDenyList.key), 0)
+
+    def test_session_deny_list_keep_local_copy_on_redis_error(self):
+        SessionDenyList.add('abc', time.time() + 60)
+        SessionDenyList.refresh()
+        SessionDenyList._loaded_at = 0
+        with mock.patch.object(redis_cli, 'pipeline') as pipeline:
+            pipeline.return_value.execute.side_effect = ConnectionError
+            self.assertTrue(SessionDenyList.contains('abc'))
+            self.assertFalse(SessionDenyList.contains('other'))
+        # 下一个同步间隔之前不再访问Redis
+        pipeline.return_value.execute.assert_called_once_with()
+
+    def test_session_backend_selected_by_config(self):
+        app = create_app('test')
+        request = HTTPServerRequest(uri='/', connection=mock.Mock())
+        self.assertIsInstance(BaseHandler(app, request).session, Session)
+        self.assertNotIsInstance(BaseHandler(app, request).session,
+                                 CookieSession)
+        app.settings['config'] = CookieSessionConfig
+        self.assertIsInstance(BaseHandler(app, request).session,
+                              CookieSession)